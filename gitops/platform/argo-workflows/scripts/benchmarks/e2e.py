@@ -0,0 +1,169 @@
+"""
+End-to-end migration and rollback against local EKS and Kubernetes fakes
+
+Runs main.karpenter_mode then main.nodegroup_mode, unchanged, against the
+stand-ins of benchmarks/fakes.py: EKS answered in process by a botocore
+handler, the Kubernetes API by a local HTTP server. Reports per mode the
+wall time, node group results, API calls by operation as seen by the
+fakes (and the throttles they injected), the sharedlib.ratelimit counters
+and the peak memory.
+
+python benchmarks/e2e.py [--nodegroups 50] [--pods-per-node 10] \
+    [--latency-ms 20] [--throttle-rate 0.05] [--drain-wave-size 1] \
+    [--verify-report /tmp/verify.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as migrator  # noqa: E402
+from sharedlib import drain, infra, poller, ratelimit  # noqa: E402
+from sharedlib.concurrency import DEFAULT_CONCURRENCY  # noqa: E402
+from sharedlib.journal import open_journal  # noqa: E402
+from fakes import FakeCluster, FakeEKS, FakeKubeServer  # noqa: E402
+
+CONTEXT = "bench"
+REGION = "us-east-2"
+
+
+def _diff(after, before):
+    return {key: value - before.get(key, 0) for key, value in sorted(after.items())
+            if value - before.get(key, 0)}
+
+
+def aws_clients(fake, concurrency):
+    import boto3
+    session = boto3.Session(aws_access_key_id="bench", aws_secret_access_key="bench",
+                            region_name=REGION)
+    config = ratelimit.aws_client_config(concurrency + 4)
+    eks = session.client('eks', config=config)
+    ec2 = session.client('ec2', config=config)
+    handler = FakeEKS(fake)
+    handler.register(eks)
+    handler.register(ec2)
+    return eks, ec2
+
+
+def kube_client(url, concurrency):
+    from kubernetes.client import Configuration
+    configuration = Configuration(host=url)
+    configuration.connection_pool_maxsize = concurrency + 4
+    infra.add_kube_client(CONTEXT, ratelimit.kube_api_client(CONTEXT, configuration))
+
+
+def run_mode(name, fake, func):
+    calls, throttled = dict(fake.calls), dict(fake.throttled)
+    api = {bucket: counters["calls"] for bucket, counters in ratelimit.stats().items()}
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    results = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    return {
+        "mode": name,
+        "seconds": round(elapsed, 2),
+        "nodegroups": statuses,
+        "failures": {result.name: str(result.error) for result in results if not result.ok},
+        "api_calls": _diff(fake.calls, calls),
+        "api_calls_total": sum(_diff(fake.calls, calls).values()),
+        "throttled": _diff(fake.throttled, throttled),
+        "client_calls": _diff({bucket: counters["calls"] for bucket, counters
+                               in ratelimit.stats().items()}, api),
+        # includes the fakes' own state changes, ie. rescheduled pods
+        "peak_memory_mib": round((peak - baseline) / 1024 / 1024, 2),
+    }
+
+
+def run(args):
+    # the fakes are fast, poll them accordingly
+    drain.POLL_INTERVAL = 0.2
+    fake = FakeCluster(CONTEXT, args.nodegroups, args.nodes_per_nodegroup,
+                       args.pods_per_node, args.update_seconds,
+                       args.latency_ms / 1000.0, args.throttle_rate, args.seed)
+    eks, ec2 = aws_clients(fake, args.concurrency)
+    poller._pollers[id(eks)] = poller.NodegroupUpdatePoller(
+        eks, min_interval=0.2, max_interval=1.0)
+    drain_options = {"wave_size": args.drain_wave_size, "concurrency": 10,
+                     "wave_timeout": 120}
+    journal = open_journal(CONTEXT, args.journal)
+    tracemalloc.start()
+    report = {"config": vars(args), "modes": []}
+    # the generated manifests go to stdout, keep it for the report
+    with FakeKubeServer(fake) as server, infra.kube_context(CONTEXT), \
+            contextlib.redirect_stdout(sys.stderr):
+        kube_client(server.url, args.concurrency)
+        if args.mode in ("both", "karpenter"):
+            def migrate():
+                return migrator.karpenter_mode(CONTEXT, eks, ec2, args.concurrency,
+                                               drain_options=drain_options, journal=journal)
+            if args.verify_report:
+                report["modes"].append(run_mode("karpenter", fake, lambda: migrator.verified(
+                    CONTEXT, migrate, args.verify_report)))
+            else:
+                report["modes"].append(run_mode("karpenter", fake, migrate))
+        if args.mode in ("both", "nodegroup"):
+            report["modes"].append(run_mode("nodegroup", fake, lambda: migrator.nodegroup_mode(
+                CONTEXT, eks, journal=journal, deadline=args.rollback_deadline)))
+    tracemalloc.stop()
+    report["max_rss_mib"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+def print_report(report, file=sys.stdout):
+    for mode in report["modes"]:
+        print("%-10s %8.2fs  %s  api=%d throttled=%d peak=%.1fMiB" % (
+            mode["mode"], mode["seconds"],
+            ", ".join("%s=%d" % item for item in sorted(mode["nodegroups"].items())),
+            mode["api_calls_total"], sum(mode["throttled"].values()),
+            mode["peak_memory_mib"]), file=file)
+        for operation, count in sorted(mode["api_calls"].items(), key=lambda item: -item[1]):
+            print("    %-32s %6d" % (operation, count), file=file)
+        for name, error in sorted(mode["failures"].items()):
+            print("    failed %s: %s" % (name, error), file=file)
+    print("max rss %.1fMiB" % report["max_rss_mib"], file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodegroups", type=int, default=50)
+    parser.add_argument("--nodes-per-nodegroup", type=int, default=2)
+    parser.add_argument("--pods-per-node", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=20,
+                        help="added to every EKS and Kubernetes request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of requests answered with a throttle")
+    parser.add_argument("--update-seconds", type=float, default=2.0,
+                        help="time a node group update takes to complete")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--drain-wave-size", type=int, default=0)
+    parser.add_argument("--rollback-deadline", type=int, default=300)
+    parser.add_argument("--mode", choices=("both", "karpenter", "nodegroup"), default="both")
+    parser.add_argument("--journal", metavar="SPEC", help="ie. file:/tmp/bench-journal")
+    parser.add_argument("--verify-report", metavar="FILE",
+                        help="snapshot the fake cluster around the migration and write "
+                             "the verification report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv[1:])
+    report = run(args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,549 @@
+"""
+Local EKS and Kubernetes stand-ins for the benchmarks
+
+FakeCluster holds the state of one synthetic cluster: managed node groups,
+their nodes and pods, Karpenter nodes, NodePools and EC2NodeClasses and
+the cluster-autoscaler replicas. It is served two ways:
+
+- FakeEKS answers EKS requests from a botocore `before-send` handler, so
+  requests are still built, signed and parsed by botocore, without a
+  network round trip
+- FakeKubeServer is a threaded HTTP server on 127.0.0.1 speaking enough
+  of the Kubernetes API (lists, label and field selectors, node watches,
+  server-side apply, merge patches, evictions, deployment scale) for
+  sharedlib
+
+A node group update completes `update_seconds` after it is issued: a
+node group scaled down loses its nodes, and their pods move to a
+Karpenter node, a node group scaled up gets new Ready nodes. Every request
+can be delayed (latency) and throttled (throttle_rate), and is counted
+per operation.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+NODEGROUP_NODE_LABEL = "eks.amazonaws.com/nodegroup"
+KARPENTER_NODE_LABEL = "karpenter.sh/nodepool"
+INSTANCE_TYPES = ["m5.large", "m5.xlarge", "c5.2xlarge", "r5.large", "m6g.large"]
+PLURALS = {"nodepools": "NodePool", "ec2nodeclasses": "EC2NodeClass"}
+
+
+class FakeCluster:
+
+    def __init__(self, name="bench", nodegroups=10, nodes_per_nodegroup=2,
+                 pods_per_node=10, update_seconds=2.0, latency=0.0, throttle_rate=0.0,
+                 seed=0):
+        self.name = name
+        self.update_seconds = update_seconds
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.resource_version = 1
+        self.nodegroups = {}
+        self.updates = {}
+        self.nodes = {}
+        self.pods = {}
+        self.objects = {plural: {} for plural in PLURALS}
+        self.deployments = {("kube-system", "aws-cluster-autoscaler"): 1}
+        self.node_events = []
+        self.calls = {}
+        self.throttled = {}
+        with self.lock:
+            for i in range(nodegroups):
+                self._add_nodegroup("team-%04d" % i, i, nodes_per_nodegroup, pods_per_node)
+
+    # state, called with the lock held
+
+    def _next_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def _add_nodegroup(self, name, i, node_count, pods_per_node):
+        self.nodegroups[name] = {
+            "nodegroupName": name,
+            "nodegroupArn": "arn:aws:eks:us-east-2:111122223333:nodegroup/%s/%s/%s" %
+                            (self.name, name, uuid.UUID(int=i)),
+            "clusterName": self.name,
+            "version": "1.29",
+            "status": "ACTIVE",
+            "capacityType": "SPOT" if i % 3 else "ON_DEMAND",
+            "scalingConfig": {"minSize": 0, "maxSize": max(10, node_count),
+                              "desiredSize": node_count},
+            "instanceTypes": INSTANCE_TYPES[i % len(INSTANCE_TYPES):][:2],
+            "subnets": ["subnet-%04d" % (i % 3), "subnet-%04d" % (i % 3 + 3)],
+            "amiType": "AL2_ARM_64" if INSTANCE_TYPES[i % len(INSTANCE_TYPES)] == "m6g.large"
+                       else "AL2_x86_64",
+            "nodeRole": "arn:aws:iam::111122223333:role/nodes",
+            "labels": {"team": name},
+            "taints": [],
+            "tags": {"team": name},
+            "createdAt": 1700000000,
+        }
+        for n in range(node_count):
+            node_name = self._add_node(name, NODEGROUP_NODE_LABEL)
+            for p in range(pods_per_node):
+                self._add_pod(name, node_name)
+
+    def _add_node(self, nodegroup_name, label):
+        index = sum(1 for node in self.nodes.values()
+                    if node["metadata"]["labels"].get(label) == nodegroup_name)
+        prefix = "karpenter-" if label == KARPENTER_NODE_LABEL else ""
+        name = "%s%s-node-%d" % (prefix, nodegroup_name, index)
+        while name in self.nodes:
+            index += 1
+            name = "%s%s-node-%d" % (prefix, nodegroup_name, index)
+        nodegroup = self.nodegroups[nodegroup_name]
+        labels = {label: nodegroup_name,
+                  "node.kubernetes.io/instance-type": nodegroup["instanceTypes"][0]}
+        if label == KARPENTER_NODE_LABEL:
+            # the NodePool template labels
+            labels["migrate.karpenter.io/nodegroup"] = nodegroup_name
+            labels["karpenter.sh/capacity-type"] = nodegroup["capacityType"].lower().replace(
+                "_", "-")
+        else:
+            labels["eks.amazonaws.com/capacityType"] = nodegroup["capacityType"]
+        self.nodes[name] = {
+            "apiVersion": "v1", "kind": "Node",
+            "metadata": {"name": name, "uid": str(uuid.uuid4()),
+                         "labels": labels,
+                         "resourceVersion": self._next_version()},
+            "spec": {},
+            "status": {"conditions": [{"type": "Ready", "status": "True"}],
+                       "allocatable": {"cpu": "1930m", "memory": "7Gi", "pods": "29"}},
+        }
+        self._node_event("ADDED", self.nodes[name])
+        return name
+
+    def _delete_node(self, name):
+        node = self.nodes.pop(name)
+        node["metadata"]["resourceVersion"] = self._next_version()
+        self._node_event("DELETED", node)
+
+    def _node_event(self, kind, node):
+        self.node_events.append((int(node["metadata"]["resourceVersion"]), kind,
+                                 json.loads(json.dumps(node))))
+        self.changed.notify_all()
+
+    def _add_pod(self, nodegroup_name, node_name):
+        name = "%s-%s" % (nodegroup_name, uuid.uuid4().hex[:10])
+        now = time.time()
+        # scheduled up to 3 seconds after it is created
+        scheduled = now + self.random.randint(0, 3)
+        self.pods[(nodegroup_name, name)] = {
+            "apiVersion": "v1", "kind": "Pod",
+            "metadata": {
+                "name": name, "namespace": nodegroup_name, "uid": str(uuid.uuid4()),
+                "labels": {"app": nodegroup_name},
+                "creationTimestamp": _rfc3339(now),
+                "ownerReferences": [{"apiVersion": "apps/v1", "kind": "ReplicaSet",
+                                     "name": nodegroup_name + "-app",
+                                     "uid": "rs-" + nodegroup_name, "controller": True}],
+            },
+            "spec": {"nodeName": node_name, "containers": [{
+                "name": "app", "image": "app",
+                "resources": {"requests": {"cpu": "100m", "memory": "128Mi"}}}]},
+            "status": {"phase": "Running", "conditions": [
+                {"type": "PodScheduled", "status": "True",
+                 "lastTransitionTime": _rfc3339(scheduled)}]},
+        }
+
+    def _karpenter_node(self, nodegroup_name):
+        for name, node in self.nodes.items():
+            if node["metadata"]["labels"].get(KARPENTER_NODE_LABEL) == nodegroup_name:
+                return name
+        return self._add_node(nodegroup_name, KARPENTER_NODE_LABEL)
+
+    def _reschedule(self, key):
+        # the ReplicaSet replaces the pod on a Karpenter node
+        pod = self.pods.pop(key)
+        nodegroup_name = pod["metadata"]["namespace"]
+        self._add_pod(nodegroup_name, self._karpenter_node(nodegroup_name))
+
+    def _nodegroup_nodes(self, nodegroup_name):
+        return sorted(name for name, node in self.nodes.items()
+                      if node["metadata"]["labels"].get(NODEGROUP_NODE_LABEL) == nodegroup_name)
+
+    def settle(self):
+        """
+        Complete the node group updates that are due
+        """
+        now = time.monotonic()
+        with self.lock:
+            for update in self.updates.values():
+                if update["status"] != "InProgress" or update["doneAt"] > now:
+                    continue
+                update["status"] = "Successful"
+                nodegroup = self.nodegroups[update["nodegroup"]]
+                nodegroup["status"] = "ACTIVE"
+                desired = nodegroup["scalingConfig"]["desiredSize"]
+                nodes = self._nodegroup_nodes(update["nodegroup"])
+                for name in nodes[desired:]:
+                    for key, pod in list(self.pods.items()):
+                        if pod["spec"]["nodeName"] == name:
+                            self._reschedule(key)
+                    self._delete_node(name)
+                for _ in range(desired - len(nodes)):
+                    self._add_node(update["nodegroup"], NODEGROUP_NODE_LABEL)
+
+    # request accounting
+
+    def request(self, operation, throttle=True):
+        """
+        Count a request, apply the injected latency and return True when
+        it is throttled
+        """
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = throttle and self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled[operation] = self.throttled.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        self.settle()
+        return throttled
+
+
+class _Raw:
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class FakeEKS:
+    """
+    botocore before-send handler serving the EKS operations of sharedlib.
+    Registered on other clients too (ie. EC2), it fails their operations
+    so the benchmark never reaches AWS.
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def register(self, client):
+        client.meta.events.register("before-send", self)
+
+    def __call__(self, request, event_name, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        operation = event_name.rsplit(".", 1)[-1]
+        url = urlparse(request.url)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = json.loads(request.body) if request.body else {}
+        if self.cluster.request(operation):
+            status, headers, payload = 429, {"x-amzn-ErrorType": "ThrottlingException"}, \
+                {"message": "Rate exceeded"}
+        else:
+            handler = getattr(self, "_" + operation, None)
+            if handler is None:
+                status, headers, payload = 400, {"x-amzn-ErrorType": "InvalidRequestException"}, \
+                    {"message": "%s is not supported by the fake" % operation}
+            else:
+                parts = [unquote(part) for part in url.path.strip("/").split("/")]
+                status, payload = handler(parts, query, body)
+                headers = {}
+                if status >= 400:
+                    headers["x-amzn-ErrorType"] = payload.pop("code")
+        headers["Content-Type"] = "application/json"
+        return AWSResponse(request.url, status, headers, _Raw(json.dumps(payload).encode()))
+
+    def _not_found(self, what):
+        return 404, {"code": "ResourceNotFoundException", "message": what + " not found"}
+
+    def _ListNodegroups(self, parts, query, body):
+        names = sorted(self.cluster.nodegroups)
+        start = int(query.get("nextToken", 0))
+        size = int(query.get("maxResults", 100))
+        page = {"nodegroups": names[start:start + size]}
+        if start + size < len(names):
+            page["nextToken"] = str(start + size)
+        return 200, page
+
+    def _DescribeNodegroup(self, parts, query, body):
+        with self.cluster.lock:
+            nodegroup = self.cluster.nodegroups.get(parts[3])
+            if nodegroup is None:
+                return self._not_found("nodegroup " + parts[3])
+            return 200, {"nodegroup": json.loads(json.dumps(nodegroup))}
+
+    def _DescribeCluster(self, parts, query, body):
+        return 200, {"cluster": {
+            "name": self.cluster.name, "status": "ACTIVE", "version": "1.29",
+            "endpoint": "https://127.0.0.1",
+            "certificateAuthority": {"data": ""},
+            "resourcesVpcConfig": {"clusterSecurityGroupId": "sg-cluster",
+                                   "subnetIds": ["subnet-0000"]},
+        }}
+
+    def _UpdateNodegroupConfig(self, parts, query, body):
+        with self.cluster.lock:
+            nodegroup = self.cluster.nodegroups.get(parts[3])
+            if nodegroup is None:
+                return self._not_found("nodegroup " + parts[3])
+            if nodegroup["status"] == "UPDATING":
+                return 409, {"code": "ResourceInUseException",
+                             "message": "nodegroup %s is updating" % parts[3]}
+            nodegroup["scalingConfig"].update(body.get("scalingConfig", {}))
+            nodegroup["status"] = "UPDATING"
+            update_id = str(uuid.uuid4())
+            self.cluster.updates[update_id] = {
+                "nodegroup": parts[3], "status": "InProgress",
+                "doneAt": time.monotonic() + self.cluster.update_seconds}
+        return 200, {"update": {"id": update_id, "status": "InProgress",
+                                "type": "ConfigUpdate", "createdAt": time.time()}}
+
+    def _DescribeUpdate(self, parts, query, body):
+        update = self.cluster.updates.get(parts[3])
+        if update is None:
+            return self._not_found("update " + parts[3])
+        return 200, {"update": {"id": parts[3], "status": update["status"],
+                                "type": "ConfigUpdate", "errors": []}}
+
+
+def _match_labels(selector, labels):
+    for term in filter(None, (selector or "").split(",")):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key.rstrip("=")) != value:
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+class _KubeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cluster = None
+
+    ROUTES = [
+        ("GET", r"/api/v1/nodes", "list_nodes"),
+        ("PATCH", r"/api/v1/nodes/(?P<name>[^/]+)", "patch_node"),
+        ("GET", r"/api/v1/pods", "list_pods"),
+        ("GET", r"/api/v1/namespaces/(?P<namespace>[^/]+)/pods", "list_pods"),
+        ("POST", r"/api/v1/namespaces/(?P<namespace>[^/]+)/pods/(?P<name>[^/]+)/eviction",
+         "evict_pod"),
+        ("PATCH", r"/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments/"
+                  r"(?P<name>[^/]+)/scale", "scale_deployment"),
+        ("GET", r"/apis/[^/]+/[^/]+/(?P<plural>nodepools|ec2nodeclasses)", "list_objects"),
+        ("GET", r"/apis/[^/]+/[^/]+/(?P<plural>nodepools|ec2nodeclasses)/(?P<name>[^/]+)",
+         "get_object"),
+        ("PATCH", r"/apis/[^/]+/[^/]+/(?P<plural>nodepools|ec2nodeclasses)/(?P<name>[^/]+)",
+         "apply_object"),
+        ("DELETE", r"/apis/[^/]+/[^/]+/(?P<plural>nodepools|ec2nodeclasses)/(?P<name>[^/]+)",
+         "delete_object"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_method != method or match is None:
+                continue
+            watch = query.get("watch") in ("true", "1")
+            operation = "%s %s" % ("watch" if watch else name, match.groupdict().get("plural", ""))
+            # a 429 on an eviction means a PodDisruptionBudget, not a throttle
+            if self.cluster.request(operation.strip(), throttle=not watch and name != "evict_pod"):
+                return self._send(429, _status(429, "TooManyRequests", "throttled"),
+                                  {"Retry-After": "1"})
+            if watch:
+                return self._watch_nodes(query)
+            status, payload = getattr(self, "_" + name)(query, body, **match.groupdict())
+            return self._send(status, payload)
+        self._send(404, _status(404, "NotFound", "%s %s" % (method, url.path)))
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _list(self, kind, items):
+        return 200, {"apiVersion": "v1", "kind": kind, "items": items,
+                     "metadata": {"resourceVersion": str(self.cluster.resource_version)}}
+
+    def _list_nodes(self, query, body):
+        with self.cluster.lock:
+            return self._list("NodeList", [
+                node for node in self.cluster.nodes.values()
+                if _match_labels(query.get("labelSelector"), node["metadata"]["labels"])])
+
+    def _patch_node(self, query, body, name):
+        with self.cluster.lock:
+            node = self.cluster.nodes.get(name)
+            if node is None:
+                return 404, _status(404, "NotFound", "node " + name)
+            node["spec"].update(body.get("spec", {}))
+            node["metadata"]["resourceVersion"] = self.cluster._next_version()
+            self.cluster._node_event("MODIFIED", node)
+            return 200, node
+
+    def _list_pods(self, query, body, namespace=None):
+        node_name = None
+        field_selector = query.get("fieldSelector") or ""
+        if field_selector.startswith("spec.nodeName="):
+            node_name = field_selector.split("=", 1)[1]
+        with self.cluster.lock:
+            return self._list("PodList", [
+                pod for (pod_namespace, _), pod in self.cluster.pods.items()
+                if namespace in (None, pod_namespace) and
+                node_name in (None, pod["spec"]["nodeName"]) and
+                _match_labels(query.get("labelSelector"), pod["metadata"]["labels"])])
+
+    def _evict_pod(self, query, body, namespace, name):
+        with self.cluster.lock:
+            if (namespace, name) not in self.cluster.pods:
+                return 404, _status(404, "NotFound", "pod " + name)
+            self.cluster._reschedule((namespace, name))
+        return 201, _status(201, "", "evicted", "Success")
+
+    def _scale_deployment(self, query, body, namespace, name):
+        replicas = body["spec"]["replicas"]
+        with self.cluster.lock:
+            self.cluster.deployments[(namespace, name)] = replicas
+        return 200, {"apiVersion": "autoscaling/v1", "kind": "Scale",
+                     "metadata": {"name": name, "namespace": namespace},
+                     "spec": {"replicas": replicas}, "status": {"replicas": replicas}}
+
+    def _list_objects(self, query, body, plural):
+        with self.cluster.lock:
+            items = [self.cluster.objects[plural][name]
+                     for name in sorted(self.cluster.objects[plural])]
+        start = int(query.get("continue") or 0)
+        limit = int(query.get("limit") or len(items) or 1)
+        status, payload = self._list(PLURALS[plural] + "List", items[start:start + limit])
+        if start + limit < len(items):
+            payload["metadata"]["continue"] = str(start + limit)
+        return status, payload
+
+    def _get_object(self, query, body, plural, name):
+        with self.cluster.lock:
+            obj = self.cluster.objects[plural].get(name)
+        if obj is None:
+            return 404, _status(404, "NotFound", name)
+        return 200, obj
+
+    def _apply_object(self, query, body, plural, name):
+        with self.cluster.lock:
+            if self.headers.get("Content-Type") == "application/merge-patch+json":
+                obj = self.cluster.objects[plural].get(name)
+                if obj is None:
+                    return 404, _status(404, "NotFound", name)
+                body = _merge(obj, body)
+            body["metadata"]["resourceVersion"] = self.cluster._next_version()
+            body["metadata"].setdefault("uid", str(uuid.uuid4()))
+            self.cluster.objects[plural][name] = body
+        return 200, body
+
+    def _delete_object(self, query, body, plural, name):
+        with self.cluster.lock:
+            obj = self.cluster.objects[plural].pop(name, None)
+        if obj is None:
+            return 404, _status(404, "NotFound", name)
+        return 200, _status(200, "", "deleted", "Success")
+
+    def _watch_nodes(self, query):
+        since = int(query.get("resourceVersion") or 0)
+        deadline = time.monotonic() + int(query.get("timeoutSeconds") or 60)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while time.monotonic() < deadline:
+                with self.cluster.lock:
+                    events = [(version, kind, node) for version, kind, node in
+                              self.cluster.node_events if version > since]
+                    if not events:
+                        self.cluster.changed.wait(0.1)
+                if not events:
+                    # updates complete on request, or here while only watching
+                    self.cluster.settle()
+                    continue
+                for version, kind, node in events:
+                    since = version
+                    if _match_labels(query.get("labelSelector"), node["metadata"]["labels"]):
+                        line = json.dumps({"type": kind, "object": node}).encode() + b"\n"
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped the watch
+            self.close_connection = True
+
+
+def _rfc3339(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def _merge(target, patch):
+    # RFC 7386 JSON merge patch
+    if not isinstance(patch, dict):
+        return patch
+    target = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = _merge(target.get(key), value)
+    return target
+
+
+def _status(code, reason, message, status="Failure"):
+    return {"apiVersion": "v1", "kind": "Status", "status": status, "code": code,
+            "reason": reason, "message": message}
+
+
+class FakeKubeServer:
+
+    def __init__(self, cluster):
+        handler = type("KubeHandler", (_KubeHandler,), {"cluster": cluster})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,133 @@
+"""
+Reconcile cost per cycle as the fleet grows
+
+Seeds the fakes of benchmarks/fakes.py with migrated node groups (NodePool
+and EC2NodeClass applied, node group scaled down), then runs
+sharedlib.reconcile cycles in three phases of one sweep each:
+
+- first: NodePools without a fingerprint yet, each gets it stamped
+- steady: nothing changed, one describe per node group and no writes
+- edits: `--edits` node groups get a new label and maxSize, only they are
+  patched, and their rollback annotations carry the new maxSize
+
+and reports the API calls per cycle per phase, which should not depend on
+the number of node groups.
+
+python benchmarks/reconcile.py [--nodegroups 50,500] [--budget 20] [--edits 5]
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharedlib import infra  # noqa: E402
+from sharedlib.apply import stamp  # noqa: E402
+from sharedlib.index import PAGE_SIZE, ResourceIndex  # noqa: E402
+from sharedlib.reconcile import SCALED_DOWN, Reconciler  # noqa: E402
+from sharedlib.render import render_nodegroup  # noqa: E402
+from e2e import CONTEXT, aws_clients, kube_client  # noqa: E402
+from fakes import FakeCluster, FakeKubeServer  # noqa: E402
+
+EDIT_MAX_SIZE = 20
+
+
+def seed_migrated(fake):
+    with fake.lock:
+        for name, nodegroup in fake.nodegroups.items():
+            node_class, node_pool = render_nodegroup(nodegroup, ["sg-cluster"])
+            fake.objects["ec2nodeclasses"][name] = stamp(node_class)
+            fake.objects["nodepools"][name] = stamp(node_pool)
+            nodegroup["scalingConfig"] = dict(SCALED_DOWN)
+
+
+def edit_nodegroups(fake, count):
+    names = sorted(fake.nodegroups)[::max(1, len(fake.nodegroups) // max(1, count))][:count]
+    with fake.lock:
+        for name in names:
+            nodegroup = fake.nodegroups[name]
+            nodegroup["labels"] = dict(nodegroup["labels"], tier="edited")
+            nodegroup["scalingConfig"]["maxSize"] = EDIT_MAX_SIZE
+    return names
+
+
+def run_phase(name, fake, reconciler, cycles):
+    per_cycle = []
+    statuses = {}
+    start = time.perf_counter()
+    for _ in range(cycles):
+        calls = dict(fake.calls)
+        for result in reconciler.cycle():
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+        per_cycle.append(sum(fake.calls.values()) - sum(calls.values()))
+    return {
+        "phase": name,
+        "cycles": cycles,
+        "seconds_per_cycle": round((time.perf_counter() - start) / max(1, cycles), 3),
+        "calls_per_cycle_mean": round(sum(per_cycle) / max(1, cycles), 1),
+        "calls_per_cycle_max": max(per_cycle, default=0),
+        "nodegroups": statuses,
+    }
+
+
+def run_size(nodegroups, args):
+    fake = FakeCluster(CONTEXT, nodegroups, 0, 0, latency=args.latency_ms / 1000.0,
+                       seed=args.seed)
+    seed_migrated(fake)
+    eks, ec2 = aws_clients(fake, args.workers)
+    sweep = math.ceil(nodegroups / args.budget)
+    report = {"nodegroups": nodegroups, "sweep_cycles": sweep, "phases": []}
+    with FakeKubeServer(fake) as server, infra.kube_context(CONTEXT):
+        kube_client(server.url, args.workers)
+        resources = ResourceIndex(PAGE_SIZE).load()
+        reconciler = Reconciler(CONTEXT, eks, ec2, resources, args.budget, args.workers)
+        report["phases"].append(run_phase("first", fake, reconciler, sweep))
+        report["phases"].append(run_phase("steady", fake, reconciler, sweep))
+        edited = edit_nodegroups(fake, args.edits)
+        report["phases"].append(run_phase("edits", fake, reconciler, sweep))
+    pools = fake.objects["nodepools"]
+    report["edited_annotations_ok"] = all(
+        pools[name]["metadata"]["annotations"]["migrate.karpenter.io/max"] ==
+        str(EDIT_MAX_SIZE) and
+        pools[name]["spec"]["template"]["metadata"]["labels"].get("tier") == "edited"
+        for name in edited)
+    return report
+
+
+def print_report(reports, file=sys.stdout):
+    for report in reports:
+        print("%d node groups, sweep of %d cycles, edits propagated: %s" % (
+            report["nodegroups"], report["sweep_cycles"], report["edited_annotations_ok"]),
+            file=file)
+        for phase in report["phases"]:
+            print("    %-8s calls/cycle mean=%-7.1f max=%-5d %6.3fs/cycle  %s" % (
+                phase["phase"], phase["calls_per_cycle_mean"], phase["calls_per_cycle_max"],
+                phase["seconds_per_cycle"],
+                ", ".join("%s=%d" % item for item in sorted(phase["nodegroups"].items()))),
+                file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodegroups", default="50,500",
+                        help="comma separated fleet sizes")
+    parser.add_argument("--budget", type=int, default=20)
+    parser.add_argument("--edits", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv[1:])
+    reports = [run_size(int(size), args) for size in args.nodegroups.split(",")]
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(reports)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
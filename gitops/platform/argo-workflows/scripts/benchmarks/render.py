@@ -0,0 +1,77 @@
+"""
+Throughput and memory of the offline manifest renderer
+
+Renders synthetic node groups to multi document YAML (or JSON) and
+reports node groups per second and peak traced memory.
+
+python benchmarks/render.py [--nodegroups 5000] [--output yaml|json]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharedlib import render  # noqa: E402
+
+AMI_TYPES = ["AL2_x86_64", "AL2_ARM_64", "BOTTLEROCKET_x86_64", "AL2_x86_64_GPU"]
+INSTANCE_TYPES = ["m5.large", "m5.xlarge", "c5.2xlarge", "r5.large", "m6g.large"]
+
+
+def synthetic_nodegroups(count):
+    for i in range(count):
+        yield {
+            "nodegroupName": "team-%05d" % i,
+            "clusterName": "argocon-1",
+            "subnets": ["subnet-%04d" % (i % 3), "subnet-%04d" % (i % 3 + 3)],
+            "tags": {"team": "team-%d" % (i % 50), "env": "bench"},
+            "amiType": AMI_TYPES[i % len(AMI_TYPES)],
+            "nodeRole": "arn:aws:iam::111122223333:role/nodes-%d" % (i % 5),
+            "capacityType": "SPOT" if i % 3 else "ON_DEMAND",
+            "instanceTypes": INSTANCE_TYPES[:1 + i % len(INSTANCE_TYPES)],
+            "labels": {"team": "team-%d" % (i % 50)},
+            "taints": [{"key": "team", "value": "team-%d" % (i % 50),
+                        "effect": "NO_SCHEDULE"}] if i % 2 else [],
+            "scalingConfig": {"minSize": 1, "maxSize": 10, "desiredSize": 2},
+            "securityGroups": ["sg-%04d" % (i % 7)],
+        }
+
+
+def run(count, output_format):
+    out = io.StringIO()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rendered = render.render(synthetic_nodegroups(count))
+    if output_format == "json":
+        render.write_json_stream(rendered, out)
+    else:
+        render.write_yaml_stream(rendered, out)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "nodegroups": count,
+        "output": output_format,
+        "c_emitter": render.Dumper.__name__.startswith("C"),
+        "seconds": round(elapsed, 3),
+        "nodegroups_per_second": round(count / elapsed, 1),
+        "output_bytes": out.tell(),
+        "peak_memory_mib": round(peak / 1024 / 1024, 2),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodegroups", type=int, default=5000)
+    parser.add_argument("--output", choices=("yaml", "json"), default="yaml")
+    args = parser.parse_args(argv[1:])
+    json.dump(run(args.nodegroups, args.output), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
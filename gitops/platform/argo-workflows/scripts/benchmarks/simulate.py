@@ -0,0 +1,84 @@
+"""
+Throughput of the offline bin-packing pre-flight simulator
+
+Simulates synthetic pods (replicas of a few deployment sizes, some with
+node selectors, some not tolerating the NodePool taint) on a rendered
+NodePool and reports pods per second and the projected nodes.
+
+python benchmarks/simulate.py [--pods 50000] [--deployments 500]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharedlib import render, simulate  # noqa: E402
+
+NODEGROUP = {
+    "nodegroupName": "team-a",
+    "clusterName": "argocon-1",
+    "subnets": ["subnet-0001"],
+    "amiType": "AL2_x86_64",
+    "nodeRole": "arn:aws:iam::111122223333:role/nodes",
+    "capacityType": "ON_DEMAND",
+    "instanceTypes": ["m5.large", "m5.xlarge", "m5.2xlarge", "c5.2xlarge", "r5.2xlarge"],
+    "labels": {"team": "team-a"},
+    "taints": [{"key": "team", "value": "team-a", "effect": "NO_SCHEDULE"}],
+    "scalingConfig": {"minSize": 1, "maxSize": 10, "desiredSize": 2},
+}
+CPU = ["50m", "100m", "250m", "500m", "1", "2"]
+MEMORY = ["64Mi", "256Mi", "512Mi", "1Gi", "2Gi", "4Gi"]
+TOLERATION = {"key": "team", "operator": "Equal", "value": "team-a", "effect": "NoSchedule"}
+
+
+def synthetic_pods(count, deployments, seed=0):
+    rng = random.Random(seed)
+    sizes = [(rng.choice(CPU), rng.choice(MEMORY), rng.random()) for _ in range(deployments)]
+    for i in range(count):
+        cpu, memory, kind = sizes[i % deployments]
+        spec = {
+            "nodeName": "node-%d" % (i % 200),
+            "tolerations": [TOLERATION] if kind > 0.01 else [],
+            "containers": [{"resources": {"requests": {"cpu": cpu, "memory": memory}}}],
+        }
+        if kind > 0.9:
+            spec["nodeSelector"] = {"kubernetes.io/arch": "amd64"}
+        yield {
+            "metadata": {"namespace": "bench", "name": "pod-%06d" % i,
+                         "ownerReferences": [{"kind": "ReplicaSet"}]},
+            "spec": spec,
+        }
+
+
+def run(count, deployments):
+    nodepool = render.render_node_pool(NODEGROUP)
+    pods = list(synthetic_pods(count, deployments))
+    start = time.perf_counter()
+    report = simulate.simulate(nodepool, pods)
+    elapsed = time.perf_counter() - start
+    return {
+        "pods": count,
+        "deployments": deployments,
+        "seconds": round(elapsed, 3),
+        "pods_per_second": round(count / elapsed, 1),
+        "nodes": report["nodes"],
+        "unschedulable": len(report["unschedulable"]),
+        "hourly_cost": report["hourlyCost"],
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pods", type=int, default=50000)
+    parser.add_argument("--deployments", type=int, default=500)
+    args = parser.parse_args(argv[1:])
+    json.dump(run(args.pods, args.deployments), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,76 @@
+"""
+Cold start latency of the workflow steps
+
+Runs every karpenter-migrate / karpenter-rollback step as
+`python -m sharedlib --startup-only <command>` in a fresh interpreter,
+which performs the imports and client initialization of the step
+without calling any API, and reports the latency per step.
+
+python benchmarks/startup.py [--runs 10] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLUSTER = ["--cluster", "argocon-1", "--region", "us-east-2"]
+NODEGROUP = ["--nodegroup", "team-a"]
+
+STEPS = {
+    "python": None,
+    "get-nodegroups": ["list"] + CLUSTER + ["--without-nodepool"],
+    "generate-karpenter": ["apply"] + CLUSTER + NODEGROUP,
+    "down-autoscaler": ["scale", "--deployment", "aws-cluster-autoscaler",
+                        "--replicas", "0"],
+    "scale-down-nodegroup": ["scale"] + CLUSTER + NODEGROUP +
+                            ["--min", "0", "--max", "1", "--desired", "0"],
+    "scale-up-nodegroup": ["scale"] + CLUSTER + NODEGROUP + ["--from-nodepool"],
+    "delete-karpenter": ["delete"] + NODEGROUP,
+    "rollback-nodegroup": ["rollback"] + CLUSTER + NODEGROUP,
+}
+
+
+def time_step(argv):
+    if argv is None:
+        command = [sys.executable, "-c", "pass"]
+    else:
+        command = [sys.executable, "-m", "sharedlib", "--startup-only"] + argv
+    start = time.perf_counter()
+    subprocess.run(command, cwd=SCRIPTS_DIR, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv[1:])
+
+    report = {}
+    for step, step_argv in STEPS.items():
+        # first run warms the filesystem cache and the .pyc files
+        time_step(step_argv)
+        samples = sorted(time_step(step_argv) for _ in range(args.runs))
+        report[step] = {
+            "min_ms": round(samples[0] * 1000, 1),
+            "median_ms": round(statistics.median(samples) * 1000, 1),
+            "p95_ms": round(samples[int(0.95 * (len(samples) - 1))] * 1000, 1),
+        }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        return
+    print("%-24s %10s %10s %10s" % ("step", "min ms", "median ms", "p95 ms"))
+    for step, stats in report.items():
+        print("%-24s %10.1f %10.1f %10.1f" %
+              (step, stats["min_ms"], stats["median_ms"], stats["p95_ms"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
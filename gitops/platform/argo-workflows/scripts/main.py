@@ -3,136 +3,430 @@
 Generate Karpenter from Node Groups
 
 """
+import argparse
+import contextlib
+import signal
 import sys
+import threading
 import boto3
-import yaml
-from sharedlib import infra
+from sharedlib import infra, metrics, ratelimit
+from sharedlib.apply import apply_objects
+from sharedlib.cache import get_cache
+from sharedlib.headroom import headroom
+from sharedlib.index import get_index
+from sharedlib.journal import (APPLIED, DISCOVERED, DRAINED, MIGRATE, ROLLBACK,
+                               SCALED_DOWN, VERIFIED, open_journal, verify_scaled_down)
+from sharedlib import verify
+from sharedlib.reconcile import DEFAULT_BUDGET, DEFAULT_INTERVAL, Reconciler
+from sharedlib.rollback import DEFAULT_DEADLINE, rollback
+from sharedlib.render import (INSTANCE_EXACT, INSTANCE_MODES, NODECLASS_MODES,
+                              NODECLASS_PER_NODEGROUP, NODECLASS_SHARED, dump_yaml,
+                              share_node_class)
+from sharedlib.drain import add_drain_arguments, drain_nodegroup, drain_options_from_args
+from sharedlib.workload import (DISRUPTION_DEFAULT, DISRUPTION_MODES, DISRUPTION_PROFILE,
+                               nodegroup_disruptions)
+from sharedlib.discovery import (add_selector_arguments, discover_nodegroup_names,
+                                 selector_from_args)
+from sharedlib.concurrency import (DEFAULT_CONCURRENCY, Result, limited, locked_print,
+                                   print_summary, run_concurrently)
+from sharedlib.fleet import (DEFAULT_MAX_CLUSTERS, DEFAULT_MAX_IN_FLIGHT, FleetError,
+                             aws_client_config, fleet_report, parse_fleet,
+                             print_fleet_report, run_fleet, write_report)
 
 
+def _done(journal, nodegroup_name, phase):
+    return journal is not None and journal.done(MIGRATE, nodegroup_name, phase)
 
-def karpenter_mode(cluster, eks, ec2):
+
+def _record(journal, nodegroup_name, phase):
+    if journal is not None:
+        journal.record(MIGRATE, nodegroup_name, phase)
+
+
+def migrate_nodegroup(nodegroup_name, cluster, eks, ec2, autoscaler, resources,
+                      nodeclass_mode=NODECLASS_PER_NODEGROUP, drain_options=None,
+                      headroom_options=None, check_capacity=False,
+                      instance_mode=INSTANCE_EXACT, journal=None, disruptions=None):
+    """
+    Migrate a single Node Group to Karpenter
+
+    Returns "skipped" when a corresponding NodePool already exists,
+    otherwise "migrated" once the node group has been scaled down.
+    With a journal, phases completed by a previous run are not repeated.
+    disruptions maps node group names to their sharedlib.workload report.
+    """
+    # print all the information about the node group
+    with metrics.span("describe"):
+        nodegroup = infra.get_node_group(eks, cluster, nodegroup_name)
+    if nodegroup is None:
+        raise RuntimeError("unable to describe nodegroup " + nodegroup_name)
+    if _done(journal, nodegroup_name, VERIFIED):
+        return "skipped"
+    resume = journal is not None and journal.in_progress(MIGRATE, nodegroup_name)
+    k8s_karpenter_node_pool = resources.get_for_nodegroup(nodegroup_name, "NodePool")
+    # skip if there is already a corresponding karpenter node pool,
+    # unless it comes from an unfinished migration
+    if k8s_karpenter_node_pool is not None and not resume:
+        return "skipped"
+    if k8s_karpenter_node_pool is not None and _done(journal, nodegroup_name, APPLIED):
+        locked_print("Resuming nodegroup %s after phase %s" %
+                     (nodegroup_name, journal.phase(MIGRATE, nodegroup_name)),
+                     file=sys.stderr)
+        karpenter_node_pool = k8s_karpenter_node_pool
+    else:
+        with metrics.span("generate"):
+            karpenter_node_class = infra.generate_karpenter_node_class(
+                eks, ec2, nodegroup)
+            karpenter_node_pool = infra.generate_karpenter_node_pool(
+                nodegroup, instance_mode, ec2,
+                (disruptions or {}).get(nodegroup_name, {}).get("disruption"))
+            if nodeclass_mode == NODECLASS_SHARED:
+                # point the NodePool at one EC2NodeClass per distinct spec
+                karpenter_node_class, karpenter_node_pool = share_node_class(
+                    karpenter_node_class, karpenter_node_pool)
+        # print karpenter_node_class and karpenter_node_pool in yaml
+        locked_print(dump_yaml([karpenter_node_class, karpenter_node_pool]))
+        # simulate the node group's pods on the NodePool before changing anything
+        if check_capacity:
+            from sharedlib.simulate import preflight
+            with metrics.span("preflight"):
+                preflight(nodegroup_name, karpenter_node_pool)
+        # create custom object with the node class, skipping unchanged objects
+        with metrics.span("apply"):
+            results = apply_objects([karpenter_node_class, karpenter_node_pool], resources)
+        if any(status == "failed" for status, _ in results):
+            raise RuntimeError("unable to apply karpenter resources for " + nodegroup_name)
+        _record(journal, nodegroup_name, APPLIED)
+
+    # scale cluster-autoscaler to zero before the first node group is scaled down
+    autoscaler.scale_down()
+    if not _done(journal, nodegroup_name, SCALED_DOWN):
+        drained = _done(journal, nodegroup_name, DRAINED)
+        # pre-provision karpenter capacity with pause pods, removed once scaled down
+        capacity = contextlib.nullcontext()
+        if headroom_options is not None and not drained:
+            capacity = headroom(nodegroup_name, karpenter_node_pool, **headroom_options)
+        with capacity:
+            # drain the nodes in waves so pods move to karpenter gradually
+            if drain_options and drain_options['wave_size'] > 0 and not drained:
+                with metrics.span("drain"):
+                    drain_nodegroup(nodegroup_name, **drain_options)
+                _record(journal, nodegroup_name, DRAINED)
+            # scale down to zero by updating scalingConfig, and set max to 1
+            locked_print("Scale down nodegroup "+nodegroup_name, file=sys.stderr)
+            with metrics.span("scale-down"):
+                infra.update_nodegroup(
+                    eks,
+                    clusterName=cluster,
+                    nodegroupName=nodegroup_name,
+                    scalingConfig={
+                        'desiredSize': 0,
+                        'minSize': 0,
+                        'maxSize': 1
+                    }
+                )
+        _record(journal, nodegroup_name, SCALED_DOWN)
+    if journal is not None:
+        with metrics.span("verify"):
+            verified = verify_scaled_down(eks, cluster, nodegroup_name)
+        if not verified:
+            raise RuntimeError("nodegroup %s is not scaled down" % nodegroup_name)
+        _record(journal, nodegroup_name, VERIFIED)
+    return "migrated"
+
+
+class _AutoscalerSwitch:
+    """
+    Scale the cluster-autoscaler to zero exactly once across worker threads,
+    and across resumed runs when the journal recorded it
+    """
+
+    def __init__(self, journal=None):
+        self._lock = threading.Lock()
+        self._journal = journal
+        self._done = journal is not None and journal.get_state("autoscaler-replicas") == "0"
+
+    def scale_down(self):
+        with self._lock:
+            if self._done:
+                return
+            with metrics.span("autoscaler-down"):
+                infra.scale_deployment(
+                    "aws-cluster-autoscaler", "kube-system", 0)
+            if self._journal is not None:
+                self._journal.set_state("autoscaler-replicas", 0)
+            self._done = True
+
+
+def karpenter_mode(cluster, eks, ec2, concurrency=DEFAULT_CONCURRENCY, selector=None,
+                   nodeclass_mode=NODECLASS_PER_NODEGROUP, drain_options=None,
+                   headroom_options=None, check_capacity=False,
+                   instance_mode=INSTANCE_EXACT, journal=None, slots=None,
+                   disruption_mode=DISRUPTION_DEFAULT):
     """
     Migrate from Node Groups to Karpenter
 
     Order of operation:
 
     1.) Get Node Groups of EKS Cluster
-    2.) Generate Karpenter NodeClass and NodePool for each Node Group
+    2.) Generate Karpenter NodeClass and NodePool for each Node Group, with
+        disruption settings from the workload profile of the node group,
+        optionally checking offline that the NodePool can schedule its pods
+    3.) Optionally pre-provision headroom and drain the Node Group nodes in waves
+    4.) Scale down each Node Group
+
+    Node groups are migrated concurrently, at most `concurrency` at a time,
+    so the total time is bound by the slowest node group instead of the sum.
+    With a journal (sharedlib.journal) a rerun resumes every node group
+    after its last completed phase. In fleet mode each node group also
+    holds one of the fleet wide slots while it is migrated.
     """
 
-    # Get the node groups
-    for nodegroup_name in infra.get_eks_cluster_nodegroups(eks, cluster):
-        # print all the information about the node group
-        nodegroup = infra.get_node_group(eks, cluster, nodegroup_name)
-        k8s_karpenter_node_pool = infra.get_custom_object(nodegroup_name, "NodePool")
-        # skip if there is already a corresponding karpenter node pool
-        if k8s_karpenter_node_pool is not None:
-            continue
-        karpenter_node_class = infra.generate_karpenter_node_class(
-            eks, ec2, nodegroup)
-        # print karpenter_node_class in yaml
-        print("---")
-        print(yaml.dump(karpenter_node_class, default_flow_style=False))
-        karpenter_node_pool = infra.generate_karpenter_node_pool(nodegroup)
-        print("---")
-        print(yaml.dump(karpenter_node_pool, default_flow_style=False))
-        # create custom object with the node class
-        infra.apply_or_create_custom_object(karpenter_node_class, "EC2NodeClass")
-        infra.apply_or_create_custom_object(karpenter_node_pool, "NodePool")
-
-        # scale cluster-autoscaler to zero
-        infra.scale_deployment(
-            "aws-cluster-autoscaler", "kube-system", 0)
-        # evict all pods by placing a NO_EXECUTE taint on the nodes
-        # scale down to zero by updating scalingConfig, and set max to 1
-        print("Scale down nodegroup "+nodegroup_name)
-        infra.update_nodegroup(
-            eks,
-            clusterName=cluster,
-            nodegroupName=nodegroup_name,
-            scalingConfig={
-                'desiredSize': 0,
-                'minSize': 0,
-                'maxSize': 1
-            }
-        )
+    with metrics.span("discover", cluster=cluster):
+        nodegroup_names = list(discover_nodegroup_names(
+            eks, cluster, selector, max_workers=concurrency))
+    if journal is not None:
+        for nodegroup_name in nodegroup_names:
+            if journal.phase(MIGRATE, nodegroup_name) is None:
+                journal.forget(ROLLBACK, nodegroup_name)
+                journal.record(MIGRATE, nodegroup_name, DISCOVERED)
+    # one LIST of the existing NodePools instead of a GET per node group
+    with metrics.labels(cluster=cluster):
+        with metrics.span("index"):
+            resources = get_index()
+        disruptions = None
+        if disruption_mode == DISRUPTION_PROFILE:
+            # one streamed pass over the nodes and pods of all node groups
+            with metrics.span("profile"):
+                disruptions = nodegroup_disruptions(nodegroup_names)
+        # one span per node group, with a span per phase inside
+        results = run_concurrently(
+            limited(metrics.traced("migrate-nodegroup", migrate_nodegroup), slots),
+            nodegroup_names, cluster, eks, ec2, _AutoscalerSwitch(journal),
+            resources, nodeclass_mode, drain_options, headroom_options, check_capacity,
+            instance_mode, journal, disruptions, max_workers=concurrency)
+    print_summary(results, title="Migration summary for cluster " + cluster)
+    get_cache().print_stats()
+    ratelimit.print_stats()
 
-    return None
+    return results
 
 
-def nodegroup_mode(cluster, eks):
+def nodegroup_mode(cluster, eks, selector=None, journal=None, deadline=DEFAULT_DEADLINE):
     """
     Migrate from Karpenter to Node Groups
 
     Order of operation:
 
     1.) Get Node Groups of EKS Cluster
-    2.) Restore Scaling Config from corresponding NodePool
-    3.) Delete NodePool and NodeClass
+    2.) Restore Scaling Config of every Node Group from corresponding NodePool
+    3.) Scale up cluster-autoscaler
+    4.) Delete NodePool and NodeClass of each Node Group once its nodes are Ready
+
+    Node groups without Ready capacity by the deadline keep their NodePool.
+    With a journal, scaling configs restored by a previous run are not
+    restored again.
     """
 
-    # Get the node groups
-    for nodegroup_name in infra.get_eks_cluster_nodegroups(eks, cluster):
-        # Get the corresponding karpenter node pool
-        print("Restoring Node Group "+nodegroup_name +
-              " from corresponding NodePool")
-        k8s_karpenter_node_pool = infra.get_custom_object(nodegroup_name, "NodePool")
-        # if k8s_karpenter_node_pool is None then continue
-        if k8s_karpenter_node_pool is None:
-            continue
-        # Get the scaling config from annotations
-        min_size = int(
-            k8s_karpenter_node_pool['metadata']['annotations']['migrate.karpenter.io/min'])
-        max_size = int(
-            k8s_karpenter_node_pool['metadata']['annotations']['migrate.karpenter.io/max'])
-        desired_size = int(
-            k8s_karpenter_node_pool['metadata']['annotations']['migrate.karpenter.io/desired'])
-        # restore scalingConfig
-        print("Restoring scaling config for nodegroup "+nodegroup_name)
-        infra.update_nodegroup(
-            eks,
-            clusterName=cluster,
-            nodegroupName=nodegroup_name,
-            scalingConfig={
-                'desiredSize': desired_size,
-                'minSize': min_size,
-                'maxSize': max_size
-            }
-        )
-        # scale cluster-autoscaler from zero
-        infra.scale_deployment(
-            "aws-cluster-autoscaler", "kube-system", 1)
-
-        # Delete nodepool and nodeclass
-        print("Deleting NodePool"+nodegroup_name)
-        infra.delete_custom_object(nodegroup_name, "NodePool")
-        print("Deleting NodeClass for nodegroup "+nodegroup_name)
-        infra.delete_custom_object(nodegroup_name, "EC2NodeClass")
+    with metrics.labels(cluster=cluster):
+        with metrics.span("index"):
+            resources = get_index()
+        with metrics.span("discover"):
+            nodegroup_names = list(discover_nodegroup_names(eks, cluster, selector))
+        with metrics.span("rollback"):
+            results = rollback(cluster, eks, nodegroup_names, resources, journal, deadline)
+    print_summary(results, title="Rollback summary for cluster %s (time to capacity)" % cluster)
+    ratelimit.print_stats()
+
+    return results
 
-    return None
+
+def verified(cluster, migrate, report_file, thresholds=None):
+    """
+    Run migrate() between a snapshot of the nodes, pods and NodeClaims
+    before and one after, and write the verification report (see
+    sharedlib.verify). A failed gate adds a failed "verify" result.
+    """
+    with metrics.labels(cluster=cluster), metrics.span("verify-before"):
+        before = verify.capture(cluster)
+    results = migrate()
+    with metrics.labels(cluster=cluster), metrics.span("verify-after"):
+        report = verify.build_report(before, verify.capture(cluster), thresholds=thresholds)
+    verify.print_report(report)
+    verify.write_report(report, report_file)
+    failed = [gate["gate"] for gate in report["gates"] if not gate["ok"]]
+    if failed:
+        results.append(Result("verify", "failed",
+                              error=RuntimeError("gates failed: " + ", ".join(failed))))
+    else:
+        results.append(Result("verify", "verified"))
+    return results
+
+
+def reconcile_mode(cluster, eks, ec2, interval=DEFAULT_INTERVAL, budget=DEFAULT_BUDGET,
+                   once=False, stop=None):
+    """
+    Keep the NodePools and EC2NodeClasses of migrated Node Groups in sync
+    with later edits of the Node Groups
+
+    Every `interval` seconds at most `budget` Node Groups are described,
+    only changed ones are rendered and patched, see sharedlib.reconcile.
+    Runs until stop is set, or a single cycle with once.
+    """
+
+    with metrics.labels(cluster=cluster):
+        with metrics.span("index"):
+            # a watch keeps the index fresh between cycles
+            resources = get_index(watch=not once)
+        results = Reconciler(cluster, eks, ec2, resources, budget).run(interval, once, stop)
+    ratelimit.print_stats()
+
+    return results
+
+
+def fleet_mode(members, run_cluster, concurrency=DEFAULT_CONCURRENCY,
+               max_clusters=DEFAULT_MAX_CLUSTERS, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               report_file=None):
+    """
+    Run run_cluster(cluster, eks, ec2, slots) for every cluster of the fleet
+    concurrently, with pooled clients per cluster, and print the
+    aggregated report
+    """
+    results = run_fleet(
+        members, lambda clients, slots: run_cluster(
+            clients.member.cluster, clients.eks, clients.ec2, slots),
+        concurrency=concurrency, max_clusters=max_clusters, max_in_flight=max_in_flight)
+    report = fleet_report(results, members)
+    print_fleet_report(report)
+    if report_file:
+        write_report(report, report_file)
+    return report
 
 
 def parse_command_line_option(argv):
-    if len(argv) < 4:
-        print("Usage: python karpenter-migrator.py <karpenter | nodegroup> <clusterName> <region>")
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description="Migrate EKS managed node groups to Karpenter and back")
+    parser.add_argument("mode", help="karpenter | nodegroup | reconcile")
+    parser.add_argument("cluster_name", nargs="?")
+    parser.add_argument("region", nargs="?")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="max node groups migrated at the same time (default %(default)s)")
+    add_selector_arguments(parser)
+    parser.add_argument("--nodeclass-mode", choices=NODECLASS_MODES,
+                        default=NODECLASS_PER_NODEGROUP,
+                        help="shared: one EC2NodeClass per distinct spec")
+    parser.add_argument("--disruption", choices=DISRUPTION_MODES, default=DISRUPTION_DEFAULT,
+                        help="profile: NodePool consolidation and expiry from the "
+                             "node group's pods, default: WhenEmpty after 30s")
+    parser.add_argument("--instance-mode", choices=INSTANCE_MODES, default=INSTANCE_EXACT,
+                        help="flexible: allow compatible instance families, sizes and "
+                             "generations, flexible-spot: for SPOT node groups only")
+    add_drain_arguments(parser)
+    parser.add_argument("--headroom", action="store_true",
+                        help="pre-provision pause pod capacity on the NodePool before scale down")
+    parser.add_argument("--headroom-timeout", type=int, default=600)
+    parser.add_argument("--preflight", action="store_true",
+                        help="fail node groups whose pods the NodePool could not schedule, before applying")
+    parser.add_argument("--rollback-deadline", type=int, default=DEFAULT_DEADLINE,
+                        help="seconds to wait for node group capacity before keeping "
+                             "the NodePool (default %(default)s)")
+    parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL,
+                        help="reconcile: seconds between cycles (default %(default)s)")
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET,
+                        help="reconcile: node groups described per cycle (default %(default)s)")
+    parser.add_argument("--once", action="store_true", help="reconcile: run a single cycle")
+    parser.add_argument("--verify-report", metavar="FILE",
+                        help="karpenter: snapshot the cluster before and after, write the "
+                             "verification report and fail on its gates")
+    parser.add_argument("--verify-gate", action="append", metavar="NAME=VALUE",
+                        help="override a verification gate threshold, or NAME=off")
+    parser.add_argument("--journal", metavar="SPEC",
+                        help="resume from a checkpoint journal, configmap:<namespace>/<name> "
+                             "or a file path (default $SHAREDLIB_JOURNAL)")
+    parser.add_argument("--fleet", metavar="SPEC",
+                        help="migrate several clusters instead of cluster_name: comma "
+                             "separated cluster:region[:kube-context], or a file of them")
+    parser.add_argument("--max-clusters", type=int, default=DEFAULT_MAX_CLUSTERS,
+                        help="fleet: max clusters migrated at the same time (default %(default)s)")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="fleet: max node groups migrated at the same time across "
+                             "clusters (default %(default)s)")
+    parser.add_argument("--report-file", help="fleet: write the aggregated report as JSON")
+    parser.add_argument("--metrics-file",
+                        help="write API latency and phase histograms as a Prometheus textfile "
+                             "(default $SHAREDLIB_METRICS_FILE)")
+    parser.add_argument("--metrics-push", metavar="URL",
+                        help="push the metrics to a Pushgateway (default $SHAREDLIB_METRICS_PUSH)")
+    parser.add_argument("--trace-file",
+                        help="write the phase and API spans as a Chrome trace JSON file "
+                             "(default $SHAREDLIB_TRACE_FILE)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="run under cProfile and write the stats of all threads to FILE")
+    args = parser.parse_args(argv[1:])
+    selector = selector_from_args(args)
+
+    mode = args.mode
+    if mode not in ("karpenter", "nodegroup", "reconcile"):
+        print("Mode %s is not supported. Please use karpenter, nodegroup or reconcile" % mode)
         sys.exit(2)
+    try:
+        thresholds = verify.parse_gates(args.verify_gate)
+    except verify.VerifyError as e:
+        parser.error(str(e))
+    # reconcile until SIGTERM (ie. the pod is deleted), finishing the cycle
+    stop = threading.Event()
+    if mode == "reconcile" and not args.once:
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    def run_cluster(cluster_name, eks, ec2, slots=None):
+        journal = open_journal(cluster_name, args.journal)
+        if mode == "karpenter":
+            def migrate():
+                return karpenter_mode(
+                    cluster_name, eks, ec2, args.concurrency, selector, args.nodeclass_mode,
+                    drain_options_from_args(args),
+                    {"timeout": args.headroom_timeout} if args.headroom else None,
+                    args.preflight, args.instance_mode, journal, slots, args.disruption)
+            if args.verify_report:
+                return verified(cluster_name, migrate, args.verify_report, thresholds)
+            return migrate()
+        if mode == "reconcile":
+            return reconcile_mode(cluster_name, eks, ec2, args.interval, args.budget,
+                                  args.once, stop)
+        return nodegroup_mode(cluster_name, eks, selector, journal, args.rollback_deadline)
 
-    mode = argv[1]
-    cluster_name = argv[2]
-    region = argv[3]
+    metrics.configure(args.metrics_file, args.trace_file, args.metrics_push,
+                      {"mode": mode, "cluster": args.cluster_name or "fleet"})
+    if args.fleet:
+        try:
+            members = parse_fleet(args.fleet)
+        except (FleetError, OSError) as e:
+            parser.error(str(e))
+        if args.verify_report:
+            parser.error("--verify-report is not supported with --fleet")
+        if mode == "reconcile" and not args.once and len(members) > args.max_clusters:
+            parser.error("reconcile runs until stopped, --max-clusters must cover the fleet")
+        with metrics.profile(args.profile):
+            report = fleet_mode(members, run_cluster, args.concurrency, args.max_clusters,
+                                args.max_in_flight, args.report_file)
+        if not report["ok"]:
+            sys.exit(1)
+        return None
+
+    if not args.cluster_name or not args.region:
+        parser.error("cluster_name and region are required without --fleet")
     # print("Cluster="+cluster_name+", Region="+region)
     # AWS Credentials https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
     session = boto3.Session()
-    eks = session.client('eks', region_name=region)
-    ec2 = session.client('ec2', region_name=region)
-    if mode == "karpenter":
-        karpenter_mode(cluster_name, eks, ec2)
-        return None
-    elif mode == "nodegroup":
-        nodegroup_mode(cluster_name, eks)
-        return None
-    else:
-        print("Mode %s is not supported. Please use karpenter or nodegroup" % mode)
+    config = aws_client_config(args.concurrency)
+    eks = session.client('eks', region_name=args.region, config=config)
+    ec2 = session.client('ec2', region_name=args.region, config=config)
+    with metrics.profile(args.profile):
+        results = run_cluster(args.cluster_name, eks, ec2)
+    if not all(result.ok for result in results):
+        sys.exit(1)
+    return None
 
 
 if __name__ == "__main__":
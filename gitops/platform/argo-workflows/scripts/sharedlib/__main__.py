@@ -0,0 +1,4 @@
+import sys
+from sharedlib.cli import main
+
+sys.exit(main())
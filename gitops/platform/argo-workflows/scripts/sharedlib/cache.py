@@ -0,0 +1,328 @@
+"""
+TTL/LRU cache for AWS describe calls
+
+Many node groups share the same cluster, launch templates and instance
+types, so `describe_cluster`, `describe_nodegroup`, launch template
+versions and instance type metadata are cached in memory with a TTL and
+LRU eviction. Hit/miss counters are kept per namespace.
+
+A persistent tier lets separate Argo step pods reuse one warm snapshot:
+
+    SHAREDLIB_CACHE_FILE=/tmp/cache/aws.json       file (ie. a shared volume or artifact)
+    SHAREDLIB_CACHE_CONFIGMAP=argo-workflows/karpenter-migrator-cache
+
+The persistent tier is read on first use and written back at exit.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+DEFAULT_MAXSIZE = 1024
+
+# seconds an entry is valid, per namespace
+TTLS = {
+    "describe_cluster": 600,
+    "describe_nodegroup": 30,
+    "launch_template_version": 600,
+    "instance_types": 86400,
+}
+DEFAULT_TTL = 300
+# immutable results, ie. numbered launch template versions
+PINNED_TTL = 7 * 86400
+
+_MISSING = object()
+
+
+class TTLCache:
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttls=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttls = dict(TTLS if ttls is None else ttls)
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # (namespace, key) -> Future of the call in flight, see get_or_call
+        self._in_flight = {}
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+        self.dirty = False
+
+    def _count(self, counter, namespace):
+        counter[namespace] = counter.get(namespace, 0) + 1
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._data.get((namespace, key))
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    self._data.move_to_end((namespace, key))
+                    self._count(self.hits, namespace)
+                    return value
+                del self._data[(namespace, key)]
+            self._count(self.misses, namespace)
+            return default
+
+    def set(self, namespace, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttls.get(namespace, DEFAULT_TTL)
+        with self._lock:
+            self._data[(namespace, key)] = (self.clock() + ttl, value)
+            self._data.move_to_end((namespace, key))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+
+    def invalidate(self, namespace, key=_MISSING):
+        with self._lock:
+            for k in list(self._data):
+                if k[0] == namespace and (key is _MISSING or k[1] == key):
+                    del self._data[k]
+
+    def get_or_call(self, namespace, key, func, ttl=None):
+        """
+        Return the cached value, or call func() and cache a non None result.
+        Concurrent misses of a key wait for the first caller's func() and
+        share its result, or its exception.
+        """
+        value = self.get(namespace, key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            future = self._in_flight.get((namespace, key))
+            owner = future is None
+            if owner:
+                future = self._in_flight[(namespace, key)] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = func()
+            if value is not None:
+                self.set(namespace, key, value, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[(namespace, key)]
+
+    def stats(self):
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            return {
+                "size": len(self._data),
+                "evictions": self.evictions,
+                "namespaces": {
+                    ns: {"hits": self.hits.get(ns, 0), "misses": self.misses.get(ns, 0)}
+                    for ns in namespaces
+                },
+            }
+
+    def print_stats(self, file=sys.stderr):
+        stats = self.stats()
+        for ns, counters in stats["namespaces"].items():
+            print("cache %-26s hits=%d misses=%d" %
+                  (ns, counters["hits"], counters["misses"]), file=file)
+
+    def snapshot(self):
+        """
+        Return the unexpired entries as a JSON serializable document
+        """
+        now = self.clock()
+        with self._lock:
+            return {
+                "version": 1,
+                "entries": [[ns, key, expires, value]
+                            for (ns, key), (expires, value) in self._data.items()
+                            if expires > now],
+            }
+
+    def restore(self, document):
+        now = self.clock()
+        if not document or document.get("version") != 1:
+            return 0
+        count = 0
+        with self._lock:
+            for ns, key, expires, value in document["entries"]:
+                if expires > now:
+                    self._data[(ns, key)] = (expires, value)
+                    count += 1
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return count
+
+
+def _dumps(document):
+    from sharedlib.infra import DateTimeEncoder
+    return json.dumps(document, cls=DateTimeEncoder, separators=(",", ":"))
+
+
+class FileTier:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print("Ignoring corrupt cache file %s: %s" % (self.path, e), file=sys.stderr)
+            return None
+
+    def save(self, document):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(_dumps(document))
+        os.replace(tmp, self.path)
+
+
+class ConfigMapTier:
+    """
+    Cache snapshot in a ConfigMap shared by the fan-out pods: saves merge
+    with the live snapshot under the ConfigMap resourceVersion, so the
+    last pod to exit does not drop the entries of the others, and keep
+    the entries expiring last within the ConfigMap size limit
+    """
+
+    KEY = "cache.json"
+    # ConfigMaps are limited to 1 MiB, leave room for the metadata
+    MAX_BYTES = 1024 * 1024 - 16 * 1024
+    CONFLICT_RETRIES = 3
+
+    def __init__(self, namespace, name):
+        self.namespace = namespace
+        self.name = name
+
+    def _read(self):
+        from kubernetes.client.exceptions import ApiException
+        from sharedlib.infra import get_core_api
+        try:
+            return get_core_api().read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                print("Unable to read cache configmap: %s" % e, file=sys.stderr)
+            return None
+
+    @classmethod
+    def _document(cls, configmap):
+        data = ((configmap and configmap.data) or {}).get(cls.KEY)
+        try:
+            return json.loads(data) if data else None
+        except ValueError as e:
+            print("Ignoring corrupt cache configmap: %s" % e, file=sys.stderr)
+            return None
+
+    def load(self):
+        return self._document(self._read())
+
+    def fit(self, document):
+        """
+        Return the serialized document, without the entries expiring first
+        when it is over MAX_BYTES
+        """
+        entries = sorted(document["entries"], key=lambda entry: entry[2], reverse=True)
+        while True:
+            data = _dumps(dict(document, entries=entries))
+            size = len(data.encode())
+            if size <= self.MAX_BYTES or not entries:
+                return data
+            dropped = max(1, len(entries) * (size - self.MAX_BYTES) // size)
+            print("Cache configmap over %d bytes, dropping %d entries" %
+                  (self.MAX_BYTES, dropped), file=sys.stderr)
+            entries = entries[:-dropped]
+
+    def save(self, document):
+        from kubernetes.client.exceptions import ApiException
+        from sharedlib.infra import get_core_api
+        api = get_core_api()
+        for _ in range(self.CONFLICT_RETRIES):
+            configmap = self._read()
+            body = {
+                "metadata": {"name": self.name, "namespace": self.namespace},
+                "data": {self.KEY: self.fit(merge(self._document(configmap), document))},
+            }
+            try:
+                if configmap is None:
+                    api.create_namespaced_config_map(self.namespace, body)
+                else:
+                    body["metadata"]["resourceVersion"] = configmap.metadata.resource_version
+                    api.replace_namespaced_config_map(self.name, self.namespace, body)
+                return
+            except ApiException as e:
+                # 409: another pod saved in between, merge again
+                if e.status != 409:
+                    print("Unable to write cache configmap: %s" % e, file=sys.stderr)
+                    return
+        print("Unable to write cache configmap, conflicting writers", file=sys.stderr)
+
+
+def merge(base, document):
+    """
+    Return the entries of both snapshots, the later expiry of a key wins
+    """
+    entries = {}
+    for source in (base, document):
+        if not source or source.get("version") != 1:
+            continue
+        for ns, key, expires, value in source["entries"]:
+            current = entries.get((ns, key))
+            if current is None or current[2] < expires:
+                entries[(ns, key)] = [ns, key, expires, value]
+    return {"version": 1, "entries": list(entries.values())}
+
+
+def tier_from_environment():
+    path = os.environ.get("SHAREDLIB_CACHE_FILE")
+    if path:
+        return FileTier(path)
+    configmap = os.environ.get("SHAREDLIB_CACHE_CONFIGMAP")
+    if configmap:
+        namespace, _, name = configmap.rpartition("/")
+        return ConfigMapTier(namespace or "default", name)
+    return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the process wide cache, warmed from the persistent tier if any
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TTLCache()
+            tier = tier_from_environment()
+            if tier is not None:
+                restored = _cache.restore(tier.load())
+                _cache.dirty = False
+                print("Restored %d cache entries" % restored, file=sys.stderr)
+                atexit.register(_save, _cache, tier)
+        return _cache
+
+
+def _save(cache, tier):
+    if not cache.dirty:
+        return
+    try:
+        tier.save(cache.snapshot())
+    except Exception as e:
+        print("Unable to save cache: %s" % e, file=sys.stderr)
@@ -0,0 +1,275 @@
+"""
+EC2 instance type catalog
+
+A small bundled snapshot of instance types (sharedlib/data/instance-types.json)
+with vCPU, memory, architecture, family, generation and an approximate
+on-demand price, usable fully offline. SHAREDLIB_CATALOG points to another
+catalog file with the same format.
+
+Each instance type is exposed with the well-known labels Karpenter
+uses in NodePool requirements, so requirements can be evaluated against
+the catalog. The catalog also derives NodePool limits and the widened
+("flexible") requirements of a node group from its instance types.
+
+`python -m sharedlib catalog --output-file PATH` refreshes a catalog from
+describe_instance_types, keeping the bundled prices.
+"""
+
+import json
+import os
+import re
+import sys
+
+BUNDLED_CATALOG = os.path.join(os.path.dirname(__file__), "data", "instance-types.json")
+CATALOG_VERSION = 1
+# rough on-demand price per vCPU hour for instance types without a price
+DEFAULT_VCPU_PRICE = 0.048
+ARCHITECTURES = {"x86_64": "amd64", "arm64": "arm64"}
+INSTANCE_TYPE_NAME = re.compile(r"^([a-z]+)(\d+)[a-z-]*\.([a-z0-9]+)$")
+
+
+class CatalogError(Exception):
+    pass
+
+
+def instance_type_labels(info):
+    """
+    Return the well-known node labels of a catalog instance type
+    """
+    return {
+        "node.kubernetes.io/instance-type": info["instanceType"],
+        "kubernetes.io/arch": info["arch"],
+        "kubernetes.io/os": "linux",
+        "karpenter.k8s.aws/instance-category": info["category"],
+        "karpenter.k8s.aws/instance-family": info["family"],
+        "karpenter.k8s.aws/instance-generation": str(info["generation"]),
+        "karpenter.k8s.aws/instance-size": info["size"],
+        "karpenter.k8s.aws/instance-cpu": str(info["vcpu"]),
+        "karpenter.k8s.aws/instance-memory": str(info["memoryMiB"]),
+        "karpenter.k8s.aws/instance-hypervisor": info["hypervisor"],
+    }
+
+
+class Catalog:
+
+    def __init__(self, document):
+        if document.get("version") != CATALOG_VERSION:
+            raise CatalogError("unsupported catalog version %r" % document.get("version"))
+        self.document = document
+        self.instance_types = {info["instanceType"]: info
+                               for info in document["instanceTypes"]}
+        self.labels = {name: instance_type_labels(info)
+                       for name, info in self.instance_types.items()}
+
+    def get(self, instance_type):
+        return self.instance_types.get(instance_type)
+
+    def extend(self, entries):
+        """
+        Add or replace instance types, ie. fetched with describe_instance_types
+        """
+        for info in entries:
+            self.instance_types[info["instanceType"]] = info
+            self.labels[info["instanceType"]] = instance_type_labels(info)
+
+    def missing(self, instance_types):
+        return [name for name in instance_types if name not in self.instance_types]
+
+    def names(self):
+        return list(self.instance_types)
+
+    def matching(self, requirements):
+        """
+        Return the instance types satisfying every NodePool requirement.
+        Requirements on keys the catalog does not know do not constrain
+        the instance type.
+        """
+        return [name for name in self.instance_types
+                if all(requirement_matches(requirement, self.labels[name])
+                       for requirement in requirements)]
+
+
+def price(info):
+    """
+    Return the hourly on-demand price of an instance type, estimated from
+    its vCPUs when the catalog has none
+    """
+    if info.get("onDemandPrice") is not None:
+        return info["onDemandPrice"]
+    return info["vcpu"] * DEFAULT_VCPU_PRICE
+
+
+def requirement_matches(requirement, labels):
+    """
+    Evaluate a NodeSelectorRequirement against labels, unknown keys match
+    """
+    key = requirement["key"]
+    if key not in labels:
+        return True
+    value = labels[key]
+    operator = requirement["operator"]
+    values = [str(v) for v in requirement.get("values") or []]
+    if operator == "In":
+        return value in values
+    if operator == "NotIn":
+        return value not in values
+    if operator == "Exists":
+        return True
+    if operator == "DoesNotExist":
+        return False
+    if operator in ("Gt", "Lt"):
+        try:
+            number, bound = int(value), int(values[0])
+        except (ValueError, IndexError):
+            return False
+        return number > bound if operator == "Gt" else number < bound
+    return False
+
+
+_catalog = None
+
+
+def load_catalog(path=None):
+    """
+    Return the catalog at path, SHAREDLIB_CATALOG, or the bundled one
+    """
+    global _catalog
+    if path is None and _catalog is not None:
+        return _catalog
+    catalog_path = path or os.environ.get("SHAREDLIB_CATALOG") or BUNDLED_CATALOG
+    try:
+        with open(catalog_path) as f:
+            catalog = Catalog(json.load(f))
+    except (OSError, ValueError) as e:
+        raise CatalogError("unable to load catalog %s: %s" % (catalog_path, e))
+    if path is None:
+        _catalog = catalog
+    return catalog
+
+
+def entry_from_instance_type(info, prices=None):
+    """
+    Return the catalog entry of a describe_instance_types InstanceTypes item,
+    or None for instance types Karpenter does not use (metal, unknown arch)
+    """
+    name = info['InstanceType']
+    match = INSTANCE_TYPE_NAME.match(name)
+    architectures = [ARCHITECTURES[arch] for arch in
+                     info['ProcessorInfo']['SupportedArchitectures'] if arch in ARCHITECTURES]
+    if match is None or not architectures or not info.get('Hypervisor'):
+        return None
+    network = info['NetworkInfo']
+    return {
+        "instanceType": name,
+        "category": match.group(1),
+        "family": name.split(".")[0],
+        "generation": int(match.group(2)),
+        "size": match.group(3),
+        "arch": architectures[0],
+        "vcpu": info['VCpuInfo']['DefaultVCpus'],
+        "memoryMiB": info['MemoryInfo']['SizeInMiB'],
+        "hypervisor": info['Hypervisor'],
+        # ENI limited max pods, as in the EKS AMI eni-max-pods.txt
+        "maxPods": network['MaximumNetworkInterfaces'] *
+        (network['Ipv4AddressesPerInterface'] - 1) + 2,
+        "onDemandPrice": (prices or {}).get(name),
+    }
+
+
+def ensure_instance_types(catalog, ec2, instance_types):
+    """
+    Add the instance types missing from the catalog with the cached
+    describe_instance_types of sharedlib.infra. When they cannot be
+    described the catalog is left as is, the NodePool limits stay unset.
+    """
+    missing = catalog.missing(instance_types)
+    if not missing:
+        return catalog
+    from botocore.exceptions import ClientError
+    from sharedlib import infra
+    try:
+        described = infra.get_instance_types(ec2, missing)
+    except ClientError as e:
+        print("Unable to describe instance types %s: %s" %
+              (", ".join(missing), e.response['Error']['Message']), file=sys.stderr)
+        return catalog
+    entries = [entry_from_instance_type(info) for info in described.values()]
+    catalog.extend(entry for entry in entries if entry is not None)
+    return catalog
+
+
+def refresh_catalog(ec2, path, families=None):
+    """
+    Write a catalog of the current generation instance types of the ec2
+    client's region, optionally only of some families (ie. m6i, c7g),
+    keeping the prices of the bundled catalog
+    """
+    prices = {name: info.get("onDemandPrice") for name, info in
+              load_catalog(BUNDLED_CATALOG).instance_types.items()}
+    filters = [{"Name": "current-generation", "Values": ["true"]}]
+    if families:
+        filters.append({"Name": "instance-type",
+                        "Values": [family + ".*" for family in families]})
+    from sharedlib.ratelimit import paginate
+    entries = []
+    for page in paginate(ec2, 'describe_instance_types', token='NextToken', Filters=filters):
+        for info in page['InstanceTypes']:
+            entry = entry_from_instance_type(info, prices)
+            if entry is not None:
+                entries.append(entry)
+    document = {
+        "version": CATALOG_VERSION,
+        "source": "describe_instance_types",
+        "region": ec2.meta.region_name,
+        "note": "on-demand prices from the bundled catalog, null when unknown",
+        "instanceTypes": sorted(entries, key=lambda entry: entry["instanceType"]),
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(document, f, indent=1)
+        f.write("\n")
+    os.replace(tmp, path)
+    print("Catalog of %d instance types written to %s" % (len(entries), path),
+          file=sys.stderr)
+    return Catalog(document)
+
+
+def flexible_requirements(catalog, instance_types):
+    """
+    Return NodePool requirements allowing every catalog instance type of the
+    same categories as instance_types, of at least their oldest generation
+    and within their vCPU range. Returns None when an instance type is not
+    in the catalog.
+    """
+    infos = [catalog.get(name) for name in instance_types]
+    if not infos or None in infos:
+        return None
+    vcpus = [info["vcpu"] for info in infos]
+    return [
+        {"key": "karpenter.k8s.aws/instance-category", "operator": "In",
+         "values": sorted({info["category"] for info in infos})},
+        {"key": "karpenter.k8s.aws/instance-generation", "operator": "Gt",
+         "values": [str(min(info["generation"] for info in infos) - 1)]},
+        {"key": "karpenter.k8s.aws/instance-cpu", "operator": "Gt",
+         "values": [str(min(vcpus) - 1)]},
+        {"key": "karpenter.k8s.aws/instance-cpu", "operator": "Lt",
+         "values": [str(max(vcpus) + 1)]},
+    ]
+
+
+def nodepool_limits(catalog, instance_types, requirements, max_size):
+    """
+    Return NodePool limits for max_size nodes of the largest instance type
+    the NodePool may launch: the node group instance_types and the catalog
+    instance types the requirements allow. Returns None when an instance
+    type is not in the catalog, limits would be guessed.
+    """
+    if not instance_types or catalog.missing(instance_types):
+        return None
+    names = set(instance_types) | set(catalog.matching(requirements))
+    infos = [catalog.get(name) for name in names]
+    nodes = max(1, max_size)
+    return {
+        "cpu": nodes * max(info["vcpu"] for info in infos),
+        "memory": "%dMi" % (nodes * max(info["memoryMiB"] for info in infos)),
+    }
@@ -0,0 +1,762 @@
+"""
+sharedlib command line
+
+Entry point for the Argo workflow steps, so templates run
+`python -m sharedlib <command>` instead of inline scripts.
+Heavy imports (boto3, kubernetes, yaml) are deferred to the command that
+needs them, e.g. `scale --deployment` never imports boto3.
+
+    python -m sharedlib list --cluster argocon-1 --without-nodepool
+    python -m sharedlib snapshot --cluster argocon-1 --output-file /tmp/snapshot.json
+    python -m sharedlib generate --cluster argocon-1 --nodegroup team-a
+    python -m sharedlib apply --cluster argocon-1 --nodegroup team-a
+    python -m sharedlib apply --cluster argocon-1 --nodegroup team-a --snapshot /tmp/snapshot.json
+    python -m sharedlib render --input /tmp/snapshot.json --output-dir gitops/platform/karpenter
+    python -m sharedlib catalog --region us-east-2 --output-file /tmp/instance-types.json
+    python -m sharedlib scale --cluster argocon-1 --nodegroup team-a --min 0 --max 1 --desired 0
+    python -m sharedlib scale --cluster argocon-1 --nodegroup team-a --from-nodepool
+    python -m sharedlib scale --deployment aws-cluster-autoscaler --namespace kube-system --replicas 0
+    python -m sharedlib headroom up --nodegroup team-a
+    python -m sharedlib drain --nodegroup team-a --wave-size 2
+    python -m sharedlib simulate --nodegroup team-a --snapshot /tmp/snapshot.json --pods pods.json
+    python -m sharedlib delete --nodegroup team-a
+    python -m sharedlib rollback --cluster argocon-1 --nodegroup team-a --deadline 900
+    python -m sharedlib journal show --cluster argocon-1
+    python -m sharedlib profile --cluster argocon-1 --nodegroup team-a
+    python -m sharedlib plan --cluster argocon-1 --snapshot /tmp/snapshot.json --max-parallel 4
+    python -m sharedlib verify snapshot --cluster argocon-1 --output-file /tmp/before.json
+    python -m sharedlib verify report --cluster argocon-1 --before /tmp/before.json --output-file /tmp/verify.json
+
+With a checkpoint journal (`--journal` or SHAREDLIB_JOURNAL, see
+sharedlib.journal) and --cluster, the migration and rollback steps record
+their phase and skip the work a previous attempt already completed.
+
+Every step records API latency histograms and phase spans, exported at
+exit as a Prometheus textfile and a Chrome trace, see sharedlib.metrics.
+
+`--startup-only` performs the imports and client initialization for the
+command and exits, it is used by benchmarks/startup.py.
+"""
+
+import argparse
+import json
+import sys
+
+
+def _eks(args):
+    import boto3
+    from sharedlib.ratelimit import aws_client_config
+    return boto3.Session().client('eks', region_name=args.region, config=aws_client_config())
+
+
+def _ec2(args):
+    import boto3
+    from sharedlib.ratelimit import aws_client_config
+    return boto3.Session().client('ec2', region_name=args.region, config=aws_client_config())
+
+
+def _infra():
+    from sharedlib import infra
+    return infra
+
+
+def _dump(objects, output):
+    if output == "json":
+        return json.dumps(objects, indent=2)
+    from sharedlib.render import dump_yaml
+    return dump_yaml(objects)
+
+
+def _journal(args):
+    from sharedlib.journal import open_journal
+    return open_journal(getattr(args, "cluster", None), args.journal)
+
+
+def _journal_done(journal, operation, nodegroup_name, phase):
+    if journal is None or not journal.done(operation, nodegroup_name, phase):
+        return False
+    print("Nodegroup %s already %s, skipping" % (nodegroup_name, phase), file=sys.stderr)
+    return True
+
+
+def _filter_nodepool(args, nodegroup_names, journal=None):
+    if not (args.with_nodepool or args.without_nodepool):
+        return list(nodegroup_names)
+    from sharedlib.index import get_index
+    from sharedlib.journal import MIGRATE
+    resources = get_index()
+    nodegroups = []
+    for nodegroup_name in nodegroup_names:
+        has_nodepool = resources.get_for_nodegroup(
+            nodegroup_name, "NodePool") is not None
+        if args.without_nodepool and journal is not None and \
+                journal.in_progress(MIGRATE, nodegroup_name):
+            # unfinished migration, its NodePool may already exist
+            has_nodepool = False
+        if args.with_nodepool and not has_nodepool:
+            continue
+        if args.without_nodepool and has_nodepool:
+            continue
+        nodegroups.append(nodegroup_name)
+    return nodegroups
+
+
+def cmd_list(args):
+    from sharedlib.discovery import discover_nodegroup_names, selector_from_args
+    eks = _eks(args)
+    nodegroups = _filter_nodepool(args, discover_nodegroup_names(
+        eks, args.cluster, selector_from_args(args)))
+    json.dump(nodegroups, sys.stdout)
+    return 0
+
+
+def cmd_snapshot(args):
+    from sharedlib.discovery import selector_from_args
+    from sharedlib.snapshot import build_snapshot, write_snapshot
+    snapshot = build_snapshot(
+        _eks(args), _ec2(args), args.cluster, selector_from_args(args))
+    write_snapshot(snapshot, args.output_file)
+    print("Snapshot of %d nodegroups written to %s" %
+          (len(snapshot["nodegroups"]), args.output_file), file=sys.stderr)
+    if args.output_file != "-":
+        journal = _journal(args)
+        nodegroups = _filter_nodepool(args, snapshot["nodegroups"], journal)
+        if journal is not None and args.without_nodepool:
+            from sharedlib.journal import DISCOVERED, MIGRATE, ROLLBACK
+            for nodegroup_name in nodegroups:
+                if journal.phase(MIGRATE, nodegroup_name) is None:
+                    journal.forget(ROLLBACK, nodegroup_name)
+                    journal.record(MIGRATE, nodegroup_name, DISCOVERED)
+        json.dump(nodegroups, sys.stdout)
+    return 0
+
+
+def _disruption(args):
+    if getattr(args, "disruption", "default") != "profile":
+        return None
+    from sharedlib.workload import nodegroup_disruptions
+    return nodegroup_disruptions([args.nodegroup]).get(args.nodegroup, {}).get("disruption")
+
+
+def _generate(args):
+    if args.snapshot:
+        from sharedlib.snapshot import (SnapshotError, generate_from_snapshot,
+                                        read_snapshot)
+        try:
+            return generate_from_snapshot(read_snapshot(args.snapshot), args.nodegroup,
+                                          args.nodeclass_mode, args.instance_mode,
+                                          _disruption(args))
+        except SnapshotError as e:
+            print(e, file=sys.stderr)
+            return None
+    infra = _infra()
+    eks = _eks(args)
+    ec2 = _ec2(args)
+    nodegroup = infra.get_node_group(eks, args.cluster, args.nodegroup)
+    if nodegroup is None:
+        print("Nodegroup %s not found" % args.nodegroup, file=sys.stderr)
+        return None
+    karpenter_node_class = infra.generate_karpenter_node_class(
+        eks, ec2, nodegroup)
+    karpenter_node_pool = infra.generate_karpenter_node_pool(
+        nodegroup, args.instance_mode, ec2, _disruption(args))
+    if args.nodeclass_mode == "shared":
+        from sharedlib.render import share_node_class
+        return list(share_node_class(karpenter_node_class, karpenter_node_pool))
+    return [karpenter_node_class, karpenter_node_pool]
+
+
+def cmd_generate(args):
+    objects = _generate(args)
+    if objects is None:
+        return 1
+    print(_dump(objects, args.output))
+    return 0
+
+
+def cmd_apply(args):
+    from sharedlib.journal import APPLIED, MIGRATE
+    journal = _journal(args)
+    if _journal_done(journal, MIGRATE, args.nodegroup, APPLIED):
+        return 0
+    objects = _generate(args)
+    if objects is None:
+        return 1
+    # print karpenter nodeclass and nodepool
+    print(_dump(objects, args.output), file=sys.stderr)
+    from sharedlib.apply import apply_objects, summarize
+    counts = summarize(apply_objects(objects))
+    print("Apply: %s" % ", ".join("%s=%d" % item for item in sorted(counts.items())),
+          file=sys.stderr)
+    if counts.get("failed"):
+        return 1
+    if journal is not None:
+        journal.record(MIGRATE, args.nodegroup, APPLIED)
+    return 0
+
+
+def cmd_render(args):
+    from sharedlib.render import render_file
+    count, errors = render_file(
+        args.input, args.output, args.output_dir, args.security_group,
+        nodeclass_mode=args.nodeclass_mode, instance_mode=args.instance_mode)
+    print("Rendered %d nodegroups" % count, file=sys.stderr)
+    return 1 if errors else 0
+
+
+def cmd_catalog(args):
+    from sharedlib.catalog import refresh_catalog
+    refresh_catalog(_ec2(args), args.output_file, args.family)
+    return 0
+
+
+def cmd_scale(args):
+    from sharedlib.journal import MIGRATE, RESTORED, ROLLBACK, SCALED_DOWN, VERIFIED
+    infra = _infra()
+    journal = _journal(args)
+    if args.deployment:
+        print("Scaling deployment %s to %d" %
+              (args.deployment, args.replicas), file=sys.stderr)
+        infra.scale_deployment(args.deployment, args.namespace, args.replicas)
+        if journal is not None and args.deployment == "aws-cluster-autoscaler":
+            journal.set_state("autoscaler-replicas", args.replicas)
+        return 0
+    # the migration scales node groups to 0, the rollback restores them
+    operation, phase = (ROLLBACK, RESTORED) if args.from_nodepool else (MIGRATE, SCALED_DOWN)
+    if not (args.from_nodepool or args.desired == 0):
+        journal = None
+    if _journal_done(journal, operation, args.nodegroup, phase):
+        if operation == MIGRATE and not journal.done(MIGRATE, args.nodegroup, VERIFIED):
+            return _verify_scale_down(args, journal)
+        return 0
+    if args.from_nodepool:
+        # Get the scaling config from karpenter annotations
+        from sharedlib.index import get_index, nodepool_scaling_config
+        k8s_karpenter_node_pool = get_index().get_for_nodegroup(
+            args.nodegroup, "NodePool")
+        if k8s_karpenter_node_pool is None:
+            print("NodePool for nodegroup %s not found" % args.nodegroup,
+                  file=sys.stderr)
+            return 1
+        scaling_config = nodepool_scaling_config(k8s_karpenter_node_pool)
+        args.min = scaling_config['minSize']
+        args.max = scaling_config['maxSize']
+        args.desired = scaling_config['desiredSize']
+    print("Updating nodegroup %s min_size=%d max_size=%d desired_size=%d" %
+          (args.nodegroup, args.min, args.max, args.desired), file=sys.stderr)
+    infra.update_nodegroup(
+        _eks(args),
+        clusterName=args.cluster,
+        nodegroupName=args.nodegroup,
+        scalingConfig={
+            'desiredSize': args.desired,
+            'minSize': args.min,
+            'maxSize': args.max
+        }
+    )
+    if journal is not None:
+        journal.record(operation, args.nodegroup, phase)
+        if operation == MIGRATE:
+            return _verify_scale_down(args, journal)
+    return 0
+
+
+def _verify_scale_down(args, journal):
+    from sharedlib.journal import MIGRATE, VERIFIED, verify_scaled_down
+    if not verify_scaled_down(_eks(args), args.cluster, args.nodegroup):
+        print("Nodegroup %s is not scaled down" % args.nodegroup, file=sys.stderr)
+        return 1
+    journal.record(MIGRATE, args.nodegroup, VERIFIED)
+    return 0
+
+
+def cmd_drain(args):
+    from sharedlib.drain import DrainError, drain_nodegroup
+    from sharedlib.journal import DRAINED, MIGRATE
+    journal = _journal(args)
+    if _journal_done(journal, MIGRATE, args.nodegroup, DRAINED):
+        return 0
+    try:
+        timings = drain_nodegroup(
+            args.nodegroup, wave_size=args.wave_size, concurrency=args.concurrency,
+            wave_timeout=args.wave_timeout)
+    except DrainError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if journal is not None:
+        journal.record(MIGRATE, args.nodegroup, DRAINED)
+    json.dump(timings, sys.stdout)
+    return 0
+
+
+def cmd_headroom(args):
+    from sharedlib import headroom
+    if args.action == "down":
+        headroom.teardown(args.nodegroup)
+        return 0
+    from sharedlib.journal import DRAINED, MIGRATE
+    # no headroom needed once the pods have moved
+    if _journal_done(_journal(args), MIGRATE, args.nodegroup, DRAINED):
+        return 0
+    from sharedlib.index import get_index
+    nodepool = get_index().get_for_nodegroup(args.nodegroup, "NodePool")
+    if nodepool is None:
+        print("NodePool for nodegroup %s not found" % args.nodegroup, file=sys.stderr)
+        return 1
+    try:
+        headroom.provision(args.nodegroup, nodepool, timeout=args.timeout)
+    except headroom.HeadroomError as e:
+        print(e, file=sys.stderr)
+        headroom.teardown(args.nodegroup)
+        return 1
+    return 0
+
+
+def _simulation_nodepool(args):
+    if args.nodepool:
+        # JSON manifests load as YAML too
+        import yaml
+        with (sys.stdin if args.nodepool == "-" else open(args.nodepool)) as f:
+            for document in yaml.safe_load_all(f):
+                if document and document.get('kind') == "NodePool":
+                    return document
+        print("No NodePool in " + args.nodepool, file=sys.stderr)
+        return None
+    objects = _generate(args)
+    if objects is None:
+        return None
+    return objects[-1]
+
+
+def cmd_simulate(args):
+    from sharedlib.catalog import CatalogError, load_catalog
+    from sharedlib.simulate import load_pods, live_nodegroup_pods, print_report, simulate
+    nodepool = _simulation_nodepool(args)
+    if nodepool is None:
+        return 1
+    if args.pods:
+        with (sys.stdin if args.pods == "-" else open(args.pods)) as f:
+            pods = load_pods(f)
+    else:
+        pods = live_nodegroup_pods(args.nodegroup)
+    try:
+        catalog = load_catalog(args.catalog)
+    except CatalogError as e:
+        print(e, file=sys.stderr)
+        return 1
+    report = simulate(nodepool, pods, catalog)
+    print_report(report)
+    json.dump(report, sys.stdout)
+    return 0 if report['ok'] else 1
+
+
+def cmd_delete(args):
+    from sharedlib.apply import delete_for_nodegroup
+    from sharedlib.index import get_index
+    from sharedlib.journal import DELETED, MIGRATE, ROLLBACK
+    journal = _journal(args)
+    if _journal_done(journal, ROLLBACK, args.nodegroup, DELETED):
+        return 0
+    delete_for_nodegroup(args.nodegroup, get_index())
+    if journal is not None:
+        journal.forget(MIGRATE, args.nodegroup)
+        journal.record(ROLLBACK, args.nodegroup, DELETED)
+    return 0
+
+
+def cmd_rollback(args):
+    from sharedlib.concurrency import print_summary
+    from sharedlib.index import get_index
+    from sharedlib.rollback import rollback
+    eks = _eks(args)
+    nodegroup_names = args.nodegroup
+    if not nodegroup_names:
+        from sharedlib.discovery import discover_nodegroup_names, selector_from_args
+        nodegroup_names = list(discover_nodegroup_names(
+            eks, args.cluster, selector_from_args(args)))
+    results = rollback(args.cluster, eks, nodegroup_names, get_index(), _journal(args),
+                       args.deadline, args.autoscaler_replicas)
+    print_summary(results, title="Rollback summary for cluster %s (time to capacity)" %
+                  args.cluster)
+    json.dump({result.name: {"status": result.status, "timeToCapacity": result.value,
+                             "error": None if result.error is None else str(result.error)}
+               for result in results}, sys.stdout)
+    return 0 if all(result.ok for result in results) else 1
+
+
+def cmd_profile(args):
+    from sharedlib import workload
+    nodegroup_names = args.nodegroup
+    if not nodegroup_names:
+        from sharedlib.discovery import discover_nodegroup_names, selector_from_args
+        nodegroup_names = list(discover_nodegroup_names(
+            _eks(args), args.cluster, selector_from_args(args)))
+    report = workload.disruption_report(
+        workload.profile_nodegroups(nodegroup_names, args.page_size))
+    workload.print_report(report)
+    json.dump(report, sys.stdout)
+    return 0
+
+
+def cmd_plan(args):
+    from sharedlib import plan
+    if args.snapshot:
+        from sharedlib.snapshot import SnapshotError, read_snapshot
+        try:
+            nodegroups = read_snapshot(args.snapshot)["nodegroups"]
+        except (OSError, ValueError, SnapshotError) as e:
+            print(e, file=sys.stderr)
+            return 1
+    else:
+        from sharedlib.discovery import discover_nodegroups, selector_from_args
+        nodegroups = {nodegroup['nodegroupName']: nodegroup for nodegroup in
+                      discover_nodegroups(_eks(args), args.cluster, selector_from_args(args))}
+    if args.nodegroups:
+        # ie. the filtered list printed by `snapshot --without-nodepool`
+        names = set(json.loads(args.nodegroups))
+        nodegroups = {name: nodegroup for name, nodegroup in nodegroups.items()
+                      if name in names}
+    scores = plan.score_nodegroups(nodegroups, *plan.live_cluster_objects())
+    batches, held = plan.plan_batches(scores, args.max_parallel, args.max_pods,
+                                      args.vcpu_headroom)
+    migration_plan = plan.build_plan(args.cluster, scores, batches, held)
+    plan.print_plan(migration_plan)
+    if args.output_file:
+        plan.write_plan(migration_plan, args.output_file)
+    json.dump(migration_plan["batches"], sys.stdout)
+    return 0
+
+
+def cmd_verify(args):
+    from sharedlib import verify
+    if args.action == "snapshot":
+        snapshot = verify.capture(args.cluster, args.page_size)
+        verify.write_snapshot(snapshot, args.output_file)
+        return 0
+    if not args.before:
+        print("verify report requires --before", file=sys.stderr)
+        return 2
+    try:
+        thresholds = verify.parse_gates(args.gate)
+        before = verify.read_snapshot(args.before)
+        after = (verify.read_snapshot(args.after) if args.after
+                 else verify.capture(args.cluster, args.page_size))
+    except (OSError, ValueError, verify.VerifyError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    report = verify.build_report(before, after, thresholds=thresholds)
+    verify.print_report(report)
+    verify.write_report(report, args.output_file)
+    json.dump({"ok": report["ok"], "gates": report["gates"]}, sys.stdout)
+    return 0 if report["ok"] or args.report_only else 1
+
+
+def cmd_journal(args):
+    journal = _journal(args)
+    if journal is None:
+        print("No journal configured, use --journal or SHAREDLIB_JOURNAL", file=sys.stderr)
+        return 1
+    if args.action == "reset":
+        from sharedlib.journal import PHASES
+        entries = journal.entries()
+        for operation in PHASES:
+            for nodegroup_name in entries.get(operation, {}):
+                if args.nodegroup in (None, nodegroup_name):
+                    journal.forget(operation, nodegroup_name)
+        if args.nodegroup is None:
+            journal.set_state("autoscaler-replicas", None)
+        return 0
+    json.dump(journal.entries(), sys.stdout, indent=2)
+    print()
+    return 0
+
+
+def startup(args):
+    """
+    Initialize what the command needs without calling any API
+    """
+    needs = args.needs(args) if callable(args.needs) else args.needs
+    if "eks" in needs:
+        _eks(args)
+    if "ec2" in needs:
+        _ec2(args)
+    if "kube" in needs:
+        _infra()
+        import kubernetes.client  # noqa: F401
+    if "kubeconfig" in needs:
+        try:
+            _infra().get_custom_objects_api()
+        except Exception as e:
+            # no kube config available, the import cost is still measured
+            print("kube config not loaded: %s" % e, file=sys.stderr)
+    return 0
+
+
+def _generate_needs(args):
+    needs = () if args.snapshot else ("eks", "ec2")
+    if getattr(args, "disruption", None) == "profile":
+        needs += ("kube", "kubeconfig")
+    return needs
+
+
+def _apply_needs(args):
+    return _generate_needs(args) + ("kube", "kubeconfig")
+
+
+def _scale_needs(args):
+    if args.deployment:
+        return ("kube", "kubeconfig")
+    if args.from_nodepool:
+        return ("eks", "kube", "kubeconfig")
+    return ("eks",)
+
+
+def _plan_needs(args):
+    needs = ("kube", "kubeconfig")
+    return needs if args.snapshot else ("eks",) + needs
+
+
+def _simulate_needs(args):
+    needs = () if args.nodepool else _generate_needs(args)
+    return needs if args.pods else needs + ("kube", "kubeconfig")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m sharedlib")
+    parser.add_argument("--startup-only", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--journal", metavar="SPEC",
+                        help="checkpoint journal, configmap:<namespace>/<name> or a file "
+                             "path (default $SHAREDLIB_JOURNAL)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="run under cProfile and write the stats to FILE")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add(name, func, needs, help):
+        sub = subparsers.add_parser(name, help=help)
+        sub.set_defaults(func=func, needs=needs)
+        return sub
+
+    def add_aws(sub, nodegroup=True):
+        sub.add_argument("--cluster", required=True)
+        sub.add_argument("--region", default=None)
+        if nodegroup:
+            sub.add_argument("--nodegroup", required=True)
+
+    def add_generation_modes(sub):
+        sub.add_argument("--nodeclass-mode", choices=("per-nodegroup", "shared"),
+                         default="per-nodegroup",
+                         help="shared: one EC2NodeClass per distinct spec")
+        sub.add_argument("--instance-mode",
+                         choices=("exact", "flexible", "flexible-spot"), default="exact",
+                         help="flexible: allow compatible instance families, sizes and "
+                              "generations from the catalog, flexible-spot: for SPOT "
+                              "node groups only")
+
+    from sharedlib.discovery import add_selector_arguments
+    for name, func, help in (
+            ("list", cmd_list, "list node groups as a JSON array"),
+            ("snapshot", cmd_snapshot,
+             "write a cluster snapshot and list its node groups as a JSON array")):
+        needs = ("eks", "kube", "kubeconfig") if name == "list" else (
+            "eks", "ec2", "kube", "kubeconfig")
+        sub = add(name, func, needs, help)
+        add_aws(sub, nodegroup=False)
+        group = sub.add_mutually_exclusive_group()
+        group.add_argument("--with-nodepool", action="store_true",
+                           help="only node groups already migrated to a NodePool")
+        group.add_argument("--without-nodepool", action="store_true",
+                           help="only node groups without a NodePool")
+        add_selector_arguments(sub)
+        if name == "snapshot":
+            sub.add_argument("--output-file", default="/tmp/snapshot.json",
+                             help="snapshot path, - for stdout")
+
+    for name, func, help in (
+            ("generate", cmd_generate, "print EC2NodeClass and NodePool for a node group"),
+            ("apply", cmd_apply, "generate and apply EC2NodeClass and NodePool")):
+        needs = _generate_needs if name == "generate" else _apply_needs
+        sub = add(name, func, needs, help)
+        add_aws(sub)
+        sub.add_argument("--output", choices=("yaml", "json"), default="yaml")
+        sub.add_argument("--snapshot", metavar="PATH",
+                         help="generate offline from a cluster snapshot, - for stdin")
+        add_generation_modes(sub)
+        sub.add_argument("--disruption", choices=("profile", "default"), default="default",
+                         help="profile: NodePool consolidation and expiry from "
+                              "the node group's pods, default: WhenEmpty after 30s")
+
+    sub = add("render", cmd_render, (),
+              "render node group descriptions to manifests offline")
+    sub.add_argument("--input", default="-",
+                     help="node groups, describe_nodegroup output or snapshot JSON, - for stdin")
+    sub.add_argument("--output", choices=("yaml", "json"), default="yaml")
+    sub.add_argument("--output-dir",
+                     help="write <nodegroup>.yaml files, ie. gitops/platform/karpenter")
+    sub.add_argument("--security-group", action="append",
+                     help="security group for node groups without securityGroups")
+    add_generation_modes(sub)
+
+    sub = add("catalog", cmd_catalog, ("ec2",),
+              "refresh the instance type catalog from describe_instance_types")
+    sub.add_argument("--region", default=None)
+    sub.add_argument("--output-file", required=True,
+                     help="catalog path, use it with SHAREDLIB_CATALOG")
+    sub.add_argument("--family", action="append",
+                     help="only instance types of a family, ie. m6i, repeatable")
+
+    sub = add("scale", cmd_scale, _scale_needs,
+              "scale a node group or a deployment")
+    sub.add_argument("--cluster")
+    sub.add_argument("--region", default=None)
+    sub.add_argument("--nodegroup")
+    sub.add_argument("--min", type=int)
+    sub.add_argument("--max", type=int)
+    sub.add_argument("--desired", type=int)
+    sub.add_argument("--from-nodepool", action="store_true",
+                     help="restore the scaling config saved on the NodePool")
+    sub.add_argument("--deployment")
+    sub.add_argument("--namespace", default="kube-system")
+    sub.add_argument("--replicas", type=int)
+
+    sub = add("drain", cmd_drain, ("kube", "kubeconfig"),
+              "cordon and evict a node group's nodes in waves, print wave timings")
+    sub.add_argument("--cluster")
+    sub.add_argument("--nodegroup", required=True)
+    sub.add_argument("--wave-size", type=int, default=1)
+    sub.add_argument("--concurrency", type=int, default=10,
+                     help="concurrent node patches and evictions per wave")
+    sub.add_argument("--wave-timeout", type=int, default=600,
+                     help="seconds to wait for a wave's pods to be rescheduled")
+
+    sub = add("headroom", cmd_headroom, ("kube", "kubeconfig"),
+              "create (up) or delete (down) pause pod capacity for a node group's NodePool")
+    sub.add_argument("action", choices=("up", "down"))
+    sub.add_argument("--cluster")
+    sub.add_argument("--nodegroup", required=True)
+    sub.add_argument("--timeout", type=int, default=600)
+
+    sub = add("simulate", cmd_simulate, _simulate_needs,
+              "check offline that a node group's NodePool can schedule its pods")
+    sub.add_argument("--cluster")
+    sub.add_argument("--region", default=None)
+    sub.add_argument("--nodegroup", required=True)
+    sub.add_argument("--nodepool", metavar="PATH",
+                     help="NodePool manifest (YAML or JSON), - for stdin, "
+                          "default generate it like `generate`")
+    sub.add_argument("--snapshot", metavar="PATH",
+                     help="generate the NodePool offline from a cluster snapshot")
+    sub.add_argument("--pods", metavar="PATH",
+                     help="kubectl get pods -o json output, - for stdin, "
+                          "default the pods on the node group's nodes")
+    sub.add_argument("--catalog", metavar="PATH",
+                     help="instance type catalog, default the bundled one")
+    sub.set_defaults(nodeclass_mode="per-nodegroup")
+    sub.add_argument("--instance-mode",
+                     choices=("exact", "flexible", "flexible-spot"), default="exact")
+
+    sub = add("rollback", cmd_rollback, ("eks", "kube", "kubeconfig"),
+              "restore node groups and delete their Karpenter resources once "
+              "their nodes are Ready")
+    add_aws(sub, nodegroup=False)
+    sub.add_argument("--nodegroup", action="append",
+                     help="node group to roll back, repeatable, default all matching")
+    add_selector_arguments(sub)
+    sub.add_argument("--deadline", type=int, default=1800,
+                     help="seconds to wait for capacity, Karpenter resources of node "
+                          "groups still without Ready nodes are kept")
+    sub.add_argument("--autoscaler-replicas", type=int,
+                     help="scale the cluster-autoscaler to N after the restores")
+
+    sub = add("profile", cmd_profile, ("eks", "kube", "kubeconfig"),
+              "report the workload profile and the NodePool disruption settings "
+              "chosen for node groups")
+    add_aws(sub, nodegroup=False)
+    sub.add_argument("--nodegroup", action="append",
+                     help="node group to profile, repeatable, default all matching")
+    add_selector_arguments(sub)
+    sub.add_argument("--page-size", type=int, default=500,
+                     help="objects per LIST page")
+
+    sub = add("plan", cmd_plan, _plan_needs,
+              "order node groups into batches migrated one after the other, "
+              "printed as a JSON array")
+    add_aws(sub, nodegroup=False)
+    add_selector_arguments(sub)
+    sub.add_argument("--snapshot", metavar="PATH",
+                     help="node groups from a cluster snapshot, - for stdin")
+    sub.add_argument("--nodegroups", metavar="JSON",
+                     help="plan only the node groups of this JSON array")
+    sub.add_argument("--max-parallel", type=int, default=4,
+                     help="node groups migrated at the same time per batch")
+    sub.add_argument("--max-pods", type=int, default=500,
+                     help="pods evicted per batch")
+    sub.add_argument("--vcpu-headroom", type=lambda value: int(value) if value else None,
+                     help="vCPUs of replacement capacity per batch, a manual input: the "
+                          "EC2 vCPU quota minus the running vCPUs, empty for unbounded")
+    sub.add_argument("--output-file", help="write the plan with the scores as JSON")
+
+    sub = add("verify", cmd_verify, ("kube", "kubeconfig"),
+              "snapshot nodes, pods and NodeClaims, or report on the migration "
+              "against a before snapshot and fail on its gates")
+    sub.add_argument("action", choices=("snapshot", "report"))
+    sub.add_argument("--cluster")
+    sub.add_argument("--before", metavar="PATH", help="report: the snapshot before the migration")
+    sub.add_argument("--after", metavar="PATH",
+                     help="report: the snapshot after the migration, default a live one")
+    sub.add_argument("--output-file", default="/tmp/verify.json",
+                     help="the snapshot, or the report as JSON")
+    sub.add_argument("--gate", action="append", metavar="NAME=VALUE",
+                     help="report: override a gate threshold, or NAME=off, repeatable, ie. "
+                          "new-pending-pods=0, schedule-p90-seconds=300, cost-ratio=1.1")
+    sub.add_argument("--report-only", action="store_true",
+                     help="report: do not fail when a gate fails")
+    sub.add_argument("--page-size", type=int, default=500,
+                     help="objects per LIST page")
+
+    sub = add("journal", cmd_journal, ("kube", "kubeconfig"),
+              "show or reset the checkpoint journal of a cluster")
+    sub.add_argument("action", choices=("show", "reset"))
+    sub.add_argument("--cluster", required=True)
+    sub.add_argument("--nodegroup", help="reset only this node group")
+
+    sub = add("delete", cmd_delete, ("kube", "kubeconfig"),
+              "delete the NodePool and EC2NodeClass of a node group")
+    sub.add_argument("--cluster")
+    sub.add_argument("--nodegroup", required=True)
+
+    return parser
+
+
+def _validate_scale(parser, args):
+    if args.deployment:
+        if args.replicas is None:
+            parser.error("scale --deployment requires --replicas")
+        return
+    if not args.cluster or not args.nodegroup:
+        parser.error("scale requires --cluster and --nodegroup")
+    if not args.from_nodepool and None in (args.min, args.max, args.desired):
+        parser.error("scale requires --min, --max and --desired or --from-nodepool")
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "scale":
+        _validate_scale(parser, args)
+    if args.command == "simulate" and not (args.nodepool or args.snapshot or args.cluster):
+        parser.error("simulate requires --nodepool, --snapshot or --cluster")
+    if args.startup_only:
+        return startup(args)
+    # histograms and spans of the step, exported at exit when
+    # SHAREDLIB_METRICS_FILE, SHAREDLIB_TRACE_FILE or SHAREDLIB_METRICS_PUSH is set
+    from sharedlib import metrics
+    labels = {key: getattr(args, key) for key in ("cluster", "nodegroup")
+              if isinstance(getattr(args, key, None), str)}
+    metrics.configure(grouping=dict(labels, step=args.command))
+    with metrics.profile(args.profile), metrics.span(args.command, **labels):
+        return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
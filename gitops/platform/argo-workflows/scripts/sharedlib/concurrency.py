@@ -0,0 +1,114 @@
+import contextvars
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+DEFAULT_CONCURRENCY = 8
+# statuses of a Result that count as a failure
+FAILED_STATUSES = ("failed", "timeout")
+
+# serialize multi-line output from worker threads so YAML documents
+# and log lines from different node groups do not interleave
+print_lock = threading.Lock()
+
+
+def locked_print(*args, **kwargs):
+    with print_lock:
+        print(*args, **kwargs)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor running each task in a copy of the submitter's
+    context, so worker threads keep its kube context (infra.kube_context)
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class Result:
+    """
+    Outcome of running a task for a single item (ie. a node group)
+    """
+
+    def __init__(self, name, status, value=None, error=None, elapsed=0.0):
+        self.name = name
+        self.status = status
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.status not in FAILED_STATUSES
+
+
+def _run_one(func, name, args):
+    start = time.monotonic()
+    try:
+        value = func(name, *args)
+        # a task may return a status string ("migrated", "skipped", ...)
+        status = value if isinstance(value, str) else "ok"
+        return Result(name, status, value=value, elapsed=time.monotonic() - start)
+    except Exception as e:
+        locked_print("Task for %s failed: %s" % (name, e), file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return Result(name, "failed", error=e, elapsed=time.monotonic() - start)
+
+
+def run_concurrently(func, names, *args, max_workers=DEFAULT_CONCURRENCY):
+    """
+    Run func(name, *args) for each name with at most max_workers in flight.
+
+    A failure for one name is captured in its Result and does not stop
+    the others. Results are returned in the same order as names.
+    """
+    names = list(names)
+    if not names:
+        return []
+    max_workers = max(1, min(int(max_workers), len(names)))
+    results = {}
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_one, func, name, args): name
+                   for name in names}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return [results[name] for name in names]
+
+
+def limited(func, semaphore=None):
+    """
+    Wrap func so every call holds the semaphore, ie. to bound the tasks in
+    flight across several run_concurrently calls
+    """
+    if semaphore is None:
+        return func
+
+    def run(*args, **kwargs):
+        with semaphore:
+            return func(*args, **kwargs)
+    return run
+
+
+def print_summary(results, title="Summary", file=sys.stderr):
+    """
+    Print a per-item summary table and totals by status
+    """
+    totals = {}
+    with print_lock:
+        print("%s:" % title, file=file)
+        for result in results:
+            totals[result.status] = totals.get(result.status, 0) + 1
+            line = "  %-40s %-10s %8.1fs" % (
+                result.name, result.status, result.elapsed)
+            if result.error is not None:
+                line += "  %s" % result.error
+            print(line, file=file)
+        print("  " + ", ".join("%s=%d" % (status, count)
+                               for status, count in sorted(totals.items())),
+              file=file)
+    return totals
@@ -0,0 +1,146 @@
+"""
+Streaming node group discovery
+
+Node group names are read page by page with the `list_nodegroups`
+paginator and described concurrently as they arrive, so the first node
+groups are available before the listing is complete. A NodegroupSelector
+filters on the name before describing and on tags, labels, capacity type
+and AMI type after.
+"""
+
+import fnmatch
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_WORKERS = 8
+
+
+class NodegroupSelector:
+
+    def __init__(self, names=None, tags=None, labels=None, capacity_types=None,
+                 ami_types=None):
+        # names are glob patterns, ie. "team-*"
+        self.names = list(names or [])
+        self.tags = dict(tags or {})
+        self.labels = dict(labels or {})
+        self.capacity_types = [c.upper() for c in capacity_types or []]
+        self.ami_types = list(ami_types or [])
+
+    @property
+    def needs_describe(self):
+        return bool(self.tags or self.labels or self.capacity_types or self.ami_types)
+
+    def match_name(self, nodegroup_name):
+        if not self.names:
+            return True
+        return any(fnmatch.fnmatchcase(nodegroup_name, pattern)
+                   for pattern in self.names)
+
+    def match(self, nodegroup):
+        if not self.match_name(nodegroup['nodegroupName']):
+            return False
+        tags = nodegroup.get('tags') or {}
+        if any(tags.get(k) != v for k, v in self.tags.items()):
+            return False
+        labels = nodegroup.get('labels') or {}
+        if any(labels.get(k) != v for k, v in self.labels.items()):
+            return False
+        if self.capacity_types and nodegroup.get('capacityType') not in self.capacity_types:
+            return False
+        if self.ami_types and not any(fnmatch.fnmatchcase(nodegroup.get('amiType', ''), pattern)
+                                      for pattern in self.ami_types):
+            return False
+        return True
+
+
+def iter_nodegroup_names(eks, cluster):
+    """
+    Yield every node group name of the cluster, following nextToken.
+    A failed page raises, a partial list would skip node groups.
+    """
+    from sharedlib.ratelimit import paginate
+    for page in paginate(eks, 'list_nodegroups', clusterName=cluster):
+        for nodegroup_name in page['nodegroups']:
+            yield nodegroup_name
+
+
+def discover_nodegroups(eks, cluster, selector=None, max_workers=DEFAULT_WORKERS):
+    """
+    Yield the description of every node group matching the selector.
+
+    Names are filtered before describing; describes run concurrently with
+    at most max_workers in flight and are yielded in completion order.
+    """
+    from sharedlib import infra
+    selector = selector or NodegroupSelector()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+
+        def drain(return_when):
+            nonlocal in_flight
+            done, in_flight = wait(in_flight, return_when=return_when)
+            for future in done:
+                nodegroup = future.result()
+                if nodegroup is not None and selector.match(nodegroup):
+                    yield nodegroup
+
+        for nodegroup_name in iter_nodegroup_names(eks, cluster):
+            if not selector.match_name(nodegroup_name):
+                continue
+            in_flight.add(executor.submit(
+                infra.get_node_group, eks, cluster, nodegroup_name))
+            # bound memory and keep results streaming while listing
+            if len(in_flight) >= max_workers * 2:
+                yield from drain(FIRST_COMPLETED)
+        while in_flight:
+            yield from drain(FIRST_COMPLETED)
+
+
+def discover_nodegroup_names(eks, cluster, selector=None, max_workers=DEFAULT_WORKERS):
+    """
+    Yield matching node group names, describing only when the selector needs it
+    """
+    selector = selector or NodegroupSelector()
+    if not selector.needs_describe:
+        for nodegroup_name in iter_nodegroup_names(eks, cluster):
+            if selector.match_name(nodegroup_name):
+                yield nodegroup_name
+        return
+    for nodegroup in discover_nodegroups(eks, cluster, selector, max_workers):
+        yield nodegroup['nodegroupName']
+
+
+def _key_value(items):
+    result = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError("expected key=value, got %r" % item)
+        result[key] = value
+    return result
+
+
+def add_selector_arguments(parser):
+    parser.add_argument("--nodegroup-glob", action="append", dest="nodegroup_globs",
+                        metavar="GLOB", help="only node groups whose name matches (repeatable)")
+    parser.add_argument("--tag", action="append", dest="tags", metavar="KEY=VALUE",
+                        help="only node groups with this tag (repeatable)")
+    parser.add_argument("--label", action="append", dest="labels", metavar="KEY=VALUE",
+                        help="only node groups with this Kubernetes label (repeatable)")
+    parser.add_argument("--capacity-type", action="append", dest="capacity_types",
+                        choices=("ON_DEMAND", "SPOT"))
+    parser.add_argument("--ami-type", action="append", dest="ami_types", metavar="GLOB",
+                        help="only node groups with a matching AMI type, ie. 'AL2_*'")
+
+
+def selector_from_args(args):
+    try:
+        return NodegroupSelector(
+            names=args.nodegroup_globs,
+            tags=_key_value(args.tags),
+            labels=_key_value(args.labels),
+            capacity_types=args.capacity_types,
+            ami_types=args.ami_types)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
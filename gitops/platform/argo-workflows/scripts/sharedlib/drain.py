@@ -0,0 +1,230 @@
+"""
+Wave based, PDB aware node group drain
+
+Instead of scaling a node group straight to zero, which makes EKS evict
+every pod at once, the nodes of a node group are drained in waves:
+
+1.) cordon the nodes of the wave (concurrent node patches)
+2.) evict their pods through the Eviction API, retrying while a
+    PodDisruptionBudget refuses the eviction (HTTP 429)
+3.) wait until the controllers of the evicted pods have their pods
+    Running again on Karpenter nodes before starting the next wave
+
+A wave failing to drain is uncordoned again, its nodes keep serving the
+pods not evicted until the drain is retried.
+
+Only after every wave the caller shrinks the node group scaling config.
+"""
+
+import random
+import sys
+import time
+
+from sharedlib import infra, metrics
+from sharedlib.concurrency import ContextThreadPoolExecutor
+
+NODEGROUP_NODE_LABEL = "eks.amazonaws.com/nodegroup"
+KARPENTER_NODE_LABEL = "karpenter.sh/nodepool"
+
+DEFAULT_WAVE_SIZE = 1
+DEFAULT_CONCURRENCY = 10
+DEFAULT_WAVE_TIMEOUT = 600
+DEFAULT_EVICTION_TIMEOUT = 300
+POLL_INTERVAL = 5
+EVICTION_BACKOFF = 2.0
+EVICTION_MAX_BACKOFF = 30.0
+
+
+class DrainError(Exception):
+    pass
+
+
+def list_nodegroup_nodes(nodegroup_name):
+    core = infra.get_core_api()
+    nodes = core.list_node(
+        label_selector="%s=%s" % (NODEGROUP_NODE_LABEL, nodegroup_name)).items
+    return sorted(node.metadata.name for node in nodes)
+
+
+def list_karpenter_nodes():
+    core = infra.get_core_api()
+    return {node.metadata.name for node in
+            core.list_node(label_selector=KARPENTER_NODE_LABEL).items}
+
+
+def cordon_nodes(node_names, concurrency=DEFAULT_CONCURRENCY, unschedulable=True):
+    # the API has no bulk node patch, one PATCH per node
+    core = infra.get_core_api()
+    body = {"spec": {"unschedulable": unschedulable}}
+    with ContextThreadPoolExecutor(max_workers=max(1, min(concurrency, len(node_names)))) as executor:
+        list(executor.map(lambda name: core.patch_node(name, body), node_names))
+
+
+def _is_evictable(pod):
+    if pod.status.phase in ("Succeeded", "Failed"):
+        return False
+    annotations = pod.metadata.annotations or {}
+    if "kubernetes.io/config.mirror" in annotations:
+        return False
+    for owner in pod.metadata.owner_references or []:
+        if owner.kind == "DaemonSet":
+            return False
+    return True
+
+
+def pods_on_nodes(node_names):
+    core = infra.get_core_api()
+    pods = []
+    for node_name in node_names:
+        pods.extend(pod for pod in core.list_pod_for_all_namespaces(
+            field_selector="spec.nodeName=%s" % node_name).items if _is_evictable(pod))
+    return pods
+
+
+def evict_pod(pod, timeout=DEFAULT_EVICTION_TIMEOUT):
+    """
+    Evict a pod, retrying with backoff while a PDB blocks it
+    """
+    from kubernetes.client.exceptions import ApiException
+    core = infra.get_core_api()
+    body = {
+        "apiVersion": "policy/v1",
+        "kind": "Eviction",
+        "metadata": {"name": pod.metadata.name, "namespace": pod.metadata.namespace},
+    }
+    deadline = time.monotonic() + timeout
+    backoff = EVICTION_BACKOFF
+    retries = 0
+    while True:
+        try:
+            core.create_namespaced_pod_eviction(
+                pod.metadata.name, pod.metadata.namespace, body)
+            return retries
+        except ApiException as e:
+            if e.status == 404:
+                # already gone
+                return retries
+            if e.status != 429 or time.monotonic() + backoff > deadline:
+                raise DrainError("unable to evict %s/%s: %s" %
+                                 (pod.metadata.namespace, pod.metadata.name, e.reason))
+            # disruption budget exhausted, wait for replacement pods
+            retries += 1
+            time.sleep(backoff * random.uniform(0.8, 1.2))
+            backoff = min(backoff * 2, EVICTION_MAX_BACKOFF)
+
+
+def _owner_uid(pod):
+    for owner in pod.metadata.owner_references or []:
+        if owner.controller:
+            return owner.uid
+    return None
+
+
+def wait_for_rescheduled(evicted_pods, timeout=DEFAULT_WAVE_TIMEOUT):
+    """
+    Wait until, for every controller of the evicted pods, as many pods are
+    Running on Karpenter nodes as were evicted and none is Pending
+    """
+    core = infra.get_core_api()
+    expected = {}
+    namespaces = set()
+    for pod in evicted_pods:
+        uid = _owner_uid(pod)
+        if uid is None:
+            # bare pods are not recreated
+            continue
+        expected[uid] = expected.get(uid, 0) + 1
+        namespaces.add(pod.metadata.namespace)
+    if not expected:
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        karpenter_nodes = list_karpenter_nodes()
+        running = {}
+        pending = 0
+        for namespace in namespaces:
+            for pod in core.list_namespaced_pod(namespace).items:
+                uid = _owner_uid(pod)
+                if uid not in expected:
+                    continue
+                if pod.status.phase == "Pending":
+                    pending += 1
+                elif pod.status.phase == "Running" and pod.spec.node_name in karpenter_nodes:
+                    running[uid] = running.get(uid, 0) + 1
+        if not pending and all(running.get(uid, 0) >= count
+                               for uid, count in expected.items()):
+            return
+        if time.monotonic() > deadline:
+            raise DrainError("timed out waiting for %d pending pods to be rescheduled"
+                             % pending)
+        time.sleep(POLL_INTERVAL)
+
+
+def drain_nodegroup(nodegroup_name, wave_size=DEFAULT_WAVE_SIZE,
+                    concurrency=DEFAULT_CONCURRENCY, wave_timeout=DEFAULT_WAVE_TIMEOUT,
+                    eviction_timeout=DEFAULT_EVICTION_TIMEOUT, file=sys.stderr):
+    """
+    Drain the nodes of a node group in waves of wave_size nodes.
+    Returns per wave timings.
+    """
+    wave_size = max(1, wave_size)
+    nodes = list_nodegroup_nodes(nodegroup_name)
+    waves = [nodes[i:i + wave_size] for i in range(0, len(nodes), wave_size)]
+    print("Draining nodegroup %s: %d nodes in %d waves" %
+          (nodegroup_name, len(nodes), len(waves)), file=file)
+    timings = []
+    for number, wave in enumerate(waves, 1):
+        start = time.monotonic()
+        cordon_nodes(wave, concurrency)
+        cordoned = time.monotonic()
+        try:
+            pods = pods_on_nodes(wave)
+            with ContextThreadPoolExecutor(max_workers=max(1, min(concurrency, len(pods) or 1))) as executor:
+                retries = sum(executor.map(
+                    lambda pod: evict_pod(pod, eviction_timeout), pods))
+            evicted = time.monotonic()
+            wait_for_rescheduled(pods, wave_timeout)
+        except Exception as e:
+            print("nodegroup %s wave %d/%d failed, uncordoning %s: %s" %
+                  (nodegroup_name, number, len(waves), ", ".join(wave), e), file=file)
+            cordon_nodes(wave, concurrency, unschedulable=False)
+            raise
+        settled = time.monotonic()
+        timing = {
+            "wave": number,
+            "nodes": wave,
+            "pods": len(pods),
+            "pdb_retries": retries,
+            "cordon_seconds": round(cordoned - start, 2),
+            "evict_seconds": round(evicted - cordoned, 2),
+            "reschedule_seconds": round(settled - evicted, 2),
+            "total_seconds": round(settled - start, 2),
+        }
+        timings.append(timing)
+        wall_start = time.time() - (settled - start)
+        metrics.record_span("drain-cordon", wall_start, cordoned - start)
+        metrics.record_span("drain-evict", wall_start + cordoned - start, evicted - cordoned)
+        metrics.record_span("drain-reschedule", wall_start + evicted - start, settled - evicted)
+        print("nodegroup %s wave %d/%d: %d nodes, %d pods, %d PDB retries, "
+              "cordon %.1fs evict %.1fs reschedule %.1fs total %.1fs" %
+              (nodegroup_name, number, len(waves), len(wave), len(pods), retries,
+               timing["cordon_seconds"], timing["evict_seconds"],
+               timing["reschedule_seconds"], timing["total_seconds"]), file=file)
+    return timings
+
+
+def add_drain_arguments(parser):
+    parser.add_argument("--drain-wave-size", type=int, default=0,
+                        help="drain N nodes per wave before scaling down, 0 to skip")
+    parser.add_argument("--drain-concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="concurrent node patches and evictions per wave")
+    parser.add_argument("--drain-wave-timeout", type=int, default=DEFAULT_WAVE_TIMEOUT,
+                        help="seconds to wait for a wave's pods to be rescheduled")
+
+
+def drain_options_from_args(args):
+    return {
+        "wave_size": args.drain_wave_size,
+        "concurrency": args.drain_concurrency,
+        "wave_timeout": args.drain_wave_timeout,
+    }
@@ -0,0 +1,255 @@
+"""
+Fleet mode: migrate many EKS clusters from one process
+
+A fleet is a comma separated list of clusters, or a file with one cluster
+per line (`#` starts a comment):
+
+    argocon-1:us-east-2                  kube API reached from the EKS endpoint
+    argocon-2:us-east-2:argocon-2-admin  kube API from a kubeconfig context
+
+Every cluster gets its own EKS, EC2 and Kubernetes clients with a
+connection pool sized for the node groups migrated at the same time, and
+its own kube context (infra.kube_context), so the resource index, journal
+and cluster-autoscaler of each cluster stay apart. Clusters run
+concurrently, at most `max_clusters` at a time, each with at most
+`concurrency` node groups in flight, and at most `max_in_flight` node
+groups in flight across the fleet.
+
+    python main.py karpenter --fleet argocon-1:us-east-2,argocon-2:us-east-2
+"""
+
+import base64
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+
+from sharedlib import infra, metrics, ratelimit
+from sharedlib.concurrency import (DEFAULT_CONCURRENCY, Result, print_lock,
+                                   run_concurrently)
+
+DEFAULT_MAX_CLUSTERS = 4
+DEFAULT_MAX_IN_FLIGHT = 16
+# connections next to the node group workers, for the update poller,
+# discovery and the resource index
+POOL_HEADROOM = 4
+TOKEN_PREFIX = "k8s-aws-v1."
+# the presigned URL of a token is valid 15 minutes, refresh well before
+TOKEN_TTL = 600
+
+
+class FleetError(Exception):
+    pass
+
+
+class FleetMember:
+
+    def __init__(self, cluster, region, context=None):
+        self.cluster = cluster
+        self.region = region
+        self.context = context or None
+
+    def __str__(self):
+        return "%s (%s)" % (self.cluster, self.context or self.region)
+
+
+def parse_fleet(spec):
+    """
+    Return the FleetMembers of a `cluster:region[:context]` list or file
+    """
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            entries = [line.split("#", 1)[0] for line in f]
+    else:
+        entries = spec.split(",")
+    members = []
+    for entry in entries:
+        entry = entry.strip()
+        if not entry:
+            continue
+        # kubeconfig contexts may contain ':', ie. EKS cluster ARNs
+        parts = entry.split(":", 2)
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            raise FleetError("invalid fleet entry %r, expected cluster:region[:context]" %
+                             entry)
+        members.append(FleetMember(*parts))
+    if not members:
+        raise FleetError("no cluster in fleet %r" % spec)
+    clusters = [member.cluster for member in members]
+    duplicates = sorted({cluster for cluster in clusters if clusters.count(cluster) > 1})
+    if duplicates:
+        raise FleetError("clusters listed more than once: " + ", ".join(duplicates))
+    return members
+
+
+def aws_client_config(concurrency=DEFAULT_CONCURRENCY):
+    """
+    Return the botocore Config of the clients of a cluster migrated with
+    `concurrency` node groups in flight
+    """
+    return ratelimit.aws_client_config(concurrency + POOL_HEADROOM)
+
+
+class _EksToken:
+    """
+    Bearer token of an EKS cluster, the presigned sts:GetCallerIdentity
+    URL `aws eks get-token` builds, refreshed by the kubernetes client
+    """
+
+    def __init__(self, session, region, cluster):
+        self.cluster = cluster
+        self.sts = session.client('sts', region_name=region)
+        self.sts.meta.events.register(
+            "before-sign.sts.GetCallerIdentity", self._add_cluster_header)
+        self._lock = threading.Lock()
+        self._expires = 0.0
+
+    def _add_cluster_header(self, request, **kwargs):
+        request.headers['x-k8s-aws-id'] = self.cluster
+
+    def token(self):
+        url = self.sts.generate_presigned_url(
+            "get_caller_identity", Params={}, ExpiresIn=60, HttpMethod="GET")
+        return TOKEN_PREFIX + base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+
+    def refresh(self, configuration):
+        with self._lock:
+            if time.monotonic() < self._expires:
+                return
+            configuration.api_key['authorization'] = self.token()
+            self._expires = time.monotonic() + TOKEN_TTL
+
+
+def eks_api_client(session, eks, cluster, region, pool_maxsize=None, context=None):
+    """
+    Return a kubernetes.client.ApiClient talking to the endpoint of an EKS
+    cluster with an IAM token, no kubeconfig needed. The cluster CA is
+    kept in memory, no certificate file is written.
+    """
+    import kubernetes.client
+    description = infra.describe_cluster(eks, cluster)
+    configuration = kubernetes.client.Configuration()
+    configuration.host = description['endpoint']
+    if pool_maxsize:
+        configuration.connection_pool_maxsize = pool_maxsize
+    configuration.api_key_prefix['authorization'] = "Bearer"
+    configuration.refresh_api_key_hook = _EksToken(session, region, cluster).refresh
+    api_client = ratelimit.kube_api_client(context, configuration)
+    # Configuration only takes a CA file, the connections take an SSL
+    # context loaded with the PEM instead
+    pool_kw = api_client.rest_client.pool_manager.connection_pool_kw
+    pool_kw.pop('ca_certs', None)
+    pool_kw['ssl_context'] = ssl.create_default_context(cadata=base64.b64decode(
+        description['certificateAuthority']['data']).decode())
+    return api_client
+
+
+class ClusterClients:
+    """
+    Pooled EKS, EC2 and Kubernetes clients of one fleet member
+    """
+
+    def __init__(self, member, session, concurrency=DEFAULT_CONCURRENCY):
+        config = aws_client_config(concurrency)
+        self.member = member
+        self.eks = session.client('eks', region_name=member.region, config=config)
+        self.ec2 = session.client('ec2', region_name=member.region, config=config)
+        pool_maxsize = concurrency + POOL_HEADROOM
+        if member.context:
+            self.kube_context = member.context
+            api_client = infra.new_kube_api_client(member.context, pool_maxsize)
+        else:
+            self.kube_context = "eks:%s/%s" % (member.region, member.cluster)
+            api_client = eks_api_client(session, self.eks, member.cluster,
+                                        member.region, pool_maxsize, self.kube_context)
+        infra.add_kube_client(self.kube_context, api_client)
+
+
+def run_fleet(members, task, session=None, concurrency=DEFAULT_CONCURRENCY,
+              max_clusters=DEFAULT_MAX_CLUSTERS, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Run task(clients, slots) for every member in its kube context, at most
+    max_clusters at a time. slots is the semaphore a task holds per node
+    group to bound the node groups in flight across the fleet.
+    Returns one Result per cluster, with the task's Results as value.
+    """
+    import boto3
+    session = session or boto3.Session()
+    slots = threading.BoundedSemaphore(max(1, max_in_flight))
+    clients = {}
+    failed = {}
+    # clients are created up front: a boto3 session is not thread safe
+    for member in members:
+        try:
+            clients[member.cluster] = ClusterClients(member, session, concurrency)
+        except Exception as e:
+            print("Unable to create clients for cluster %s: %s" % (member, e),
+                  file=sys.stderr)
+            failed[member.cluster] = Result(member.cluster, "failed", error=e)
+
+    def run_member(cluster):
+        with infra.kube_context(clients[cluster].kube_context), \
+                metrics.labels(cluster=cluster):
+            return task(clients[cluster], slots)
+
+    results = {result.name: result for result in run_concurrently(
+        run_member, list(clients), max_workers=max_clusters)}
+    results.update(failed)
+    return [results[member.cluster] for member in members]
+
+
+def fleet_report(cluster_results, members):
+    """
+    Return the aggregated report of a fleet run: per cluster node group
+    totals by status, and fleet wide totals
+    """
+    regions = {member.cluster: member.region for member in members}
+    clusters = []
+    totals = {}
+    for result in cluster_results:
+        nodegroups = {}
+        for nodegroup_result in result.value or []:
+            nodegroups[nodegroup_result.status] = nodegroups.get(nodegroup_result.status, 0) + 1
+            totals[nodegroup_result.status] = totals.get(nodegroup_result.status, 0) + 1
+        ok = result.ok and all(r.ok for r in result.value or [])
+        clusters.append({
+            "cluster": result.name,
+            "region": regions.get(result.name),
+            "ok": ok,
+            "elapsedSeconds": round(result.elapsed, 1),
+            "nodegroups": nodegroups,
+            "failures": {r.name: str(r.error) for r in result.value or [] if not r.ok},
+            "error": None if result.error is None else str(result.error),
+        })
+    return {
+        "clusters": clusters,
+        "nodegroups": totals,
+        "api": ratelimit.stats(),
+        "ok": all(cluster["ok"] for cluster in clusters),
+    }
+
+
+def print_fleet_report(report, file=sys.stderr):
+    with print_lock:
+        print("Fleet summary:", file=file)
+        for cluster in report["clusters"]:
+            line = "  %-30s %-12s %-6s %8.1fs  %s" % (
+                cluster["cluster"], cluster["region"],
+                "ok" if cluster["ok"] else "failed", cluster["elapsedSeconds"],
+                ", ".join("%s=%d" % item for item in sorted(cluster["nodegroups"].items())))
+            if cluster["error"]:
+                line += "  %s" % cluster["error"]
+            print(line, file=file)
+        failed = sum(1 for cluster in report["clusters"] if not cluster["ok"])
+        print("  clusters: ok=%d, failed=%d; node groups: %s" % (
+            len(report["clusters"]) - failed, failed,
+            ", ".join("%s=%d" % item for item in sorted(report["nodegroups"].items()))),
+            file=file)
+
+
+def write_report(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
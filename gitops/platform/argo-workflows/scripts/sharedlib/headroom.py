@@ -0,0 +1,199 @@
+"""
+Pre-provisioned Karpenter headroom
+
+Before a node group is drained, a low priority pause pod Deployment
+(gitops/platform/karpenter/priorityclass-pause.yaml) sized to the CPU and
+memory requested on the node group's nodes is scheduled on the new
+NodePool. Once the resulting NodeClaims are Ready the workloads are
+evicted and preempt the pause pods instead of waiting for a cold EC2
+launch. The pause Deployment is deleted afterwards.
+"""
+
+import math
+import sys
+import time
+from contextlib import contextmanager
+
+from sharedlib import infra, metrics
+from sharedlib.drain import list_nodegroup_nodes, pods_on_nodes
+
+PAUSE_IMAGE = "public.ecr.aws/eks-distro/kubernetes/pause:3.9"
+PAUSE_PRIORITY_CLASS = "pause-pods"
+PAUSE_NAMESPACE = "default"
+PAUSE_LABEL = "migrate.karpenter.io/pause-for"
+NODEPOOL_LABEL = "karpenter.sh/nodepool"
+# at most this cpu and memory per pause replica, the requests are split
+# evenly over the replicas
+DEFAULT_CHUNK_CPU = 1.0
+DEFAULT_CHUNK_MEMORY = 4 * 1024 ** 3
+DEFAULT_TIMEOUT = 600
+POLL_INTERVAL = 5
+
+
+class HeadroomError(Exception):
+    pass
+
+
+def _parse_quantity(value):
+    from kubernetes.utils import parse_quantity
+    return float(parse_quantity(value))
+
+
+def requested_resources(pods):
+    """
+    Return the (cpu cores, memory bytes) requested by pods
+    """
+    cpu = 0.0
+    memory = 0.0
+    for pod in pods:
+        for container in pod.spec.containers:
+            requests = (container.resources and container.resources.requests) or {}
+            cpu += _parse_quantity(requests.get('cpu', '0'))
+            memory += _parse_quantity(requests.get('memory', '0'))
+    return cpu, memory
+
+
+def pause_deployment_name(nodegroup_name):
+    return "pause-" + nodegroup_name
+
+
+def pause_deployment(nodegroup_name, nodepool, cpu, memory, chunk_cpu=DEFAULT_CHUNK_CPU,
+                     namespace=PAUSE_NAMESPACE, chunk_memory=DEFAULT_CHUNK_MEMORY):
+    """
+    Return the pause Deployment reserving cpu/memory on the NodePool, with
+    enough replicas for the larger of the two, ie. memory only pods
+    """
+    replicas = max(math.ceil(cpu / chunk_cpu), math.ceil(memory / chunk_memory))
+    name = pause_deployment_name(nodegroup_name)
+    labels = {"run": name, PAUSE_LABEL: nodegroup_name}
+    taints = nodepool['spec']['template']['spec'].get('taints') or []
+    tolerations = [{"key": taint['key'], "operator": "Exists", "effect": taint['effect']}
+                   for taint in taints]
+    requests = {}
+    if replicas and cpu > 0:
+        requests["cpu"] = "%dm" % math.ceil(cpu * 1000 / replicas)
+    if replicas and memory > 0:
+        requests["memory"] = str(math.ceil(memory / replicas))
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": name, "namespace": namespace, "labels": labels},
+        "spec": {
+            "replicas": replicas,
+            "selector": {"matchLabels": {"run": name}},
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    "priorityClassName": PAUSE_PRIORITY_CLASS,
+                    "terminationGracePeriodSeconds": 0,
+                    "nodeSelector": {NODEPOOL_LABEL: nodepool['metadata']['name']},
+                    "tolerations": tolerations,
+                    "containers": [{
+                        "name": "reserve-resources",
+                        "image": PAUSE_IMAGE,
+                        "resources": {"requests": requests},
+                    }],
+                },
+            },
+        },
+    }
+
+
+def apply_deployment(deployment):
+    from kubernetes.client.exceptions import ApiException
+    apps = infra.get_apps_api()
+    namespace = deployment['metadata']['namespace']
+    name = deployment['metadata']['name']
+    try:
+        return apps.patch_namespaced_deployment(name, namespace, deployment)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+    return apps.create_namespaced_deployment(namespace, deployment)
+
+
+def nodeclaims_ready(nodepool_name):
+    """
+    Return (ready, total) NodeClaims of a NodePool
+    """
+    api = infra.get_custom_objects_api()
+    claims = api.list_cluster_custom_object(
+        group="karpenter.sh", version="v1beta1", plural="nodeclaims",
+        label_selector="%s=%s" % (NODEPOOL_LABEL, nodepool_name))['items']
+    ready = 0
+    for claim in claims:
+        for condition in claim.get('status', {}).get('conditions') or []:
+            if condition['type'] == "Ready" and condition['status'] == "True":
+                ready += 1
+    return ready, len(claims)
+
+
+def wait_for_headroom(deployment, nodepool_name, timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until every pause replica runs and the NodePool NodeClaims are Ready
+    """
+    apps = infra.get_apps_api()
+    name = deployment['metadata']['name']
+    namespace = deployment['metadata']['namespace']
+    replicas = deployment['spec']['replicas']
+    deadline = time.monotonic() + timeout
+    start = time.monotonic()
+    while True:
+        status = apps.read_namespaced_deployment_status(name, namespace).status
+        ready_replicas = status.ready_replicas or 0
+        ready_claims, claims = nodeclaims_ready(nodepool_name)
+        if ready_replicas >= replicas and ready_claims == claims:
+            print("Headroom for nodepool %s ready: %d pause pods on %d nodeclaims in %.1fs" %
+                  (nodepool_name, replicas, claims, time.monotonic() - start),
+                  file=sys.stderr)
+            return
+        if time.monotonic() > deadline:
+            raise HeadroomError("timed out waiting for headroom on nodepool %s: "
+                                "%d/%d pause pods, %d/%d nodeclaims ready" %
+                                (nodepool_name, ready_replicas, replicas,
+                                 ready_claims, claims))
+        time.sleep(POLL_INTERVAL)
+
+
+def provision(nodegroup_name, nodepool, chunk_cpu=DEFAULT_CHUNK_CPU,
+              namespace=PAUSE_NAMESPACE, timeout=DEFAULT_TIMEOUT):
+    """
+    Create the pause Deployment for a node group and wait for its capacity
+    """
+    cpu, memory = requested_resources(pods_on_nodes(list_nodegroup_nodes(nodegroup_name)))
+    deployment = pause_deployment(nodegroup_name, nodepool, cpu, memory, chunk_cpu, namespace)
+    print("Provisioning headroom for nodegroup %s: %.2f cpu, %.0f MiB in %d pause pods" %
+          (nodegroup_name, cpu, memory / 1024 / 1024, deployment['spec']['replicas']),
+          file=sys.stderr)
+    if deployment['spec']['replicas'] == 0:
+        return deployment
+    apply_deployment(deployment)
+    wait_for_headroom(deployment, nodepool['metadata']['name'], timeout)
+    return deployment
+
+
+def teardown(nodegroup_name, namespace=PAUSE_NAMESPACE):
+    from kubernetes.client.exceptions import ApiException
+    try:
+        infra.get_apps_api().delete_namespaced_deployment(
+            pause_deployment_name(nodegroup_name), namespace)
+        print("Deleted headroom for nodegroup %s" % nodegroup_name, file=sys.stderr)
+    except ApiException as e:
+        if e.status != 404:
+            print("Unable to delete headroom for nodegroup %s: %s" %
+                  (nodegroup_name, e), file=sys.stderr)
+
+
+@contextmanager
+def headroom(nodegroup_name, nodepool, **kwargs):
+    """
+    Keep pre-provisioned capacity on the NodePool for the duration of the block
+    """
+    namespace = kwargs.get('namespace', PAUSE_NAMESPACE)
+    try:
+        with metrics.span("headroom-provision"):
+            provision(nodegroup_name, nodepool, **kwargs)
+        yield
+    finally:
+        with metrics.span("headroom-teardown"):
+            teardown(nodegroup_name, namespace)
@@ -0,0 +1,223 @@
+"""
+Index of existing Karpenter NodePools and EC2NodeClasses
+
+One paginated LIST per kind replaces a GET per node group. Objects are
+keyed by name and by the `migrate.karpenter.io/nodegroup` label, and the
+index can optionally be kept fresh with a watch in a background thread.
+"""
+
+import contextvars
+import sys
+import threading
+import time
+from sharedlib import infra
+from sharedlib.pagination import PAGE_SIZE, list_pages
+from sharedlib.ratelimit import backoff
+
+NODEGROUP_LABEL = "migrate.karpenter.io/nodegroup"
+
+KINDS = {
+    "NodePool": ("karpenter.sh", "v1beta1", "nodepools"),
+    "EC2NodeClass": ("karpenter.k8s.aws", "v1beta1", "ec2nodeclasses"),
+}
+
+
+class ResourceIndex:
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._by_name = {kind: {} for kind in KINDS}
+        self._by_nodegroup = {kind: {} for kind in KINDS}
+        self._resource_version = {}
+        self._watchers = []
+        self.loaded = False
+
+    def load(self, kinds=tuple(KINDS)):
+        """
+        List every NodePool and EC2NodeClass (or only the kinds given), one
+        paginated LIST per kind
+        """
+        api = infra.get_custom_objects_api()
+        for kind in kinds:
+            group, version, plural = KINDS[kind]
+            items = []
+            for page, resource_version in list_pages(
+                    api.list_cluster_custom_object, self.page_size,
+                    group=group, version=version, plural=plural):
+                items.extend(page)
+            with self._lock:
+                self._by_name[kind] = {}
+                self._by_nodegroup[kind] = {}
+                self._resource_version[kind] = resource_version
+                for obj in items:
+                    self._add(kind, obj)
+            print("Indexed %d %s" % (len(items), plural), file=sys.stderr)
+        self.loaded = True
+        return self
+
+    def _add(self, kind, obj):
+        metadata = obj.get('metadata', {})
+        self._by_name[kind][metadata['name']] = obj
+        nodegroup = (metadata.get('labels') or {}).get(NODEGROUP_LABEL)
+        if nodegroup:
+            self._by_nodegroup[kind][nodegroup] = obj
+
+    def _remove(self, kind, name):
+        obj = self._by_name[kind].pop(name, None)
+        if obj is None:
+            return
+        nodegroup = (obj['metadata'].get('labels') or {}).get(NODEGROUP_LABEL)
+        if nodegroup and self._by_nodegroup[kind].get(nodegroup) is obj:
+            del self._by_nodegroup[kind][nodegroup]
+
+    def get(self, name, kind):
+        """
+        Return the object named `name`, None if it does not exist
+        """
+        with self._lock:
+            return self._by_name[kind].get(name)
+
+    def get_for_nodegroup(self, nodegroup_name, kind):
+        """
+        Return the object migrated from a node group, matching on the
+        nodegroup label first and on the name for older objects
+        """
+        with self._lock:
+            obj = self._by_nodegroup[kind].get(nodegroup_name)
+            if obj is None:
+                obj = self._by_name[kind].get(nodegroup_name)
+            return obj
+
+    def nodegroup_names(self, kind):
+        """
+        Return the names of the node groups with a migrated object of kind
+        """
+        with self._lock:
+            return list(self._by_nodegroup[kind])
+
+    def items(self, kind):
+        with self._lock:
+            return list(self._by_name[kind].values())
+
+    def nodepools_referencing(self, node_class_name):
+        """
+        Return the names of the NodePools whose nodeClassRef is node_class_name,
+        NodePools being deleted excluded
+        """
+        with self._lock:
+            return [name for name, nodepool in self._by_name["NodePool"].items()
+                    if nodepool_node_class(nodepool) == node_class_name and
+                    not nodepool['metadata'].get('deletionTimestamp')]
+
+    def record(self, obj):
+        """
+        Update the index after applying an object
+        """
+        with self._lock:
+            self._remove(obj['kind'], obj['metadata']['name'])
+            self._add(obj['kind'], obj)
+
+    def forget(self, name, kind):
+        """
+        Update the index after deleting an object
+        """
+        with self._lock:
+            self._remove(kind, name)
+
+    def start_watch(self):
+        """
+        Keep the index up to date with a watch per kind in background threads
+        """
+        for kind in KINDS:
+            # run in a copy of the caller's context to keep its kube context
+            thread = threading.Thread(
+                target=contextvars.copy_context().run, args=(self._watch, kind), name="index-watch-" + kind,
+                daemon=True)
+            thread.start()
+            self._watchers.append(thread)
+
+    def _watch(self, kind):
+        from kubernetes import watch
+        group, version, plural = KINDS[kind]
+        api = infra.get_custom_objects_api()
+        failures = 0
+        while True:
+            w = watch.Watch()
+            try:
+                for event in w.stream(api.list_cluster_custom_object,
+                                      group=group, version=version, plural=plural,
+                                      resource_version=self._resource_version.get(kind)):
+                    obj = event['object']
+                    with self._lock:
+                        self._resource_version[kind] = obj['metadata'].get(
+                            'resourceVersion')
+                        self._remove(kind, obj['metadata']['name'])
+                        if event['type'] != "DELETED":
+                            self._add(kind, obj)
+                    failures = 0
+                # the server ended the watch, resume from the resource version
+                continue
+            except Exception as e:
+                # resource version too old: relist right away, anything else
+                # (ie. a dropped connection) backs off, the thread must not die
+                if getattr(e, "status", None) != 410:
+                    failures += 1
+                    print("Watch on %s failed: %s" % (plural, e), file=sys.stderr)
+            # events may have been missed, relist
+            while True:
+                if failures:
+                    time.sleep(backoff(failures))
+                try:
+                    self.load()
+                    break
+                except Exception as e:
+                    failures += 1
+                    print("Relisting after the %s watch failed: %s" % (plural, e),
+                          file=sys.stderr)
+
+
+# one index per kube context, see infra.kube_context
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def loaded_index():
+    """
+    Return the index of the current kube context if it was loaded, else None
+    """
+    return _indexes.get(infra.current_kube_context())
+
+
+def get_index(watch=False):
+    """
+    Return the process wide index of the current kube context, loading it
+    on first use
+    """
+    context = infra.current_kube_context()
+    with _index_lock:
+        if context not in _indexes:
+            _indexes[context] = ResourceIndex().load()
+            if watch:
+                _indexes[context].start_watch()
+        return _indexes[context]
+
+
+def nodepool_node_class(nodepool):
+    """
+    Return the name of the EC2NodeClass a NodePool references
+    """
+    return (nodepool.get('spec', {}).get('template', {}).get('spec', {})
+            .get('nodeClassRef') or {}).get('name')
+
+
+def nodepool_scaling_config(nodepool):
+    """
+    Return the node group scalingConfig saved in the NodePool annotations
+    """
+    annotations = nodepool['metadata']['annotations']
+    return {
+        'minSize': int(annotations['migrate.karpenter.io/min']),
+        'maxSize': int(annotations['migrate.karpenter.io/max']),
+        'desiredSize': int(annotations['migrate.karpenter.io/desired'])
+    }
@@ -1,14 +1,35 @@
 from botocore.exceptions import ClientError
+import concurrent.futures
+import contextlib
+import contextvars
 import json
-import time
 import os
 import sys
+import threading
 from datetime import datetime
-import kubernetes.client
-import kubernetes.config as config
+from sharedlib import metrics
+from sharedlib.cache import PINNED_TTL, get_cache
+from sharedlib.poller import NodegroupUpdateError, get_poller
+from sharedlib.ratelimit import aws_call, kube_api_client, paginate
+from sharedlib.render import (get_karpenter_ami_type, render_node_class,  # noqa: F401
+                              render_node_pool, translate_nodegroup_taints)
+
+# kubernetes is imported lazily: importing the client and loading the kube
+# config is the bulk of the start up time of a step, and steps that only
+# talk to EKS never need it.
+_kube_lock = threading.Lock()
+_kube_clients = {}
+# per kube context ApiClient, see kube_context()
+_kube_api_clients = {}
+# kubeconfig context (or EKS cluster, see add_kube_client) the kube clients
+# of the current thread talk to, None for the default kube config
+_kube_context = contextvars.ContextVar("kube_context", default=None)
+# seconds waited past the poller timeout before giving up on an update
+POLLER_GRACE = 60.0
 
 
 def load_kubernetes_configuration():
+    import kubernetes.config as config
     token_path = "/var/run/secrets/kubernetes.io/serviceaccount/token"
     if os.path.exists(token_path):
         print(
@@ -20,189 +41,157 @@ def load_kubernetes_configuration():
         config.load_kube_config()
 
 
-load_kubernetes_configuration()
-api = kubernetes.client.CustomObjectsApi()
+def current_kube_context():
+    return _kube_context.get()
 
 
-def generate_karpenter_node_class(eks, ec2, nodegroup):
+@contextlib.contextmanager
+def kube_context(context):
+    """
+    Make the kube clients of this thread, and of the worker threads started
+    through sharedlib.concurrency, use another kubeconfig context
+    """
+    token = _kube_context.set(context)
+    try:
+        yield
+    finally:
+        _kube_context.reset(token)
+
+
+def add_kube_client(context, api_client):
+    """
+    Register the kubernetes.client.ApiClient of a context, ie. one built
+    from an EKS cluster endpoint instead of the kubeconfig
+    """
+    with _kube_lock:
+        _kube_api_clients[context] = api_client
+        # API objects memoized for a previous client of the context
+        for key in [key for key in _kube_clients if key[0] == context]:
+            del _kube_clients[key]
+
+
+def new_kube_api_client(context, pool_maxsize=None):
+    """
+    Return a kubernetes.client.ApiClient for a kubeconfig context, with
+    at most pool_maxsize pooled connections
+    """
+    import kubernetes.client
+    import kubernetes.config as config
+    configuration = kubernetes.client.Configuration()
+    config.load_kube_config(context=context, client_configuration=configuration)
+    if pool_maxsize:
+        configuration.connection_pool_maxsize = pool_maxsize
+    return kube_api_client(context, configuration)
+
+
+def _kube_api_client(context):
+    # called with _kube_lock held
+    if context not in _kube_api_clients:
+        _kube_api_clients[context] = new_kube_api_client(context)
+    return _kube_api_clients[context]
+
+
+def _get_kube_client(name):
+    """
+    Return a memoized kubernetes.client API object of the current kube
+    context, loading the kube config on first use
+    """
+    context = _kube_context.get()
+    client = _kube_clients.get((context, name))
+    if client is not None:
+        return client
+    with _kube_lock:
+        if (context, name) not in _kube_clients:
+            import kubernetes.client
+            if context is None and None not in _kube_api_clients:
+                load_kubernetes_configuration()
+                # every request goes through sharedlib.ratelimit
+                _kube_api_clients[None] = kube_api_client()
+            _kube_clients[(context, name)] = getattr(kubernetes.client, name)(
+                _kube_api_client(context))
+        return _kube_clients[(context, name)]
+
+
+def get_custom_objects_api():
+    return _get_kube_client("CustomObjectsApi")
+
+
+def get_apps_api():
+    return _get_kube_client("AppsV1Api")
+
+
+def get_core_api():
+    return _get_kube_client("CoreV1Api")
+
+
+def get_policy_api():
+    return _get_kube_client("PolicyV1Api")
+
+
+def __getattr__(name):
+    # keep `infra.api` working for callers written against the eager client
+    if name == "api":
+        return get_custom_objects_api()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def generate_karpenter_node_class(eks, ec2, nodegroup, security_groups=None):
     """
     Generate the Karpenter NodeClass
+
+    security_groups may be passed in (ie. from a cluster snapshot) to
+    generate without calling EC2 and EKS.
     """
-    cluster = nodegroup['clusterName']
-    nodegroup_name = nodegroup['nodegroupName']
-    security_groups = get_nodegroup_sg(eks, ec2, nodegroup)
-    security_groups_map = [{"id": security_group}
-                           for security_group in security_groups]
-    subnets = nodegroup['subnets']
-    subnets_map = [{"id": subnet} for subnet in subnets]
-    karpenter_tags = {
-        "karpenter.sh/discovery": cluster,
-        "migrate.karpenter.io/nodegroup": nodegroup_name
-    }
-    node_group_tags = nodegroup['tags']
-    tags = {**karpenter_tags, **node_group_tags}
-    karpenter_ami_family = nodegroup['amiType']
-    iam_role_arn = nodegroup['nodeRole']
-    iam_role_name = iam_role_arn.split("/")[-1]
-    ami_type = get_karpenter_ami_type(karpenter_ami_family)
-
-    return {
-        "apiVersion": "karpenter.k8s.aws/v1beta1",
-        "kind": "EC2NodeClass",
-        "metadata": {
-            "name": nodegroup_name
-        },
-        "spec": {
-            "amiFamily": ami_type,
-            "role": iam_role_name,
-            "subnetSelectorTerms": subnets_map,
-            "securityGroupSelectorTerms": security_groups_map,
-            "tags": tags
-        }
-    }
-
-
-def generate_karpenter_node_pool(nodegroup):
+    if security_groups is None:
+        security_groups = get_nodegroup_sg(eks, ec2, nodegroup)
+    return render_node_class(nodegroup, security_groups)
+
+
+def generate_karpenter_node_pool(nodegroup, instance_mode="exact", ec2=None,
+                                 disruption=None):
     """
     Generate the Karpenter NodePool
+
+    With an ec2 client, instance types missing from the catalog are
+    described (cached) so limits and flexible requirements cover them.
+    disruption comes from sharedlib.workload.
     """
-    nodegroup_name = nodegroup['nodegroupName']
-    capacity_type = nodegroup['capacityType']
-    # if capacity_type is SPOT set karpenter_capacity_type to "spot"
-    # if capacity_type is ON_DEMAND set karpenter_capacity_type to "on-demand"
-    karpenter_capacity_type = "on-demand" if capacity_type == "ON_DEMAND" else "spot"
-    ami_family = nodegroup['amiType']
-    # if ami_family string contains ARM_64 set karpenter_arch to "arm64" else "amd64"
-    # examples of ami_family string: "AL2_x86_64", "AL2_ARM_64", "BOTTLEROCKET_x86_64", "BOTTLEROCKET_ARM_64"
-    karpenter_arch = "arm64" if "ARM_64" in ami_family else "amd64"
-    instance_types = nodegroup['instanceTypes']
-    new_labels = {"migrate.karpenter.io/nodegroup": nodegroup_name}
-    nodegroup_labels = nodegroup.get('labels') or []
-    labels = {**nodegroup_labels, **new_labels}
-    taints = translate_nodegroup_taints(nodegroup['taints'])
-    min = str(nodegroup['scalingConfig']['minSize'])
-    max = str(nodegroup['scalingConfig']['maxSize'])
-    desired_size = str(nodegroup['scalingConfig']['desiredSize'])
-    instance_hypervisor = "nitro"
-    return {
-        "apiVersion": "karpenter.sh/v1beta1",
-        "kind": "NodePool",
-        "metadata": {
-            "name": nodegroup_name,
-            "annotations": {
-                "migrate.karpenter.io/min": min,
-                "migrate.karpenter.io/max": max,
-                "migrate.karpenter.io/desired": desired_size
-            }
-        },
-        "spec": {
-            "template": {
-                "metadata": {
-                    "labels": labels
-                },
-                "spec": {
-                    "nodeClassRef": {
-                        "name": nodegroup_name
-                    },
-                    "requirements": [
-                        {"key": "karpenter.sh/capacity-type", "operator": "In",
-                         "values": [karpenter_capacity_type]},
-                        {"key": "karpenter.io/arch", "operator": "In",
-                         "values": [karpenter_arch]},
-                        {"key": "karpenter.k8s.aws/instance-hypervisor",
-                         "operator": "In", "values": [instance_hypervisor]},
-                        {"key": "node.kubernetes.io/instance-type",
-                         "operator": "In", "values": instance_types},
-                    ],
-                    "taints": taints
-                }
-            },
-            "limits": {
-                "cpu": 1000
-            },
-            "disruption": {
-                "consolidationPolicy": "WhenEmpty",
-                "consolidateAfter": "30s"
-            }
-        }
-    }
-
-
-def translate_nodegroup_taints(taints):
-    """
-    taints is an array with the following structure for each item dict
-    [
-        {
-            'key': 'string',
-            'value': 'string',
-            'effect': 'NO_SCHEDULE'|'NO_EXECUTE'|'PREFER_NO_SCHEDULE'
-        }
-    ]
-    return the taints with the effect changed to match the following return
-    [
-        {
-            'key': 'string',
-            'value': 'string',
-            'effect': 'NoSchedule'|'NoExecute'|'PreferNoSchedule'
-        }
-    ]
-    """
-    taints_translated = []
-    for taint in taints:
-        if taint['effect'] == 'NO_SCHEDULE':
-            taint['effect'] = 'NoSchedule'
-        elif taint['effect'] == 'NO_EXECUTE':
-            taint['effect'] = 'NoExecute'
-        elif taint['effect'] == 'PREFER_NO_SCHEDULE':
-            taint['effect'] = 'PreferNoSchedule'
-        taints_translated.append(taint)
-    # remove from the taints_translated an item if the key is "migratedfrom" and value is "karpenter"
-    taints_translated = [taint for taint in taints_translated if taint['key']
-                         != 'migratedfrom' and taint['value'] != 'karpenter']
-    return taints_translated
+    from sharedlib.catalog import ensure_instance_types, load_catalog
+    catalog = load_catalog()
+    if ec2 is not None:
+        ensure_instance_types(catalog, ec2, nodegroup['instanceTypes'])
+    return render_node_pool(nodegroup, instance_mode, catalog, disruption)
 
 
 def apply_or_create_custom_object(object, kind):
     """
     Apply or Create Custom Object
 
+    Uses a single server-side apply request and skips the write when the
+    live object has the same content hash, see sharedlib.apply.
     """
-    # if kind is EC2NodeClass, plural is ec2nodeclasses
-    # if kind is NodePool, plural is nodepools
-    # else return None
     if kind not in ["EC2NodeClass", "NodePool"]:
-        print("Kind %s not supported.", kind, file=sys.stderr)
+        print("Kind %s not supported." % kind, file=sys.stderr)
         return None
-    plural = "ec2nodeclasses" if kind == "EC2NodeClass" else "nodepools"
-    try:
-        api_response = api.patch_cluster_custom_object(
-            group=object['apiVersion'].split('/')[0],
-            version=object['apiVersion'].split('/')[1],
-            plural=plural,
-            name=object['metadata']['name'],
-            body=object,
-            field_manager="karpenter-migrator"
-        )
-        print("%s %s updated." %
-              (kind, object['kind']+object['metadata']['name']), file=sys.stderr)
-        return api_response
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            # Custom object doesn't exist, create it
-            api_response = api.create_cluster_custom_object(
-                group=object['apiVersion'].split('/')[0],
-                version=object['apiVersion'].split('/')[1],
-                plural=plural,
-                body=object,
-                pretty='true',
-                field_manager="karpenter-migrator"
-            )
-            print("%s %s created." %
-                  (kind, object['kind']+object['metadata']['name']), file=sys.stderr)
-            return api_response
-        else:
-            print(
-                "Exception when calling CustomObjectsApi->patch_cluster_custom_object: %s\n" % e)
+    from sharedlib.apply import apply_object
+    from sharedlib import index
+    _, api_response = apply_object(object, index.loaded_index())
+    return api_response
+
+
+def _index_record(obj):
+    # keep the resource index, when one is loaded, in sync with our writes
+    from sharedlib import index
+    resources = index.loaded_index()
+    if resources is not None and obj:
+        resources.record(obj)
+
+
+def _index_forget(object_name, kind):
+    from sharedlib import index
+    resources = index.loaded_index()
+    if resources is not None:
+        resources.forget(object_name, kind)
 
 
 def get_custom_object(object_name, kind):
@@ -213,12 +202,19 @@ def get_custom_object(object_name, kind):
     # if kind is EC2NodeClass, plural is ec2nodeclasses
     # if kind is NodePool, plural is nodepools
     # else return None
-    if kind not in ["ECs2NodeClass", "NodePool"]:
-        print("Kind %s not supported.", kind)
+    if kind not in ["EC2NodeClass", "NodePool"]:
+        print("Kind %s not supported." % kind, file=sys.stderr)
         return None
+    # serve from the resource index when one is loaded, see sharedlib.index
+    from sharedlib import index
+    resources = index.loaded_index()
+    if resources is not None:
+        return resources.get(object_name, kind)
     plural = "ec2nodeclasses" if kind == "EC2NodeClass" else "nodepools"
     # if plural is ec2nodeclasses then set group to 'karpenter.k8s.aws' other wise karpenter.sh
     group = "karpenter.k8s.aws" if plural == "ec2nodeclasses" else "karpenter.sh"
+    from kubernetes.client.exceptions import ApiException
+    api = get_custom_objects_api()
     try:
         api_response = api.get_cluster_custom_object(
             group=group,
@@ -227,14 +223,12 @@ def get_custom_object(object_name, kind):
             name=object_name,
         )
         return api_response
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            # Custom object doesn't exist
-            print("%s %s not found" % (kind, object_name), file=sys.stderr)
-            return None
-        else:
-            print(
-                "Exception when calling CustomObjectsApi->patch_cluster_custom_object: %s\n" % e)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        # Custom object doesn't exist
+        print("%s %s not found" % (kind, object_name), file=sys.stderr)
+        return None
 
 
 def delete_custom_object(object_name, kind):
@@ -246,11 +240,13 @@ def delete_custom_object(object_name, kind):
     # if kind is NodePool, plural is nodepools
     # else return None
     if kind not in ["EC2NodeClass", "NodePool"]:
-        print("Kind %s not supported.", kind)
+        print("Kind %s not supported." % kind, file=sys.stderr)
         return None
     plural = "ec2nodeclasses" if kind == "EC2NodeClass" else "nodepools"
     # if plural is ec2nodeclasses then set group to 'karpenter.k8s.aws' other wise karpenter.sh
     group = "karpenter.k8s.aws" if plural == "ec2nodeclasses" else "karpenter.sh"
+    from kubernetes.client.exceptions import ApiException
+    api = get_custom_objects_api()
     try:
         api_response = api.delete_cluster_custom_object(
             group=group,
@@ -259,21 +255,21 @@ def delete_custom_object(object_name, kind):
             name=object_name,
         )
         print("Deleted %s %s " % (kind, object_name))
+        _index_forget(object_name, kind)
         return api_response
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            # Custom object doesn't exist
-            print("%s %s not found" % (kind, object_name), file=sys.stderr)
-            return None
-        else:
-            print(
-                "Exception when calling CustomObjectsApi->patch_cluster_custom_object: %s\n" % e)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        # Custom object doesn't exist
+        print("%s %s not found" % (kind, object_name), file=sys.stderr)
+        return None
 
 # scale deployment cluster-autoscaler-aws-cluster-autoscaler in namespace kube-system to 2 replicas
 
 
 def scale_deployment(deployment_name, namespace, replicas):
-    apps_api = kubernetes.client.AppsV1Api()
+    from kubernetes.client.exceptions import ApiException
+    apps_api = get_apps_api()
     try:
         api_response = apps_api.patch_namespaced_deployment_scale(
             name=deployment_name,
@@ -284,181 +280,217 @@ def scale_deployment(deployment_name, namespace, replicas):
                 }
             }
         )
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            # Custom object doesn't exist
-            print("deployment %s in %s not found" %
-                  (deployment_name, namespace), file=sys.stderr)
-            return None
-        else:
-            print(
-                "Exception when calling CustomObjectsApi->patch_cluster_custom_object: %s\n" % e)
-    return None
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        # Custom object doesn't exist
+        print("deployment %s in %s not found" %
+              (deployment_name, namespace), file=sys.stderr)
+        return None
+    return api_response
 
 
 """
 EKS Managed Node Group Functions
+
+Throttles and retryable errors are retried by sharedlib.ratelimit, any
+other ClientError is raised to the caller.
 """
 
 
-def get_node_group(client, cluster, nodegroup):
-    try:
-        response = client.describe_nodegroup(
-            clusterName=cluster,
-            nodegroupName=nodegroup
-        )
-        return response['nodegroup']
-    except ClientError as e:
-        print(e)
-        return None
+def _region(client):
+    return client.meta.region_name
+
 
+def get_node_group(client, cluster, nodegroup, cached=True):
+    """
+    Return the description of a node group, None when it does not exist
+    """
+    def describe():
+        try:
+            response = aws_call(
+                client, 'describe_nodegroup',
+                clusterName=cluster,
+                nodegroupName=nodegroup
+            )
+            return response['nodegroup']
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ResourceNotFoundException":
+                raise
+            print("Nodegroup %s not found" % nodegroup, file=sys.stderr)
+            return None
+    if not cached:
+        return describe()
+    return get_cache().get_or_call(
+        "describe_nodegroup", "%s/%s/%s" % (_region(client), cluster, nodegroup), describe)
 
-def get_karpenter_ami_type(ami_type):
-    ami_type_map = {
-        "AL2_x86_64": "AL2",
-        "AL2_x86_64_GPU": "AL2",
-        "AL2_ARM_64": "AL2",
-        "CUSTOM": "Custom",
-        "BOTTLEROCKET_ARM_64": "Bottlerocket",
-        "BOTTLEROCKET_x86_64": "Bottlerocket",
-        "BOTTLEROCKET_ARM_64_NVIDIA": "Bottlerocket",
-        "BOTTLEROCKET_x86_64_NVIDIA": "Bottlerocket",
-        "WINDOWS_CORE_2019_x86_64": "Windows2019",
-        "WINDOWS_FULL_2019_x86_64": "Windows2019",
-        "WINDOWS_CORE_2022_x86_64": "Windows2022",
-        "WINDOWS_FULL_2022_x86_64": "Windows2022"
-    }
-    karpenter_ami_type = ami_type_map.get(ami_type, "Custom")
-    return karpenter_ami_type
+
+def describe_cluster(client, cluster):
+    """
+    Return the cached describe_cluster of the EKS cluster
+    """
+    def describe():
+        return aws_call(client, 'describe_cluster', name=cluster)['cluster']
+    return get_cache().get_or_call(
+        "describe_cluster", "%s/%s" % (_region(client), cluster), describe)
+
+
+def get_launch_template_version(client, template_name, template_version):
+    """
+    Return the cached LaunchTemplateData of a launch template version
+
+    Numbered versions are immutable and stay cached for PINNED_TTL,
+    $Latest and $Default for the launch_template_version TTL.
+    """
+    def describe():
+        template = aws_call(
+            client, 'describe_launch_template_versions',
+            LaunchTemplateName=template_name, Versions=[str(template_version)])
+        launch_template = template.get('LaunchTemplateVersions')
+        if not launch_template:
+            return None
+        return launch_template[0].get('LaunchTemplateData') or {}
+    return get_cache().get_or_call(
+        "launch_template_version",
+        "%s/%s/%s" % (_region(client), template_name, template_version), describe,
+        ttl=PINNED_TTL if str(template_version).isdigit() else None)
 
 
-def update_nodegroup(client, **kargs):
+def get_instance_types(client, instance_types):
+    """
+    Return the cached describe_instance_types entries keyed by instance type
+    """
+    cache = get_cache()
+    region = _region(client)
+    result = {}
+    missing = []
+    for instance_type in instance_types:
+        info = cache.get("instance_types", "%s/%s" % (region, instance_type))
+        if info is None:
+            missing.append(instance_type)
+        else:
+            result[instance_type] = info
+    if missing:
+        for page in paginate(client, 'describe_instance_types', token='NextToken',
+                             InstanceTypes=missing):
+            for info in page['InstanceTypes']:
+                cache.set("instance_types", "%s/%s" %
+                          (region, info['InstanceType']), info)
+                result[info['InstanceType']] = info
+    return result
+
+
+def update_nodegroup(client, wait=True, **kargs):
     """
     Method to set the scaling config for the node group
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/eks/client/update_nodegroup_config.html
+
+    With wait=False a Future is returned that resolves once the shared
+    poller sees the update complete, instead of blocking on a waiter.
+    A failed update raises sharedlib.poller.NodegroupUpdateError.
     """
+    response = aws_call(client, 'update_nodegroup_config', **kargs)
+    get_cache().invalidate("describe_nodegroup", "%s/%s/%s" % (
+        _region(client), kargs['clusterName'], kargs['nodegroupName']))
+    # wait for the node group to update
+    future = get_poller(client).track(
+        kargs['clusterName'], kargs['nodegroupName'], response)
+    if not wait:
+        return future
     try:
-        response = client.update_nodegroup_config(**kargs)
-        # wait for the node group to update
-        waiter = client.get_waiter('nodegroup_active')
-        waiter.wait(clusterName=kargs['clusterName'],
-                    nodegroupName=kargs['nodegroupName'])
-        return response
-    except ClientError as e:
-        print(e)
-        return None
+        with metrics.span("nodegroup-update-wait"):
+            # the poller times the update out itself, this is the fallback
+            return future.result(timeout=get_poller(client).timeout + POLLER_GRACE)
+    except concurrent.futures.TimeoutError:
+        raise NodegroupUpdateError(
+            "Timed out waiting for nodegroup %s update" % kargs['nodegroupName']) from None
 
 
-def set_scaling_config_for_nodegroup(client, cluster, nodegroup, scaling_config):
+def set_scaling_config_for_nodegroup(client, cluster, nodegroup, scaling_config, wait=True):
     """
     Method to set the scaling config for the node group
     """
-    try:
-        response = client.update_nodegroup_config(
-            clusterName=cluster,
-            nodegroupName=nodegroup,
-            scalingConfig=scaling_config
-        )
-        # wait for the node group to update
-        waiter = client.get_waiter('nodegroup_active')
-        waiter.wait(clusterName=cluster, nodegroupName=nodegroup)
+    response = update_nodegroup(
+        client,
+        wait=wait,
+        clusterName=cluster,
+        nodegroupName=nodegroup,
+        scalingConfig=scaling_config
+    )
+    if wait and response is not None:
         print("Scaling config set for node group %s" %
               nodegroup, file=sys.stderr)
-
-        return response
-    except ClientError as e:
-        print(e)
-        return None
+    return response
 
 
-def add_taint_to_nodegroup(client, cluster, nodegroup, taints):
+def add_taint_to_nodegroup(client, cluster, nodegroup, taints, wait=True):
     """
     Method to add the taint to the node group
     """
-    try:
-        response = client.update_nodegroup_config(
-            clusterName=cluster,
-            nodegroupName=nodegroup,
-            taints=taints
-        )
-        # wait for the node group to update
-        waiter = client.get_waiter('nodegroup_active')
-        waiter.wait(clusterName=cluster, nodegroupName=nodegroup)
+    response = update_nodegroup(
+        client,
+        wait=wait,
+        clusterName=cluster,
+        nodegroupName=nodegroup,
+        taints=taints
+    )
+    if wait and response is not None:
         print("Taint added to node group %s" % nodegroup, file=sys.stderr)
-
-        return response
-    except ClientError as e:
-        print(e)
-        return None
+    return response
 
 
-def remove_taint_to_nodegroup(client, cluster, nodegroup, taints):
+def remove_taint_to_nodegroup(client, cluster, nodegroup, taints, wait=True):
     """
     Method to remove the taint to the node group
     """
-    try:
-        response = client.update_nodegroup_config(
-            clusterName=cluster,
-            nodegroupName=nodegroup,
-            taints=taints
-        )
-        # wait for the node group to update
-        waiter = client.get_waiter('nodegroup_active')
-        waiter.wait(clusterName=cluster, nodegroupName=nodegroup)
+    response = update_nodegroup(
+        client,
+        wait=wait,
+        clusterName=cluster,
+        nodegroupName=nodegroup,
+        taints=taints
+    )
+    if wait and response is not None:
         print("Taint removed to node group %s" % nodegroup, file=sys.stderr)
-
-        return response
-    except ClientError as e:
-        print(e)
-        return None
+    return response
 
 
 def get_eks_cluster_nodegroups(client, cluster):
     """
-    Return all EKS Cluster NodeGroups
+    Return all EKS Cluster NodeGroups, following nextToken across pages.
+    See sharedlib.discovery to stream and filter large clusters.
     """
-    try:
-        response = client.list_nodegroups(clusterName=cluster)['nodegroups']
-    except ClientError as e:
-        print(e.response['Error']['Message'])
-
-    return response
+    nodegroups = []
+    for page in paginate(client, 'list_nodegroups', clusterName=cluster):
+        nodegroups.extend(page['nodegroups'])
+    return nodegroups
 
 
 def get_nodegroup_sg(eks, ec2, nodegroup):
     """
     Return Security Group for node group
     """
-    template_name = nodegroup['launchTemplate']['name']
-    template_version = nodegroup['launchTemplate']['version']
-    try:
-        template = ec2.describe_launch_template_versions(
-            LaunchTemplateName=template_name, Versions=[template_version])
-        # check if template[0]['LaunchTemplateData']['NetworkInterfaces'][0]['Groups']
-        # if template[0]['LaunchTemplateData']['NetworkInterfaces'][0]['Groups'] is not None, return it
-        # else check template[0]['LaunchTemplateData']['SecurityGroupIds']]
-        # if template[0]['LaunchTemplateData']['SecurityGroupIds'] is not None, return it
-        launch_template = template.get('LaunchTemplateVersions')
-        if launch_template:
-            launch_data = launch_template[0].get('LaunchTemplateData')
-        if launch_data:
-            sg_top = launch_data.get('SecurityGroupIds')
-            network_interfaces = launch_data.get('NetworkInterfaces')
-            if network_interfaces:
-                sg_net = network_interfaces[0].get('Groups')
-                if sg_net is not None:
-                    return sg_net
-                if sg_top is not None:
-                    return sg_top
-
-        # return eks security group
-        cluster = eks.describe_cluster(name=nodegroup['clusterName'])
-        return [cluster['cluster']['resourcesVpcConfig']['clusterSecurityGroupId']]
-
-    except ClientError as e:
-        print(e.response['Error']['Message'])
-
-    return None
+    launch_data = None
+    if nodegroup.get('launchTemplate'):
+        template_name = nodegroup['launchTemplate']['name']
+        template_version = nodegroup['launchTemplate']['version']
+        launch_data = get_launch_template_version(
+            ec2, template_name, template_version)
+    # check if LaunchTemplateData['NetworkInterfaces'][0]['Groups'] is not None, return it
+    # else check LaunchTemplateData['SecurityGroupIds'], if is not None, return it
+    if launch_data:
+        sg_top = launch_data.get('SecurityGroupIds')
+        network_interfaces = launch_data.get('NetworkInterfaces')
+        if network_interfaces:
+            sg_net = network_interfaces[0].get('Groups')
+            if sg_net is not None:
+                return sg_net
+            if sg_top is not None:
+                return sg_top
+
+    # return eks security group
+    cluster = describe_cluster(eks, nodegroup['clusterName'])
+    return [cluster['resourcesVpcConfig']['clusterSecurityGroupId']]
 
 
 """
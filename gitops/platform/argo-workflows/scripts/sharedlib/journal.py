@@ -0,0 +1,240 @@
+"""
+Checkpoint/resume journal for migrations and rollbacks
+
+Records the last completed phase of every node group so a migration or a
+rollback that died partway (evicted pod, waiter timeout, throttling)
+resumes where it stopped instead of starting over:
+
+    migrate:  discovered -> applied -> drained -> scaled-down -> verified
+    rollback: restored -> deleted
+
+The journal of a cluster is a ConfigMap named <name>-<cluster> with one
+key per node group and operation (ie. `migrate.team-a`), so the workflow
+fan-out pods update their own key with a merge patch without overwriting
+each other. When the ConfigMap cannot be used, ie. no kube config, a
+local file is used instead.
+
+    SHAREDLIB_JOURNAL=configmap:argo-workflows/karpenter-migrator-journal
+    SHAREDLIB_JOURNAL=/tmp/journal-{cluster}.json
+"""
+
+import datetime
+import json
+import os
+import sys
+import threading
+
+MIGRATE = "migrate"
+ROLLBACK = "rollback"
+
+DISCOVERED = "discovered"
+APPLIED = "applied"
+DRAINED = "drained"
+SCALED_DOWN = "scaled-down"
+VERIFIED = "verified"
+RESTORED = "restored"
+DELETED = "deleted"
+
+PHASES = {
+    MIGRATE: (DISCOVERED, APPLIED, DRAINED, SCALED_DOWN, VERIFIED),
+    ROLLBACK: (RESTORED, DELETED),
+}
+
+# cluster wide state, ie. the cluster-autoscaler replicas
+STATE_PREFIX = "cluster."
+CONFIGMAP_PREFIX = "configmap:"
+FALLBACK_PATH = "/tmp/karpenter-migrator-journal-{cluster}.json"
+
+
+class JournalError(Exception):
+    pass
+
+
+class ConfigMapStore:
+
+    def __init__(self, namespace, name):
+        self.namespace = namespace
+        self.name = name
+
+    def __str__(self):
+        return "configmap %s/%s" % (self.namespace, self.name)
+
+    def load(self):
+        from kubernetes.client.exceptions import ApiException
+        from sharedlib.infra import get_core_api
+        try:
+            configmap = get_core_api().read_namespaced_config_map(
+                self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return {}
+        return dict(configmap.data or {})
+
+    def put(self, key, value):
+        """
+        Set (or with value None delete) one key, leaving the others untouched
+        """
+        from kubernetes.client.exceptions import ApiException
+        from sharedlib.infra import get_core_api
+        api = get_core_api()
+        body = {"metadata": {"name": self.name, "namespace": self.namespace},
+                "data": {key: value}}
+        try:
+            api.patch_namespaced_config_map(self.name, self.namespace, body)
+            return
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        if value is None:
+            return
+        try:
+            api.create_namespaced_config_map(self.namespace, body)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            # created concurrently by another step
+            api.patch_namespaced_config_map(self.name, self.namespace, body)
+
+
+class FileStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return "file " + self.path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def put(self, key, value):
+        data = self.load()
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class Journal:
+    """
+    Phases of the node groups of one cluster
+    """
+
+    def __init__(self, store, cluster):
+        self.store = store
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self._data = store.load()
+
+    def _key(self, operation, nodegroup_name):
+        return "%s.%s" % (operation, nodegroup_name)
+
+    def get(self, operation, nodegroup_name):
+        value = self._data.get(self._key(operation, nodegroup_name))
+        return json.loads(value) if value else None
+
+    def phase(self, operation, nodegroup_name):
+        entry = self.get(operation, nodegroup_name)
+        return entry['phase'] if entry else None
+
+    def done(self, operation, nodegroup_name, phase):
+        """
+        Return True if phase, or a later one, was recorded
+        """
+        recorded = self.phase(operation, nodegroup_name)
+        if recorded is None:
+            return False
+        phases = PHASES[operation]
+        return phases.index(recorded) >= phases.index(phase)
+
+    def in_progress(self, operation, nodegroup_name):
+        recorded = self.phase(operation, nodegroup_name)
+        return recorded is not None and recorded != PHASES[operation][-1]
+
+    def record(self, operation, nodegroup_name, phase, **details):
+        if phase not in PHASES[operation]:
+            raise JournalError("unknown %s phase %s" % (operation, phase))
+        entry = dict(details, phase=phase,
+                     time=datetime.datetime.now(datetime.timezone.utc).isoformat())
+        self._put(self._key(operation, nodegroup_name),
+                  json.dumps(entry, sort_keys=True, separators=(",", ":")))
+        print("Journal: nodegroup %s %s %s" % (nodegroup_name, operation, phase),
+              file=sys.stderr)
+
+    def forget(self, operation, nodegroup_name):
+        if self._key(operation, nodegroup_name) in self._data:
+            self._put(self._key(operation, nodegroup_name), None)
+
+    def get_state(self, name):
+        return self._data.get(STATE_PREFIX + name)
+
+    def set_state(self, name, value):
+        self._put(STATE_PREFIX + name, None if value is None else str(value))
+
+    def _put(self, key, value):
+        with self._lock:
+            self.store.put(key, value)
+            if value is None:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+
+    def entries(self, operation=None):
+        """
+        Return {operation: {nodegroup: entry}}
+        """
+        result = {}
+        for key, value in sorted(self._data.items()):
+            kind, _, name = key.partition(".")
+            if kind not in PHASES or (operation and kind != operation):
+                continue
+            result.setdefault(kind, {})[name] = json.loads(value)
+        return result
+
+
+def store_from_spec(spec, cluster):
+    if spec.startswith(CONFIGMAP_PREFIX):
+        namespace, _, name = spec[len(CONFIGMAP_PREFIX):].rpartition("/")
+        return ConfigMapStore(namespace or "default", "%s-%s" % (name, cluster))
+    return FileStore(spec.format(cluster=cluster))
+
+
+def open_journal(cluster, spec=None):
+    """
+    Return the Journal of a cluster, from spec or SHAREDLIB_JOURNAL, or
+    None when journaling is not configured. Falls back to a local file
+    when the store cannot be read.
+    """
+    spec = spec or os.environ.get("SHAREDLIB_JOURNAL")
+    if not spec or not cluster:
+        return None
+    store = store_from_spec(spec, cluster)
+    try:
+        return Journal(store, cluster)
+    except Exception as e:
+        fallback = FileStore(FALLBACK_PATH.format(cluster=cluster))
+        print("Unable to read journal %s, using %s: %s" % (store, fallback, e),
+              file=sys.stderr)
+        return Journal(fallback, cluster)
+
+
+def verify_scaled_down(eks, cluster, nodegroup_name):
+    """
+    Return True if EKS reports the node group ACTIVE with no desired nodes
+    """
+    from sharedlib import infra
+    nodegroup = infra.get_node_group(eks, cluster, nodegroup_name, cached=False)
+    return (nodegroup is not None and nodegroup['status'] == "ACTIVE" and
+            nodegroup['scalingConfig']['desiredSize'] == 0)
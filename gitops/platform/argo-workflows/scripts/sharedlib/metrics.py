@@ -0,0 +1,329 @@
+"""
+Latency histograms, phase spans and their export
+
+Every API request (recorded by sharedlib.ratelimit for each attempt) goes
+into a latency histogram per service and operation, and every migration
+phase (`with span("drain"):`) into a duration histogram per phase. Spans
+pick up the cluster and node group labels of the enclosing spans, also
+from worker threads started through sharedlib.concurrency.
+
+At exit the metrics are written as a Prometheus textfile (node exporter
+textfile collector, or pushed to a Pushgateway) and the spans as a Chrome
+trace JSON file (chrome://tracing, ui.perfetto.dev) Argo keeps as an
+artifact:
+
+    SHAREDLIB_METRICS_FILE=/tmp/karpenter-migrator.prom
+    SHAREDLIB_METRICS_PUSH=http://pushgateway.monitoring:9091
+    SHAREDLIB_TRACE_FILE=/tmp/karpenter-migrator-trace.json
+"""
+
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+PREFIX = "karpenter_migrator"
+PUSH_JOB = "karpenter-migrator"
+# seconds, from an API GET up to a node group update
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+           300, 600, 1200)
+# spans kept for the trace, the histograms count them all
+MAX_SPANS = 200000
+
+_labels = contextvars.ContextVar("metrics_labels", default=())
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.spans = []
+        self.dropped_spans = 0
+
+    def observe(self, metric, labels, value):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_span(self, name, category, start, duration, labels):
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append((name, category, start, duration,
+                               threading.get_ident(), labels))
+
+    def exposition(self, extra=None):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        seen = set()
+        for (metric, labels), histogram in histograms:
+            name = "%s_%s" % (PREFIX, metric)
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE %s histogram" % name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    name, _format_labels(labels + (("le", _format_value(bound)),)),
+                    cumulative))
+            lines.append("%s_bucket%s %d" % (
+                name, _format_labels(labels + (("le", "+Inf"),)), histogram.count))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                          _format_value(histogram.sum)))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram.count))
+        for metric, kind, samples in extra or []:
+            name = "%s_%s" % (PREFIX, metric)
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, _format_labels(tuple(sorted(labels.items()))),
+                                          _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def trace(self):
+        """
+        Return the spans as a Chrome trace event document
+        """
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": name, "cat": category, "ph": "X",
+            "ts": round((start - self.started) * 1e6), "dur": round(duration * 1e6),
+            "pid": os.getpid(), "tid": tid, "args": dict(labels),
+        } for name, category, start, duration, tid, labels in spans]
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"started": self.started, "droppedSpans": self.dropped_spans}}
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                                         .replace('"', '\\"').replace("\n", "\\n"))
+                             for key, value in labels)
+
+
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def current_labels():
+    return dict(_labels.get())
+
+
+@contextlib.contextmanager
+def labels(**values):
+    """
+    Add labels (ie. cluster) to the spans and API calls of the block
+    """
+    token = _labels.set(tuple(sorted(dict(_labels.get(), **values).items())))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextlib.contextmanager
+def span(phase, **values):
+    """
+    Time the block as a phase, labelled with the enclosing labels and
+    values. The status label is "failed" when the block raises.
+    """
+    with labels(**values):
+        start = time.time()
+        started = time.monotonic()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            record_span(phase, start, time.monotonic() - started, status=status)
+
+
+def record_span(phase, start, duration, **values):
+    """
+    Record a phase measured by the caller, ie. a node group time-to-capacity
+    """
+    span_labels = dict(_labels.get(), **values)
+    _registry.add_span(phase, "phase", start, duration, span_labels)
+    # node group names stay in the trace, they would explode the series
+    _registry.observe("phase_duration_seconds", dict(
+        {key: value for key, value in span_labels.items() if key != "nodegroup"},
+        phase=phase), duration)
+
+
+def traced(phase, func, label="nodegroup"):
+    """
+    Wrap func(name, *args) in a span labelled with label=name, ie. for
+    run_concurrently
+    """
+    def run(name, *args, **kwargs):
+        with span(phase, **{label: name}):
+            return func(name, *args, **kwargs)
+    return run
+
+
+def observe_api(bucket, operation, duration, outcome):
+    """
+    Record the latency of one API request attempt
+    """
+    service = bucket.partition("/")[0]
+    api_labels = {"service": service, "operation": operation, "outcome": outcome}
+    cluster = dict(_labels.get()).get("cluster")
+    if cluster:
+        api_labels["cluster"] = cluster
+    _registry.observe("api_request_duration_seconds", api_labels, duration)
+    _registry.add_span(operation, "api", time.time() - duration, duration,
+                       dict(_labels.get(), service=bucket, outcome=outcome))
+
+
+def exposition():
+    """
+    Return the histograms and the sharedlib.ratelimit counters in the
+    Prometheus text format
+    """
+    from sharedlib import ratelimit
+    counters = ratelimit.stats()
+    extra = [("api_%s_total" % counter, "counter",
+              [({"bucket": bucket}, values[counter]) for bucket, values in counters.items()])
+             for counter in ("calls", "throttles", "retries", "failures")]
+    extra.append(("api_token_wait_seconds_total", "counter",
+                  [({"bucket": bucket}, values["waitedSeconds"])
+                   for bucket, values in counters.items()]))
+    return _registry.exposition([metric for metric in extra if metric[2]])
+
+
+def write_textfile(path):
+    """
+    Write the exposition atomically, for the node exporter textfile collector
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(exposition())
+    os.replace(tmp, path)
+
+
+def push(url, job=PUSH_JOB, grouping=None):
+    """
+    PUT the exposition to a Pushgateway
+    """
+    import urllib.request
+    target = "%s/metrics/job/%s" % (url.rstrip("/"), job)
+    for key, value in sorted((grouping or {}).items()):
+        target += "/%s/%s" % (key, value)
+    request = urllib.request.Request(target, data=exposition().encode(), method="PUT",
+                                     headers={"Content-Type": "text/plain; version=0.0.4"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+def write_trace(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(_registry.trace(), f, separators=(",", ":"))
+
+
+def _export(metrics_file, trace_file, push_url, grouping):
+    try:
+        if metrics_file:
+            write_textfile(metrics_file)
+            print("Metrics written to %s" % metrics_file, file=sys.stderr)
+        if trace_file:
+            write_trace(trace_file)
+            print("Trace written to %s" % trace_file, file=sys.stderr)
+        if push_url:
+            push(push_url, grouping=grouping)
+    except Exception as e:
+        print("Unable to export metrics: %s" % e, file=sys.stderr)
+
+
+def configure(metrics_file=None, trace_file=None, push_url=None, grouping=None):
+    """
+    Export the metrics and the trace at exit, to the given paths or the
+    SHAREDLIB_METRICS_FILE, SHAREDLIB_TRACE_FILE and SHAREDLIB_METRICS_PUSH ones
+    """
+    metrics_file = metrics_file or os.environ.get("SHAREDLIB_METRICS_FILE")
+    trace_file = trace_file or os.environ.get("SHAREDLIB_TRACE_FILE")
+    push_url = push_url or os.environ.get("SHAREDLIB_METRICS_PUSH")
+    if metrics_file or trace_file or push_url:
+        atexit.register(_export, metrics_file, trace_file, push_url, grouping)
+
+
+@contextlib.contextmanager
+def profile(path=None, limit=25, file=sys.stderr):
+    """
+    Run the block under cProfile, dumping the stats of all threads to path
+    (for snakeviz, pstats) and printing the top functions by cumulative time
+    """
+    if not path:
+        yield
+        return
+    import cProfile
+    import pstats
+    profilers = [cProfile.Profile()]
+    if sys.version_info < (3, 12):
+        # before 3.12 cProfile only sees the thread that enabled it: start
+        # one profiler in every thread started from now on
+        def start_thread_profiler(*args):
+            profiler = cProfile.Profile()
+            profilers.append(profiler)
+            profiler.enable()
+        threading.setprofile(start_thread_profiler)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profilers[0], stream=file)
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        print("Profile of %d threads written to %s" % (len(profilers), path), file=file)
+        stats.sort_stats("cumulative").print_stats(limit)
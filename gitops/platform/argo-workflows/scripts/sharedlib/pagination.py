@@ -0,0 +1,39 @@
+"""
+Paginated Kubernetes LISTs
+
+LISTs are sent with `limit` and followed with `continue`, so one page at a
+time is held in memory, for the typed clients (ie. CoreV1Api.list_node)
+and the CustomObjectsApi alike.
+"""
+
+PAGE_SIZE = 500
+
+
+def list_pages(list_func, page_size=PAGE_SIZE, **kwargs):
+    """
+    Yield (items, resourceVersion) per page of a LIST. Items are models
+    for the typed clients and dicts for custom objects.
+    """
+    _continue = None
+    while True:
+        if _continue:
+            kwargs["_continue"] = _continue
+        response = list_func(limit=page_size, **kwargs)
+        if isinstance(response, dict):
+            metadata = response.get('metadata') or {}
+            _continue = metadata.get('continue')
+            yield response.get('items', []), metadata.get('resourceVersion')
+        else:
+            _continue = response.metadata._continue
+            yield response.items, response.metadata.resource_version
+        if not _continue:
+            return
+
+
+def paginate(api, list_func, page_size=PAGE_SIZE, **kwargs):
+    """
+    Yield the items of a LIST page by page as dicts, keeping one page in
+    memory
+    """
+    for items, _ in list_pages(list_func, page_size, **kwargs):
+        yield from api.api_client.sanitize_for_serialization(items)
@@ -0,0 +1,286 @@
+"""
+Migration planner: ordered batches of node groups
+
+Instead of migrating every node group at once, node groups are scored from
+one LIST of the cluster's nodes, pods and PodDisruptionBudgets and packed
+into batches migrated one after the other, the node groups of a batch in
+parallel:
+
+- node groups running system-critical workloads (CoreDNS, system priority
+  classes) are migrated last, one per batch, once Karpenter capacity has
+  been proven by the app node groups
+- node groups running the Karpenter controller are held: the controller
+  must not run on capacity it manages. They are listed last as a skipped
+  batch, so they show in the workflow instead of being silently left out
+- node groups with pods of the same tight PodDisruptionBudget (few
+  disruptions allowed) are never in the same batch, their evictions would
+  compete for the same budget; PDB-bound node groups get half the
+  parallelism
+- a batch evicts at most `max_pods` pods, bounding the eviction load on
+  the API server, and adds at most `vcpu_headroom` vCPUs of replacement
+  capacity. The headroom is a manual input, the EC2 vCPU quota (Service
+  Quotas) minus the vCPUs already running, unbounded when not given
+
+Larger node groups are placed first so batches finish at the same time.
+
+    python -m sharedlib plan --cluster argocon-1 --snapshot /tmp/snapshot.json --max-parallel 4
+
+prints the batches as a JSON array for an Argo `withParam`:
+
+    [{"batch": 1, "parallelism": 2, "nodegroups": ["team-a", "team-b"], "skipped": false, ...},
+     ..., {"batch": 4, "nodegroups": ["system"], "skipped": true, ...}]
+"""
+
+import json
+import math
+import sys
+
+from sharedlib.drain import NODEGROUP_NODE_LABEL
+from sharedlib.pagination import PAGE_SIZE, paginate
+from sharedlib.pods import is_daemonset_pod, is_finished
+
+DEFAULT_MAX_PARALLEL = 4
+DEFAULT_MAX_PODS = 500
+SYSTEM_PRIORITY_CLASSES = ("system-cluster-critical", "system-node-critical")
+CRITICAL_LABELS = (("k8s-app", "kube-dns"), ("eks.amazonaws.com/component", "coredns"))
+KARPENTER_LABELS = (("app.kubernetes.io/name", "karpenter"),)
+# a PDB allowing at most this many disruptions is tight
+TIGHT_DISRUPTIONS = 1
+
+
+class NodegroupScore:
+
+    def __init__(self, name, vcpus=0):
+        self.name = name
+        self.vcpus = vcpus
+        self.pods = 0
+        self.critical = []
+        self.karpenter = False
+        # tight PDB (namespace/name) -> pods of this node group it covers
+        self.tight_pdbs = {}
+        # tight PDB (namespace/name) -> disruptions it allows
+        self.pdb_allowed = {}
+        self.tightness = 0.0
+
+    @property
+    def is_critical(self):
+        return bool(self.critical)
+
+    def as_dict(self):
+        return {"pods": self.pods, "vcpus": self.vcpus, "critical": self.critical,
+                "tightness": round(self.tightness, 2), "tightPdbs": sorted(self.tight_pdbs)}
+
+
+class Batch:
+
+    def __init__(self, max_parallel, critical=False):
+        self.max_parallel = max_parallel
+        self.critical = critical
+        self.nodegroups = []
+        self.pods = 0
+        self.vcpus = 0
+        self.pdbs = set()
+
+    def fits(self, score, max_pods, vcpu_headroom):
+        if self.critical or len(self.nodegroups) >= self.max_parallel:
+            return False
+        if self.pdbs & set(score.tight_pdbs):
+            return False
+        # a node group larger than the bounds still gets a batch of its own
+        if self.pods + score.pods > max_pods:
+            return False
+        if vcpu_headroom is not None and self.vcpus + score.vcpus > vcpu_headroom:
+            return False
+        return True
+
+    def add(self, score):
+        self.nodegroups.append(score.name)
+        self.pods += score.pods
+        self.vcpus += score.vcpus
+        self.pdbs.update(score.tight_pdbs)
+
+
+def selector_matches(selector, labels):
+    """
+    Evaluate a metav1.LabelSelector (matchLabels, matchExpressions) against labels
+    """
+    if not selector:
+        return False
+    for key, value in (selector.get('matchLabels') or {}).items():
+        if labels.get(key) != value:
+            return False
+    for expression in selector.get('matchExpressions') or []:
+        key, operator = expression['key'], expression['operator']
+        values = expression.get('values') or []
+        if operator == "In" and labels.get(key) not in values:
+            return False
+        if operator == "NotIn" and key in labels and labels[key] in values:
+            return False
+        if operator == "Exists" and key not in labels:
+            return False
+        if operator == "DoesNotExist" and key in labels:
+            return False
+    return True
+
+
+def nodegroup_vcpus(nodegroup, catalog=None):
+    """
+    Return the vCPUs of a node group's desired nodes, sized by its first
+    instance type
+    """
+    from sharedlib.catalog import load_catalog
+    catalog = catalog or load_catalog()
+    desired = (nodegroup.get('scalingConfig') or {}).get('desiredSize') or 0
+    for instance_type in nodegroup.get('instanceTypes') or []:
+        info = catalog.get(instance_type)
+        if info is not None:
+            return desired * info["vcpu"]
+    return 0
+
+
+def _critical_reason(pod):
+    metadata = pod.get('metadata') or {}
+    labels = metadata.get('labels') or {}
+    name = "%s/%s" % (metadata.get('namespace'), metadata.get('name'))
+    if (pod.get('spec') or {}).get('priorityClassName') in SYSTEM_PRIORITY_CLASSES:
+        return name
+    if any(labels.get(key) == value for key, value in CRITICAL_LABELS):
+        return name
+    return None
+
+
+def score_nodegroups(nodegroups, nodes, pods, pdbs, catalog=None):
+    """
+    Return a NodegroupScore per node group from the nodes, pods and PDBs
+    of the cluster (Kubernetes objects as dicts). DaemonSet and finished
+    pods are not counted, they are not evicted.
+    """
+    scores = {name: NodegroupScore(name, nodegroup_vcpus(nodegroup, catalog))
+              for name, nodegroup in nodegroups.items()}
+    node_groups = {}
+    for node in nodes:
+        metadata = node.get('metadata') or {}
+        nodegroup_name = (metadata.get('labels') or {}).get(NODEGROUP_NODE_LABEL)
+        if nodegroup_name in scores:
+            node_groups[metadata.get('name')] = nodegroup_name
+    tight = [pdb for pdb in pdbs
+             if (pdb.get('status') or {}).get('disruptionsAllowed', 0) <= TIGHT_DISRUPTIONS]
+    for pod in pods:
+        score = scores.get(node_groups.get((pod.get('spec') or {}).get('nodeName')))
+        if score is None or is_daemonset_pod(pod) or is_finished(pod):
+            continue
+        score.pods += 1
+        metadata = pod.get('metadata') or {}
+        labels = metadata.get('labels') or {}
+        if any(labels.get(key) == value for key, value in KARPENTER_LABELS):
+            score.karpenter = True
+        reason = _critical_reason(pod)
+        if reason is not None:
+            score.critical.append(reason)
+        for pdb in tight:
+            pdb_metadata = pdb.get('metadata') or {}
+            if pdb_metadata.get('namespace') != metadata.get('namespace'):
+                continue
+            if selector_matches((pdb.get('spec') or {}).get('selector'), labels):
+                key = "%s/%s" % (pdb_metadata.get('namespace'), pdb_metadata.get('name'))
+                score.tight_pdbs[key] = score.tight_pdbs.get(key, 0) + 1
+                score.pdb_allowed[key] = (pdb.get('status') or {}).get('disruptionsAllowed', 0)
+    for score in scores.values():
+        for key, count in score.tight_pdbs.items():
+            # evictions needed per allowed disruption, ie. sequential PDB waits
+            score.tightness = max(score.tightness, count / max(1, score.pdb_allowed[key]))
+    return scores
+
+
+def plan_batches(scores, max_parallel=DEFAULT_MAX_PARALLEL, max_pods=DEFAULT_MAX_PODS,
+                 vcpu_headroom=None):
+    """
+    Pack the scored node groups into ordered batches. Returns the batches
+    and the held node groups with the reason they are held.
+    """
+    max_parallel = max(1, max_parallel)
+    reduced_parallel = max(1, math.ceil(max_parallel / 2))
+    held = {name: "runs the Karpenter controller" for name, score in scores.items()
+            if score.karpenter}
+    order = sorted((score for score in scores.values() if score.name not in held),
+                   key=lambda score: (score.is_critical, score.tightness > 0,
+                                      -score.pods, score.name))
+    batches = []
+    for score in order:
+        if score.is_critical:
+            batch = Batch(1, critical=True)
+            batch.add(score)
+            batches.append(batch)
+            continue
+        # PDB-bound node groups only join batches of the reduced parallelism
+        parallel = reduced_parallel if score.tightness > 0 else max_parallel
+        batch = next((batch for batch in batches
+                      if batch.max_parallel <= parallel and
+                      batch.fits(score, max_pods, vcpu_headroom)), None)
+        if batch is None:
+            batch = Batch(parallel)
+            batches.append(batch)
+        batch.add(score)
+    return batches, held
+
+
+def build_plan(cluster, scores, batches, held):
+    """
+    Return the plan, the held node groups as a last skipped batch
+    """
+    entries = [{
+        "batch": number,
+        "parallelism": len(batch.nodegroups),
+        "nodegroups": batch.nodegroups,
+        "pods": batch.pods,
+        "vcpus": batch.vcpus,
+        "critical": batch.critical,
+        "skipped": False,
+    } for number, batch in enumerate(batches, 1)]
+    if held:
+        nodegroups = sorted(held)
+        entries.append({
+            "batch": len(entries) + 1,
+            "parallelism": 0,
+            "nodegroups": nodegroups,
+            "pods": sum(scores[name].pods for name in nodegroups),
+            "vcpus": sum(scores[name].vcpus for name in nodegroups),
+            "critical": False,
+            "skipped": True,
+        })
+    return {
+        "cluster": cluster,
+        "batches": entries,
+        "held": held,
+        "scores": {name: score.as_dict() for name, score in sorted(scores.items())},
+    }
+
+
+def live_cluster_objects(page_size=PAGE_SIZE):
+    """
+    Return the nodes, pods and PodDisruptionBudgets of the cluster as
+    dicts, each streamed from a paginated LIST
+    """
+    from sharedlib import infra
+    core = infra.get_core_api()
+    policy = infra.get_policy_api()
+    return (paginate(core, core.list_node, page_size, label_selector=NODEGROUP_NODE_LABEL),
+            paginate(core, core.list_pod_for_all_namespaces, page_size),
+            paginate(policy, policy.list_pod_disruption_budget_for_all_namespaces, page_size))
+
+
+def print_plan(plan, file=sys.stderr):
+    print("Migration plan for cluster %s:" % plan["cluster"], file=file)
+    for batch in plan["batches"]:
+        print("  batch %-3d %-8s pods=%-5d vcpus=%-5d %s" % (
+            batch["batch"], "skipped" if batch["skipped"] else
+            "critical" if batch["critical"] else "",
+            batch["pods"], batch["vcpus"], ", ".join(batch["nodegroups"])), file=file)
+    for name, reason in sorted(plan["held"].items()):
+        print("  held      %s: %s, not migrated" % (name, reason), file=file)
+
+
+def write_plan(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,55 @@
+"""
+Pod helpers shared by the simulator, the planner and the reports
+
+Kept free of NumPy so modules that only read pods do not import it.
+"""
+
+from functools import lru_cache
+
+MIB = 1024 * 1024
+
+
+@lru_cache(maxsize=4096)
+def _parse_quantity(value):
+    from kubernetes.utils import parse_quantity
+    return float(parse_quantity(value))
+
+
+def quantity(value):
+    """
+    Return a Kubernetes quantity as a float, 0 when missing
+    """
+    return _parse_quantity(str(value)) if value is not None else 0.0
+
+
+def _requests(containers, resource):
+    return [quantity(((c.get('resources') or {}).get('requests') or {}).get(resource))
+            for c in containers or []]
+
+
+def pod_request(pod, resource):
+    """
+    Return the effective request of a pod, the sum over its containers or
+    the largest init container, plus the pod overhead
+    """
+    spec = pod.get('spec') or {}
+    request = max([sum(_requests(spec.get('containers'), resource))] +
+                  _requests(spec.get('initContainers'), resource))
+    overhead = (spec.get('overhead') or {}).get(resource)
+    if overhead is not None:
+        request += quantity(overhead)
+    return request
+
+
+def pod_name(pod):
+    metadata = pod.get('metadata') or {}
+    return "%s/%s" % (metadata.get('namespace', 'default'), metadata.get('name'))
+
+
+def is_daemonset_pod(pod):
+    return any(owner.get('kind') == "DaemonSet"
+               for owner in (pod.get('metadata') or {}).get('ownerReferences') or [])
+
+
+def is_finished(pod):
+    return (pod.get('status') or {}).get('phase') in ("Succeeded", "Failed")
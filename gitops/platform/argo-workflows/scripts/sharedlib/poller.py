@@ -0,0 +1,205 @@
+"""
+Shared Node Group update poller
+
+One background thread tracks every pending `update_nodegroup_config`
+update for an EKS client instead of one `nodegroup_active` waiter (and
+one blocked thread) per call. Each update is polled with `describe_update`
+on its own adaptive schedule: the interval grows while the update is
+InProgress and is jittered so many node groups do not poll in lockstep.
+Once the update is Successful the node group is confirmed ACTIVE with
+`describe_nodegroup` before the future resolves.
+
+The poller only needs a boto3 EKS client, so it can be exercised against
+a local fake EKS endpoint (ie. moto server) by creating the client with
+`endpoint_url=`.
+"""
+
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from sharedlib.ratelimit import aws_call, classify
+
+
+MIN_INTERVAL = 5.0
+MAX_INTERVAL = 60.0
+BACKOFF_FACTOR = 1.5
+JITTER = 0.2
+# same budget as the boto3 nodegroup_active waiter (40 attempts x 30s)
+DEFAULT_TIMEOUT = 1200.0
+
+FAILED_STATUSES = ("Failed", "Cancelled")
+
+
+class NodegroupUpdateError(Exception):
+    pass
+
+
+class _PendingUpdate:
+
+    def __init__(self, cluster, nodegroup, update_id, response, future, deadline):
+        self.cluster = cluster
+        self.nodegroup = nodegroup
+        self.update_id = update_id
+        self.response = response
+        self.future = future
+        self.deadline = deadline
+        self.interval = MIN_INTERVAL
+        self.next_poll = 0.0
+        # set once describe_update reports Successful
+        self.update_done = False
+
+
+class NodegroupUpdatePoller:
+    """
+    Track many pending node group updates with a single polling thread
+    """
+
+    def __init__(self, client, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 timeout=DEFAULT_TIMEOUT):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.api_calls = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def track(self, cluster, nodegroup, response):
+        """
+        Track the update returned by update_nodegroup_config.
+        Returns a Future resolving to the original response.
+        """
+        future = Future()
+        now = time.monotonic()
+        pending = _PendingUpdate(
+            cluster, nodegroup, response['update']['id'], response, future,
+            now + self.timeout)
+        pending.interval = self.min_interval
+        pending.next_poll = now + self._jittered(self.min_interval)
+        with self._cond:
+            self._pending.append(pending)
+            self._ensure_thread()
+            self._cond.notify()
+        return future
+
+    def wait_active(self, cluster, nodegroup):
+        """
+        Return a Future resolving once the node group is ACTIVE,
+        for callers that do not have an update id.
+        """
+        future = Future()
+        now = time.monotonic()
+        pending = _PendingUpdate(cluster, nodegroup, None, None, future,
+                                 now + self.timeout)
+        pending.update_done = True
+        pending.interval = self.min_interval
+        with self._cond:
+            self._pending.append(pending)
+            self._ensure_thread()
+            self._cond.notify()
+        return future
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="nodegroup-update-poller", daemon=True)
+            self._thread.start()
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending:
+                    # exit when idle, track() restarts the thread
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [p for p in self._pending if p.next_poll <= now]
+                if not due:
+                    next_poll = min(p.next_poll for p in self._pending)
+                    self._cond.wait(timeout=next_poll - now)
+                    continue
+            for pending in due:
+                if self._poll(pending):
+                    with self._cond:
+                        self._pending.remove(pending)
+
+    def _poll(self, pending):
+        """
+        Poll one pending update, return True when its future is resolved
+        """
+        now = time.monotonic()
+        if now >= pending.deadline:
+            pending.future.set_exception(NodegroupUpdateError(
+                "Timed out waiting for nodegroup %s update %s" %
+                (pending.nodegroup, pending.update_id)))
+            return True
+        try:
+            if not pending.update_done:
+                self.api_calls += 1
+                # throttles are backed off below, on the update's own schedule
+                update = aws_call(
+                    self.client, 'describe_update', max_attempts=1, caller_retries=True,
+                    name=pending.cluster,
+                    nodegroupName=pending.nodegroup,
+                    updateId=pending.update_id)['update']
+                status = update['status']
+                if status in FAILED_STATUSES:
+                    errors = update.get('errors') or []
+                    pending.future.set_exception(NodegroupUpdateError(
+                        "Nodegroup %s update %s %s: %s" %
+                        (pending.nodegroup, pending.update_id, status,
+                         "; ".join(e.get('errorMessage', '') for e in errors))))
+                    return True
+                if status == "Successful":
+                    pending.update_done = True
+            if pending.update_done:
+                self.api_calls += 1
+                nodegroup = aws_call(
+                    self.client, 'describe_nodegroup', max_attempts=1, caller_retries=True,
+                    clusterName=pending.cluster,
+                    nodegroupName=pending.nodegroup)['nodegroup']
+                if nodegroup['status'] == "ACTIVE":
+                    pending.future.set_result(pending.response)
+                    return True
+                if nodegroup['status'] in ("CREATE_FAILED", "DELETE_FAILED", "DEGRADED"):
+                    pending.future.set_exception(NodegroupUpdateError(
+                        "Nodegroup %s is %s" % (pending.nodegroup, nodegroup['status'])))
+                    return True
+        except Exception as e:
+            # ie. EndpointConnectionError or ReadTimeoutError, anything
+            # escaping would kill the thread and leave every future pending
+            kind = classify(e)
+            if kind is None:
+                pending.future.set_exception(e)
+                return True
+            print("%s polling nodegroup %s, backing off: %s" %
+                  (kind.capitalize(), pending.nodegroup, e), file=sys.stderr)
+        pending.interval = min(pending.interval * BACKOFF_FACTOR, self.max_interval)
+        pending.next_poll = time.monotonic() + self._jittered(pending.interval)
+        return False
+
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+
+def get_poller(client):
+    """
+    Return the shared poller for an EKS client
+    """
+    with _pollers_lock:
+        poller = _pollers.get(id(client))
+        if poller is None or poller.client is not client:
+            poller = NodegroupUpdatePoller(client)
+            _pollers[id(client)] = poller
+        return poller
@@ -0,0 +1,292 @@
+"""
+Adaptive rate limiting and retries for EKS, EC2 and API server calls
+
+Every AWS call of sharedlib goes through `call()` (and `paginate()`), and
+every Kubernetes request through the ApiClient of `kube_api_client()`.
+A call takes a token from the bucket of its service (per region for AWS,
+per kube context for Kubernetes), so the worker threads of all node
+groups, and all clusters of a fleet, share one budget per API:
+
+- a throttle response (ThrottlingException, RequestLimitExceeded, HTTP
+  429, ...) halves the bucket rate, every success raises it back a little
+  (additive increase, multiplicative decrease)
+- throttles and retryable errors (5xx, connection errors) are retried
+  with exponential backoff and full jitter, up to MAX_ATTEMPTS
+- calls, throttles, retries, failures and the time spent waiting for a
+  token are counted per bucket, see print_stats()
+
+botocore's own retries are turned off for the clients created with
+`aws_client_config()`, so a throttle is not retried by both layers.
+"""
+
+import random
+import sys
+import threading
+import time
+
+from sharedlib import metrics
+
+MAX_ATTEMPTS = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 20.0
+# fraction of the nominal rate a throttle keeps, and added back per success
+DECREASE = 0.5
+INCREASE = 0.02
+MIN_RATE = 0.5
+# (requests per second, burst) per service
+RATES = {
+    "eks": (10.0, 20),
+    "ec2": (20.0, 100),
+    "sts": (10.0, 20),
+    "kube": (50.0, 100),
+}
+DEFAULT_RATE = (10.0, 20)
+
+THROTTLE_CODES = (
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+    "RequestThrottledException", "TooManyRequestsException", "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException", "SlowDown", "PriorRequestNotComplete",
+)
+RETRYABLE_CODES = (
+    "InternalError", "InternalFailure", "InternalServerError", "ServerException",
+    "ServiceUnavailable", "ServiceUnavailableException", "RequestTimeout",
+    "RequestTimeoutException", "Unavailable",
+)
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+THROTTLE = "throttle"
+RETRYABLE = "retryable"
+
+
+class TokenBucket:
+    """
+    Token bucket whose refill rate adapts to throttle responses
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, sleeping until it is available. Returns the seconds waited.
+        """
+        with self._lock:
+            self._refill(self.clock())
+            # a negative balance reserves the token for this caller
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = max(MIN_RATE, self.rate * DECREASE)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(self.clock())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE)
+
+
+class CallStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.failures = 0
+        self.waited = 0.0
+
+    def as_dict(self):
+        return {"calls": self.calls, "throttles": self.throttles, "retries": self.retries,
+                "failures": self.failures, "waitedSeconds": round(self.waited, 3)}
+
+
+_lock = threading.Lock()
+_buckets = {}
+_stats = {}
+
+
+def get_bucket(name):
+    """
+    Return the bucket of `service` or `service/scope`, ie. eks/us-east-2
+    """
+    with _lock:
+        if name not in _buckets:
+            rate, burst = RATES.get(name.split("/", 1)[0], DEFAULT_RATE)
+            _buckets[name] = TokenBucket(rate, burst)
+            _stats[name] = CallStats()
+        return _buckets[name]
+
+
+def _count(name, counter, amount=1):
+    with _lock:
+        stats = _stats[name]
+        setattr(stats, counter, getattr(stats, counter) + amount)
+
+
+def classify(error):
+    """
+    Return THROTTLE, RETRYABLE or None for an exception of botocore,
+    the kubernetes client or urllib3
+    """
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLE_CODES or status == 429:
+            return THROTTLE
+        if code in RETRYABLE_CODES or status in RETRYABLE_STATUSES:
+            return RETRYABLE
+        return None
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return RETRYABLE
+    status = getattr(error, "status", None)
+    if type(error).__name__ == "ApiException" and status is not None:
+        if status == 429:
+            return THROTTLE
+        if status in RETRYABLE_STATUSES:
+            return RETRYABLE
+        return None
+    import urllib3.exceptions
+    if isinstance(error, (urllib3.exceptions.HTTPError, ConnectionResetError)):
+        return RETRYABLE
+    return None
+
+
+def backoff(attempt):
+    """
+    Return the full jitter delay before retry number attempt (from 1)
+    """
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def call(name, func, /, *args, max_attempts=MAX_ATTEMPTS, classifier=classify,
+         operation=None, caller_retries=False, **kwargs):
+    """
+    Call func(*args, **kwargs) with a token of bucket name, retrying
+    throttles and retryable errors. The last error is raised unchanged.
+    The latency of every attempt is recorded by sharedlib.metrics.
+
+    With caller_retries the caller retries throttles and retryable errors
+    on its own schedule, they are counted as retries instead of failures.
+    """
+    bucket = get_bucket(name)
+    operation = operation or getattr(func, "__name__", "call")
+    for attempt in range(1, max_attempts + 1):
+        waited = bucket.acquire()
+        _count(name, "calls")
+        if waited:
+            _count(name, "waited", waited)
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            kind = classifier(e)
+            metrics.observe_api(name, operation, time.monotonic() - start, kind or "error")
+            if kind == THROTTLE:
+                bucket.throttled()
+                _count(name, "throttles")
+            if kind is None or attempt == max_attempts:
+                _count(name, "retries" if kind is not None and caller_retries else "failures")
+                raise
+            delay = backoff(attempt)
+            _count(name, "retries")
+            print("%s %s on %s, retry %d/%d in %.1fs: %s" % (
+                name, kind, operation, attempt,
+                max_attempts - 1, delay, e), file=sys.stderr)
+            time.sleep(delay)
+            continue
+        metrics.observe_api(name, operation, time.monotonic() - start, "ok")
+        bucket.succeeded()
+        return result
+
+
+def aws_bucket(client):
+    return "%s/%s" % (client.meta.service_model.service_name, client.meta.region_name)
+
+
+def aws_call(client, method, /, max_attempts=MAX_ATTEMPTS, caller_retries=False, **kwargs):
+    """
+    Call a boto3 client method through the bucket of its service and region
+    """
+    return call(aws_bucket(client), getattr(client, method),
+                max_attempts=max_attempts, caller_retries=caller_retries, **kwargs)
+
+
+def paginate(client, method, /, token="nextToken", **kwargs):
+    """
+    Yield the pages of a paginated boto3 operation, every page request
+    going through call(), so a throttled page is retried on its own
+    instead of restarting the listing
+    """
+    while True:
+        page = aws_call(client, method, **kwargs)
+        yield page
+        if not page.get(token):
+            return
+        kwargs[token] = page[token]
+
+
+def aws_client_config(max_pool_connections=None):
+    """
+    Return the botocore Config of sharedlib clients: retries are done by
+    call(), not by botocore
+    """
+    from botocore.config import Config
+    config = Config(retries={"total_max_attempts": 1, "mode": "standard"})
+    if max_pool_connections:
+        config = config.merge(Config(max_pool_connections=max_pool_connections))
+    return config
+
+
+def kube_api_client(context=None, configuration=None):
+    """
+    Return a kubernetes.client.ApiClient whose requests go through the
+    bucket of the kube context
+    """
+    import kubernetes.client
+    name = "kube/%s" % (context or "default")
+
+    class RateLimitedApiClient(kubernetes.client.ApiClient):
+
+        def call_api(self, resource_path, method, *args, **kwargs):
+            # the path template keeps the operation label bounded
+            operation = "%s %s" % (method, resource_path)
+            if resource_path.endswith("/eviction"):
+                # 429 means a PodDisruptionBudget blocks the eviction, not a
+                # throttle: sharedlib.drain retries it on its own schedule
+                return call(name, super().call_api, resource_path, method, *args,
+                            max_attempts=1, classifier=lambda error: None,
+                            operation=operation, **kwargs)
+            return call(name, super().call_api, resource_path, method, *args,
+                        operation=operation, **kwargs)
+
+    return RateLimitedApiClient(configuration)
+
+
+def stats():
+    with _lock:
+        return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+
+def print_stats(file=sys.stderr):
+    for name, counters in stats().items():
+        print("api   %-26s calls=%d throttles=%d retries=%d failures=%d waited=%.1fs" % (
+            name, counters["calls"], counters["throttles"], counters["retries"],
+            counters["failures"], counters["waitedSeconds"]), file=file)
@@ -0,0 +1,268 @@
+"""
+Continuous reconcile of node group edits into the migrated Karpenter objects
+
+After a migration the NodePool and EC2NodeClass of a node group are
+frozen, so later edits of the node group (labels, taints, instance types,
+launch template version, scaling limits) never reach them, and a rollback
+restores stale `migrate.karpenter.io/min|max|desired` annotations.
+
+The reconcile loop keeps them in sync with a flat cost per cycle:
+
+- the node groups come from the resource index (sharedlib.index), kept
+  fresh by a watch, not from a LIST per cycle
+- each cycle describes at most `budget` node groups, the least recently
+  checked first, so a fleet of any size is swept every
+  `ceil(nodegroups / budget)` cycles at the same API cost per cycle
+- the fields of the description are hashed into a fingerprint, the ETag
+  of the node group, stored on the NodePool: an unchanged node group costs
+  one describe and nothing else
+- launch template versions are immutable, their descriptions stay cached
+  (see infra.get_launch_template_version)
+- a changed node group is rendered again and diffed against the indexed
+  objects, only the changed fields are sent as a JSON merge patch
+
+The scale down of the migration (min 0, max 1, desired 0) is not an edit:
+the min/max/desired annotations keep the values to roll back to, and only
+values the user changed on the node group replace them. The disruption
+settings, the EC2NodeClass reference and the instance mode of the NodePool
+are kept.
+
+    python main.py reconcile karpenter us-east-2 --interval 60 --budget 20
+"""
+
+import copy
+import hashlib
+import json
+import sys
+import threading
+import time
+
+from sharedlib import infra, metrics
+from sharedlib.apply import FIELD_MANAGER, apply_object, stamp
+from sharedlib.concurrency import locked_print, run_concurrently
+from sharedlib.index import KINDS, nodepool_node_class, nodepool_scaling_config
+from sharedlib.render import (INSTANCE_EXACT, INSTANCE_FLEXIBLE, SHARED_NODECLASS_LABEL,
+                              share_node_class)
+from sharedlib.snapshot import NODEGROUP_FIELDS
+
+DEFAULT_INTERVAL = 60
+DEFAULT_BUDGET = 20
+DEFAULT_WORKERS = 4
+FINGERPRINT_ANNOTATION = "migrate.karpenter.io/source-fingerprint"
+ANNOTATION_PREFIX = "migrate.karpenter.io/"
+# scalingConfig set by migrate_nodegroup when scaling the node group down
+SCALED_DOWN = {'minSize': 0, 'maxSize': 1, 'desiredSize': 0}
+# maps fully owned by the rendered objects: keys missing from the rendered
+# map are removed, limited to the keys with the prefix
+OWNED_MAPS = {
+    ("metadata", "annotations"): ANNOTATION_PREFIX,
+    ("spec", "template", "metadata", "labels"): "",
+    ("spec", "tags"): "",
+}
+
+
+def fingerprint(nodegroup):
+    """
+    Return the hash of the node group fields the Karpenter objects are
+    rendered from
+    """
+    fields = {field: nodegroup.get(field) for field in NODEGROUP_FIELDS}
+    data = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def effective_scaling_config(nodegroup, nodepool):
+    """
+    Return the scalingConfig to roll back to: the NodePool annotations,
+    with the values changed on the node group since the scale down
+    """
+    scaling = nodegroup.get('scalingConfig') or {}
+    try:
+        saved = nodepool_scaling_config(nodepool)
+    except (KeyError, ValueError):
+        return dict(scaling)
+    config = {key: saved[key] if scaling.get(key) in (None, value) else scaling[key]
+              for key, value in SCALED_DOWN.items()}
+    # an edited maxSize may be below the saved sizes
+    config['minSize'] = min(config['minSize'], config['maxSize'])
+    config['desiredSize'] = min(max(config['desiredSize'], config['minSize']),
+                                config['maxSize'])
+    return config
+
+
+def instance_mode(nodepool):
+    """
+    Return the instance mode a NodePool was rendered with: exact ones
+    list the node group instance types
+    """
+    requirements = (nodepool.get('spec', {}).get('template', {}).get('spec', {})
+                    .get('requirements') or [])
+    if any(requirement.get('key') == "node.kubernetes.io/instance-type"
+           for requirement in requirements):
+        return INSTANCE_EXACT
+    return INSTANCE_FLEXIBLE
+
+
+def merge_patch(current, desired, path=()):
+    """
+    Return the JSON merge patch (RFC 7386) turning current into desired,
+    {} when there is nothing to change. Keys only the live object has
+    (ie. defaulted by the API server) are kept, except in OWNED_MAPS.
+    """
+    patch = {}
+    for key, value in desired.items():
+        live = current.get(key)
+        if isinstance(value, dict) and isinstance(live, dict):
+            child = merge_patch(live, value, path + (key,))
+            if child:
+                patch[key] = child
+        elif value != live:
+            patch[key] = copy.deepcopy(value)
+    prefix = OWNED_MAPS.get(path)
+    if prefix is not None:
+        for key in current:
+            if key not in desired and key.startswith(prefix):
+                patch[key] = None
+    return patch
+
+
+def desired_objects(eks, ec2, nodegroup, nodepool, node_class):
+    """
+    Render the EC2NodeClass and NodePool of the node group as they should
+    be now, keeping what the migration chose for the existing NodePool
+    """
+    source = fingerprint(nodegroup)
+    nodegroup = dict(nodegroup, scalingConfig=effective_scaling_config(nodegroup, nodepool))
+    desired_pool = infra.generate_karpenter_node_pool(
+        nodegroup, instance_mode(nodepool), ec2, nodepool.get('spec', {}).get('disruption'))
+    desired_class = infra.generate_karpenter_node_class(eks, ec2, nodegroup)
+    if node_class is not None and (node_class['metadata'].get('labels') or {}).get(
+            SHARED_NODECLASS_LABEL):
+        # a changed spec is a different shared class, created when missing
+        desired_class, desired_pool = share_node_class(desired_class, desired_pool)
+    else:
+        desired_class['metadata']['name'] = nodepool_node_class(nodepool) or \
+            desired_class['metadata']['name']
+        desired_pool['spec']['template']['spec']['nodeClassRef']['name'] = \
+            desired_class['metadata']['name']
+    desired_pool['metadata']['name'] = nodepool['metadata']['name']
+    desired_pool['metadata']['annotations'][FINGERPRINT_ANNOTATION] = source
+    return [stamp(desired_class), stamp(desired_pool)]
+
+
+def patch_object(kind, name, patch):
+    api = infra.get_custom_objects_api()
+    group, version, plural = KINDS[kind]
+    return api.patch_cluster_custom_object(group, version, plural, name, patch,
+                                           field_manager=FIELD_MANAGER)
+
+
+def reconcile_object(obj, resources):
+    """
+    Create obj when missing, else merge patch the fields that differ from
+    the indexed object. Returns "unchanged", "created", "patched" or "failed".
+    """
+    from kubernetes.client.exceptions import ApiException
+    kind, name = obj['kind'], obj['metadata']['name']
+    current = resources.get(name, kind)
+    if current is None:
+        status, _ = apply_object(obj, resources)
+        return "created" if status == "applied" else status
+    patch = merge_patch(current, obj)
+    if not patch:
+        return "unchanged"
+    try:
+        response = patch_object(kind, name, patch)
+    except ApiException as e:
+        print("Exception patching %s %s: %s" % (kind, name, e), file=sys.stderr)
+        return "failed"
+    locked_print("%s %s patched: %s" % (kind, name, json.dumps(patch, sort_keys=True)),
+                 file=sys.stderr)
+    resources.record(response)
+    return "patched"
+
+
+class Reconciler:
+    """
+    Reconcile the Karpenter objects of the migrated node groups of one
+    cluster, `budget` node groups per cycle
+    """
+
+    def __init__(self, cluster, eks, ec2, resources, budget=DEFAULT_BUDGET,
+                 max_workers=DEFAULT_WORKERS):
+        self.cluster = cluster
+        self.eks = eks
+        self.ec2 = ec2
+        self.resources = resources
+        self.budget = max(1, budget)
+        self.max_workers = max_workers
+        # node group -> time.monotonic() of its last describe
+        self.checked = {}
+        self.cycles = 0
+
+    def candidates(self):
+        """
+        Return the migrated node groups to describe this cycle, the least
+        recently checked first
+        """
+        names = self.resources.nodegroup_names("NodePool")
+        for name in set(self.checked) - set(names):
+            del self.checked[name]
+        return sorted(names, key=lambda name: (self.checked.get(name, 0.0), name))[:self.budget]
+
+    def reconcile_nodegroup(self, nodegroup_name):
+        """
+        Returns "unchanged" when the fingerprint matches, "missing" when
+        the node group or NodePool is gone, else "reconciled" or "failed"
+        """
+        with metrics.span("describe"):
+            nodegroup = infra.get_node_group(self.eks, self.cluster, nodegroup_name,
+                                             cached=False)
+        self.checked[nodegroup_name] = time.monotonic()
+        nodepool = self.resources.get_for_nodegroup(nodegroup_name, "NodePool")
+        if nodegroup is None or nodepool is None:
+            return "missing"
+        annotations = nodepool['metadata'].get('annotations') or {}
+        if annotations.get(FINGERPRINT_ANNOTATION) == fingerprint(nodegroup):
+            return "unchanged"
+        node_class = self.resources.get(nodepool_node_class(nodepool), "EC2NodeClass")
+        with metrics.span("generate"):
+            objects = desired_objects(self.eks, self.ec2, nodegroup, nodepool, node_class)
+        # the class first, the NodePool may reference a new shared class
+        with metrics.span("patch"):
+            statuses = [reconcile_object(obj, self.resources) for obj in objects]
+        if "failed" in statuses:
+            return "failed"
+        return "reconciled"
+
+    def cycle(self):
+        self.cycles += 1
+        with metrics.labels(cluster=self.cluster):
+            return run_concurrently(
+                metrics.traced("reconcile-nodegroup", self.reconcile_nodegroup),
+                self.candidates(), max_workers=self.max_workers)
+
+    def run(self, interval=DEFAULT_INTERVAL, once=False, stop=None):
+        """
+        Run a cycle every `interval` seconds until stop is set, returns
+        the results of the last cycle
+        """
+        stop = stop or threading.Event()
+        while True:
+            start = time.monotonic()
+            results = self.cycle()
+            elapsed = time.monotonic() - start
+            print_cycle(self.cycles, results, elapsed, len(self.checked))
+            if once or stop.wait(max(0.0, interval - elapsed)):
+                return results
+
+
+def print_cycle(number, results, elapsed, tracked, file=sys.stderr):
+    totals = {}
+    for result in results:
+        totals[result.status] = totals.get(result.status, 0) + 1
+        if result.status != "unchanged":
+            locked_print("  %-40s %s" % (result.name, result.status), file=file)
+    locked_print("Reconcile cycle %d: %d node groups in %.1fs, %d tracked, %s" % (
+        number, len(results), elapsed, tracked,
+        ", ".join("%s=%d" % item for item in sorted(totals.items())) or "idle"), file=file)
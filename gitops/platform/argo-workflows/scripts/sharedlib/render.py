@@ -0,0 +1,492 @@
+"""
+Offline Karpenter manifest renderer
+
+Pure, side effect free rendering of node group descriptions into
+EC2NodeClass and NodePool manifests. No AWS or Kubernetes client is used:
+security groups come from the description itself (`securityGroups`, as in
+a cluster snapshot) or from a default list.
+
+Input is read from a file or stdin as a stream, one document in memory
+at a time: a describe_nodegroup response, a node group, a list of node
+groups or a cluster snapshot, as JSON, JSON lines or multi document
+YAML. Output is streamed as multi document YAML
+(with the libyaml C emitter when available) or as a JSON v1 List, or
+written to one file per node group under a directory such as
+gitops/platform/karpenter/.
+
+    python -m sharedlib render --input nodegroups.json --output-dir ../../karpenter
+"""
+
+import copy
+import hashlib
+import json
+import os
+import sys
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as Dumper, CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeDumper as Dumper, SafeLoader as Loader
+
+TAINT_EFFECTS = {
+    'NO_SCHEDULE': 'NoSchedule',
+    'NO_EXECUTE': 'NoExecute',
+    'PREFER_NO_SCHEDULE': 'PreferNoSchedule',
+}
+
+# input read size, doubled while a JSON document is incomplete
+READ_SIZE = 64 * 1024
+
+
+NODEGROUP_LABEL = "migrate.karpenter.io/nodegroup"
+SHARED_NODECLASS_LABEL = "migrate.karpenter.io/shared-nodeclass"
+SHARED_NODECLASS_PREFIX = "migrated-"
+
+NODECLASS_PER_NODEGROUP = "per-nodegroup"
+NODECLASS_SHARED = "shared"
+NODECLASS_MODES = (NODECLASS_PER_NODEGROUP, NODECLASS_SHARED)
+
+# exact: pin the node group instance types, flexible: allow compatible
+# families, sizes and generations from the catalog, flexible-spot: only
+# for SPOT node groups
+INSTANCE_EXACT = "exact"
+INSTANCE_FLEXIBLE = "flexible"
+INSTANCE_FLEXIBLE_SPOT = "flexible-spot"
+INSTANCE_MODES = (INSTANCE_EXACT, INSTANCE_FLEXIBLE, INSTANCE_FLEXIBLE_SPOT)
+# disruption without a workload profile, see sharedlib.workload
+DEFAULT_DISRUPTION = {"consolidationPolicy": "WhenEmpty", "consolidateAfter": "30s"}
+
+
+class RenderError(Exception):
+    pass
+
+
+def render_node_class(nodegroup, security_groups):
+    """
+    Render the Karpenter EC2NodeClass of a node group description
+    """
+    cluster = nodegroup['clusterName']
+    nodegroup_name = nodegroup['nodegroupName']
+    security_groups_map = [{"id": security_group}
+                           for security_group in security_groups]
+    subnets = nodegroup['subnets']
+    subnets_map = [{"id": subnet} for subnet in subnets]
+    karpenter_tags = {
+        "karpenter.sh/discovery": cluster,
+        "migrate.karpenter.io/nodegroup": nodegroup_name
+    }
+    node_group_tags = nodegroup.get('tags') or {}
+    tags = {**karpenter_tags, **node_group_tags}
+    karpenter_ami_family = nodegroup['amiType']
+    iam_role_arn = nodegroup['nodeRole']
+    iam_role_name = iam_role_arn.split("/")[-1]
+    ami_type = get_karpenter_ami_type(karpenter_ami_family)
+
+    return {
+        "apiVersion": "karpenter.k8s.aws/v1beta1",
+        "kind": "EC2NodeClass",
+        "metadata": {
+            "name": nodegroup_name,
+            "labels": {
+                "migrate.karpenter.io/nodegroup": nodegroup_name
+            }
+        },
+        "spec": {
+            "amiFamily": ami_type,
+            "role": iam_role_name,
+            "subnetSelectorTerms": subnets_map,
+            "securityGroupSelectorTerms": security_groups_map,
+            "tags": tags
+        }
+    }
+
+
+def render_node_pool(nodegroup, instance_mode=INSTANCE_EXACT, catalog=None,
+                     disruption=None):
+    """
+    Render the Karpenter NodePool of a node group description
+
+    Limits allow maxSize nodes of the largest instance type the NodePool
+    allows, see sharedlib.catalog for the catalog used. They are left
+    unset, with a warning, when an instance type is not in the catalog.
+    disruption is the spec.disruption chosen from the node group's
+    workload profile (sharedlib.workload), DEFAULT_DISRUPTION without one.
+    """
+    from sharedlib.catalog import flexible_requirements, load_catalog, nodepool_limits
+    nodegroup_name = nodegroup['nodegroupName']
+    capacity_type = nodegroup['capacityType']
+    # if capacity_type is SPOT set karpenter_capacity_type to "spot"
+    # if capacity_type is ON_DEMAND set karpenter_capacity_type to "on-demand"
+    karpenter_capacity_type = "on-demand" if capacity_type == "ON_DEMAND" else "spot"
+    ami_family = nodegroup['amiType']
+    # if ami_family string contains ARM_64 set karpenter_arch to "arm64" else "amd64"
+    # examples of ami_family string: "AL2_x86_64", "AL2_ARM_64", "BOTTLEROCKET_x86_64", "BOTTLEROCKET_ARM_64"
+    karpenter_arch = "arm64" if "ARM_64" in ami_family else "amd64"
+    instance_types = nodegroup['instanceTypes']
+    new_labels = {"migrate.karpenter.io/nodegroup": nodegroup_name}
+    nodegroup_labels = nodegroup.get('labels') or {}
+    labels = {**nodegroup_labels, **new_labels}
+    taints = translate_nodegroup_taints(nodegroup.get('taints') or [])
+    min = str(nodegroup['scalingConfig']['minSize'])
+    max = str(nodegroup['scalingConfig']['maxSize'])
+    desired_size = str(nodegroup['scalingConfig']['desiredSize'])
+    instance_hypervisor = "nitro"
+    catalog = catalog or load_catalog()
+    requirements = [
+        {"key": "karpenter.sh/capacity-type", "operator": "In",
+         "values": [karpenter_capacity_type]},
+        {"key": "kubernetes.io/arch", "operator": "In",
+         "values": [karpenter_arch]},
+        {"key": "karpenter.k8s.aws/instance-hypervisor",
+         "operator": "In", "values": [instance_hypervisor]},
+    ]
+    flexible = None
+    if instance_mode == INSTANCE_FLEXIBLE or (
+            instance_mode == INSTANCE_FLEXIBLE_SPOT and capacity_type == "SPOT"):
+        # None when an instance type is not in the catalog, keep them exact
+        flexible = flexible_requirements(catalog, instance_types)
+    if flexible is not None:
+        requirements.extend(flexible)
+    else:
+        requirements.append({"key": "node.kubernetes.io/instance-type",
+                             "operator": "In", "values": instance_types})
+    limits = nodepool_limits(catalog, instance_types, requirements,
+                             nodegroup['scalingConfig']['maxSize'])
+    if limits is None:
+        print("Warning: instance types %s of nodegroup %s not in the catalog, NodePool "
+              "limits left unset" % (", ".join(catalog.missing(instance_types)) or "(none)",
+                                     nodegroup_name), file=sys.stderr)
+    return {
+        "apiVersion": "karpenter.sh/v1beta1",
+        "kind": "NodePool",
+        "metadata": {
+            "name": nodegroup_name,
+            "labels": {
+                "migrate.karpenter.io/nodegroup": nodegroup_name
+            },
+            "annotations": {
+                "migrate.karpenter.io/min": min,
+                "migrate.karpenter.io/max": max,
+                "migrate.karpenter.io/desired": desired_size
+            }
+        },
+        "spec": {
+            "template": {
+                "metadata": {
+                    "labels": labels
+                },
+                "spec": {
+                    "nodeClassRef": {
+                        "name": nodegroup_name
+                    },
+                    "requirements": requirements,
+                    "taints": taints
+                }
+            },
+            **({"limits": limits} if limits is not None else {}),
+            "disruption": copy.deepcopy(disruption or DEFAULT_DISRUPTION)
+        }
+    }
+
+
+def translate_nodegroup_taints(taints):
+    """
+    taints is an array with the following structure for each item dict
+    [
+        {
+            'key': 'string',
+            'value': 'string',
+            'effect': 'NO_SCHEDULE'|'NO_EXECUTE'|'PREFER_NO_SCHEDULE'
+        }
+    ]
+    return the taints with the effect changed to match the following return
+    [
+        {
+            'key': 'string',
+            'value': 'string',
+            'effect': 'NoSchedule'|'NoExecute'|'PreferNoSchedule'
+        }
+    ]
+
+    The input taints are not modified.
+    """
+    taints_translated = []
+    for taint in taints:
+        # remove the taint if the key is "migratedfrom" or the value is "karpenter"
+        if taint['key'] == 'migratedfrom' or taint.get('value') == 'karpenter':
+            continue
+        taint = dict(taint)
+        taint['effect'] = TAINT_EFFECTS.get(taint['effect'], taint['effect'])
+        taints_translated.append(taint)
+    return taints_translated
+
+
+def get_karpenter_ami_type(ami_type):
+    ami_type_map = {
+        "AL2_x86_64": "AL2",
+        "AL2_x86_64_GPU": "AL2",
+        "AL2_ARM_64": "AL2",
+        "CUSTOM": "Custom",
+        "BOTTLEROCKET_ARM_64": "Bottlerocket",
+        "BOTTLEROCKET_x86_64": "Bottlerocket",
+        "BOTTLEROCKET_ARM_64_NVIDIA": "Bottlerocket",
+        "BOTTLEROCKET_x86_64_NVIDIA": "Bottlerocket",
+        "WINDOWS_CORE_2019_x86_64": "Windows2019",
+        "WINDOWS_FULL_2019_x86_64": "Windows2019",
+        "WINDOWS_CORE_2022_x86_64": "Windows2022",
+        "WINDOWS_FULL_2022_x86_64": "Windows2022"
+    }
+    karpenter_ami_type = ami_type_map.get(ami_type, "Custom")
+    return karpenter_ami_type
+
+
+class _Prefixed:
+    """
+    Read text already read from a stream, then the rest of the stream
+    """
+
+    def __init__(self, text, stream):
+        self.text = text
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.text:
+            return self.stream.read(size)
+        if size < 0:
+            text, self.text = self.text + self.stream.read(), ""
+        else:
+            text, self.text = self.text[:size], self.text[size:]
+        return text
+
+
+def _iter_documents(stream):
+    """
+    Yield the JSON (single, lines or concatenated) or YAML documents of a
+    stream, reading it incrementally
+    """
+    buffer = stream.read(READ_SIZE).lstrip()
+    if buffer and buffer[0] not in "{[":
+        for document in yaml.load_all(_Prefixed(buffer, stream), Loader=Loader):
+            if document is not None:
+                yield document
+        return
+    decoder = json.JSONDecoder()
+    size = READ_SIZE
+    while True:
+        buffer = buffer.lstrip()
+        chunk = None
+        if buffer:
+            try:
+                document, end = decoder.raw_decode(buffer)
+            except ValueError:
+                chunk = stream.read(size)
+                if not chunk:
+                    raise
+                # read more at a time, a large document is not decoded again per chunk
+                size *= 2
+            else:
+                size = READ_SIZE
+                buffer = buffer[end:]
+                yield document
+                continue
+        else:
+            chunk = stream.read(size)
+            if not chunk:
+                return
+        buffer += chunk
+
+
+def load_nodegroups(stream):
+    """
+    Yield (nodegroup, default_security_groups) from the input documents
+    """
+    for document in _iter_documents(stream):
+        if isinstance(document, list):
+            for nodegroup in document:
+                yield nodegroup, None
+        elif "nodegroups" in document and "version" in document:
+            # cluster snapshot, see sharedlib.snapshot
+            cluster_sg = document["cluster"].get("clusterSecurityGroupId")
+            default = [cluster_sg] if cluster_sg else None
+            for nodegroup in document["nodegroups"].values():
+                yield nodegroup, default
+        elif "nodegroup" in document:
+            yield document["nodegroup"], None
+        else:
+            yield document, None
+
+
+def render_nodegroup(nodegroup, default_security_groups=None,
+                     instance_mode=INSTANCE_EXACT, disruption=None):
+    """
+    Return [EC2NodeClass, NodePool] for a node group description
+    """
+    security_groups = nodegroup.get('securityGroups') or default_security_groups
+    if not security_groups:
+        raise RenderError("nodegroup %s has no securityGroups" %
+                          nodegroup.get('nodegroupName'))
+    return [render_node_class(nodegroup, security_groups),
+            render_node_pool(nodegroup, instance_mode, disruption=disruption)]
+
+
+def node_class_hash(node_class):
+    """
+    Hash of the effective EC2NodeClass spec, ignoring the per node group tag
+    """
+    spec = dict(node_class['spec'])
+    spec['tags'] = {k: v for k, v in (spec.get('tags') or {}).items()
+                    if k != NODEGROUP_LABEL}
+    data = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def share_node_class(node_class, node_pool):
+    """
+    Return (shared EC2NodeClass, NodePool referencing it).
+
+    The shared class is named after the hash of its spec, so every node
+    group with the same role, AMI family, subnets, security groups and
+    tags renders the same object independently, without a global view.
+    """
+    name = SHARED_NODECLASS_PREFIX + node_class_hash(node_class)[:12]
+    spec = copy.deepcopy(node_class['spec'])
+    spec['tags'] = {k: v for k, v in (spec.get('tags') or {}).items()
+                    if k != NODEGROUP_LABEL}
+    shared = {
+        "apiVersion": node_class['apiVersion'],
+        "kind": "EC2NodeClass",
+        "metadata": {
+            "name": name,
+            "labels": {
+                SHARED_NODECLASS_LABEL: "true"
+            }
+        },
+        "spec": spec
+    }
+    node_pool = copy.deepcopy(node_pool)
+    node_pool['spec']['template']['spec']['nodeClassRef']['name'] = name
+    return shared, node_pool
+
+
+def render(nodegroups, default_security_groups=None, errors=None,
+           nodeclass_mode=NODECLASS_PER_NODEGROUP, instance_mode=INSTANCE_EXACT):
+    """
+    Yield (nodegroup_name, [EC2NodeClass, NodePool]) for each node group.
+    Node groups that cannot be rendered are appended to errors, if given,
+    instead of stopping the stream.
+
+    With nodeclass_mode "shared" node groups with identical EC2NodeClass
+    specs share one class, yielded with every one of them so each node
+    group's objects apply on their own.
+    """
+    for item in nodegroups:
+        nodegroup, default = item if isinstance(item, tuple) else (item, None)
+        try:
+            objects = render_nodegroup(
+                nodegroup, default or default_security_groups, instance_mode)
+        except (KeyError, RenderError) as e:
+            if errors is None:
+                raise
+            errors.append((nodegroup.get('nodegroupName'), e))
+            continue
+        if nodeclass_mode == NODECLASS_SHARED:
+            objects = list(share_node_class(*objects))
+        yield nodegroup['nodegroupName'], objects
+
+
+def dump_yaml(objects, stream=None):
+    """
+    Dump objects as multi document YAML
+    """
+    return yaml.dump_all(objects, stream, Dumper=Dumper, default_flow_style=False,
+                         explicit_start=True, sort_keys=False)
+
+
+def unique_objects(rendered):
+    """
+    Yield the rendered node groups without the shared EC2NodeClasses
+    already yielded, for outputs holding every node group at once
+    """
+    seen = set()
+    for nodegroup_name, objects in rendered:
+        unique = []
+        for obj in objects:
+            key = (obj['kind'], obj['metadata']['name'])
+            if obj['kind'] == "EC2NodeClass" and key in seen:
+                continue
+            seen.add(key)
+            unique.append(obj)
+        yield nodegroup_name, unique
+
+
+def write_yaml_stream(rendered, stream):
+    count = 0
+    for _, objects in unique_objects(rendered):
+        dump_yaml(objects, stream)
+        count += 1
+    return count
+
+
+def write_json_stream(rendered, stream):
+    count = 0
+    first = True
+    stream.write('{"apiVersion":"v1","kind":"List","items":[')
+    for _, objects in unique_objects(rendered):
+        for obj in objects:
+            if not first:
+                stream.write(",")
+            stream.write(json.dumps(obj, separators=(",", ":")))
+            first = False
+        count += 1
+    stream.write("]}\n")
+    return count
+
+
+def write_directory(rendered, directory, output_format="yaml"):
+    """
+    Write one <nodegroup>.yaml (or .json) file per node group
+    """
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    for nodegroup_name, objects in rendered:
+        path = os.path.join(directory, "%s.%s" % (nodegroup_name, output_format))
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            if output_format == "json":
+                json.dump({"apiVersion": "v1", "kind": "List", "items": objects},
+                          f, indent=2)
+                f.write("\n")
+            else:
+                dump_yaml(objects, f)
+        os.replace(tmp, path)
+        count += 1
+    return count
+
+
+def render_file(input_path, output_format="yaml", output_dir=None,
+                default_security_groups=None, output=None,
+                nodeclass_mode=NODECLASS_PER_NODEGROUP, instance_mode=INSTANCE_EXACT):
+    """
+    Render every node group of input_path ("-" for stdin), return
+    (rendered count, errors)
+    """
+    errors = []
+    stream = sys.stdin if input_path == "-" else open(input_path)
+    try:
+        rendered = render(load_nodegroups(stream), default_security_groups, errors,
+                          nodeclass_mode, instance_mode)
+        if output_dir:
+            count = write_directory(rendered, output_dir, output_format)
+        elif output_format == "json":
+            count = write_json_stream(rendered, output or sys.stdout)
+        else:
+            count = write_yaml_stream(rendered, output or sys.stdout)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    for nodegroup_name, error in errors:
+        print("Unable to render nodegroup %s: %s" % (nodegroup_name, error),
+              file=sys.stderr)
+    return count, errors
@@ -0,0 +1,194 @@
+"""
+Capacity-first rollback from Karpenter to node groups
+
+The serial rollback restored one node group, waited for the update, and
+deleted its NodePool right away, before the managed nodes were Ready, so
+pods could lose their Karpenter nodes with nowhere to go. Here:
+
+1.) every scaling config restore is issued up front (non-blocking, the
+    shared update poller tracks them) and the cluster-autoscaler is
+    scaled up once
+2.) one Kubernetes watch on the node group nodes counts Ready nodes
+3.) as soon as a node group has its desired number of Ready nodes its
+    NodePool and EC2NodeClass are deleted, and its time-to-capacity noted
+4.) at the deadline, node groups still without capacity keep their
+    Karpenter resources and are reported as timed out
+"""
+
+import sys
+import time
+
+from sharedlib import infra, metrics
+from sharedlib.apply import delete_for_nodegroup
+from sharedlib.concurrency import Result, locked_print
+from sharedlib.drain import NODEGROUP_NODE_LABEL
+from sharedlib.index import nodepool_scaling_config
+from sharedlib.journal import DELETED, MIGRATE, RESTORED, ROLLBACK
+
+DEFAULT_DEADLINE = 1800
+WATCH_TIMEOUT = 60
+
+
+class _Restore:
+
+    def __init__(self, name, scaling_config):
+        self.name = name
+        self.desired = scaling_config['desiredSize']
+        self.scaling_config = scaling_config
+        self.started = time.monotonic()
+        self.future = None
+        # set once the restore is recorded in the journal
+        self.journaled = False
+
+
+def node_ready(node):
+    for condition in node.status.conditions or []:
+        if condition.type == "Ready":
+            return condition.status == "True"
+    return False
+
+
+def _ready_counts(nodes):
+    counts = {}
+    for nodegroup_name, ready in nodes.values():
+        if ready:
+            counts[nodegroup_name] = counts.get(nodegroup_name, 0) + 1
+    return counts
+
+
+def watch_nodegroup_capacity(on_change, deadline):
+    """
+    Call on_change({nodegroup: ready nodes}) after the initial list and
+    after every node event, until it returns True or the deadline passes.
+    The watch is restarted from a fresh list when it expires.
+    """
+    from kubernetes import watch
+    from kubernetes.client.exceptions import ApiException
+    core = infra.get_core_api()
+    while time.monotonic() < deadline:
+        listing = core.list_node(label_selector=NODEGROUP_NODE_LABEL)
+        nodes = {node.metadata.name: (node.metadata.labels[NODEGROUP_NODE_LABEL],
+                                      node_ready(node))
+                 for node in listing.items}
+        if on_change(_ready_counts(nodes)):
+            return True
+        stream = watch.Watch()
+        try:
+            for event in stream.stream(
+                    core.list_node, label_selector=NODEGROUP_NODE_LABEL,
+                    resource_version=listing.metadata.resource_version,
+                    timeout_seconds=max(1, int(min(WATCH_TIMEOUT,
+                                                   deadline - time.monotonic())))):
+                node = event['object']
+                if event['type'] == "DELETED":
+                    nodes.pop(node.metadata.name, None)
+                else:
+                    nodes[node.metadata.name] = (
+                        node.metadata.labels[NODEGROUP_NODE_LABEL], node_ready(node))
+                if on_change(_ready_counts(nodes)):
+                    stream.stop()
+                    return True
+        except ApiException as e:
+            # 410 Gone, the resource version is too old: list again
+            if e.status != 410:
+                raise
+    return False
+
+
+def _failed_update(restore):
+    if restore.future is None or not restore.future.done():
+        return None
+    return restore.future.exception()
+
+
+def _journal_restored(journal, restore):
+    """
+    Record the restore once its update succeeded: a restore recorded when
+    sent and failed later would be skipped by a resumed rollback
+    """
+    if journal is None or restore.journaled or restore.future is None or \
+            not restore.future.done() or restore.future.exception() is not None:
+        return
+    journal.record(ROLLBACK, restore.name, RESTORED, scalingConfig=restore.scaling_config)
+    restore.journaled = True
+
+
+def rollback(cluster, eks, nodegroup_names, resources, journal=None,
+             deadline=DEFAULT_DEADLINE, autoscaler_replicas=1):
+    """
+    Restore the node groups from their NodePools, capacity first.
+    Returns one Result per node group, with status "restored" and the
+    time-to-capacity as value, "skipped", "timeout" or "failed".
+    """
+    start = time.monotonic()
+    results = {}
+    pending = {}
+    for nodegroup_name in nodegroup_names:
+        nodepool = resources.get_for_nodegroup(nodegroup_name, "NodePool")
+        if nodepool is None:
+            results[nodegroup_name] = Result(nodegroup_name, "skipped")
+            continue
+        restore = _Restore(nodegroup_name, nodepool_scaling_config(nodepool))
+        if journal is None or not journal.done(ROLLBACK, nodegroup_name, RESTORED):
+            print("Restoring scaling config for nodegroup %s: %s" %
+                  (nodegroup_name, restore.scaling_config), file=sys.stderr)
+            try:
+                restore.future = infra.update_nodegroup(
+                    eks, wait=False, clusterName=cluster, nodegroupName=nodegroup_name,
+                    scalingConfig=restore.scaling_config)
+            except Exception as e:
+                results[nodegroup_name] = Result(nodegroup_name, "failed", error=e)
+                continue
+        pending[nodegroup_name] = restore
+
+    if pending and autoscaler_replicas is not None:
+        # scale cluster-autoscaler from zero once for the whole rollback
+        infra.scale_deployment("aws-cluster-autoscaler", "kube-system", autoscaler_replicas)
+        if journal is not None:
+            journal.set_state("autoscaler-replicas", autoscaler_replicas)
+
+    def on_change(counts):
+        now = time.monotonic()
+        for restore in list(pending.values()):
+            error = _failed_update(restore)
+            if error is not None:
+                del pending[restore.name]
+                results[restore.name] = Result(restore.name, "failed", error=error,
+                                               elapsed=now - restore.started)
+                continue
+            _journal_restored(journal, restore)
+            ready = counts.get(restore.name, 0)
+            if ready < restore.desired:
+                continue
+            del pending[restore.name]
+            time_to_capacity = now - restore.started
+            metrics.record_span("time-to-capacity", time.time() - time_to_capacity,
+                                time_to_capacity, nodegroup=restore.name)
+            locked_print("Nodegroup %s has %d/%d Ready nodes after %.1fs, deleting "
+                         "its Karpenter resources" %
+                         (restore.name, ready, restore.desired, time_to_capacity),
+                         file=sys.stderr)
+            try:
+                delete_for_nodegroup(restore.name, resources)
+            except Exception as e:
+                results[restore.name] = Result(restore.name, "failed", error=e,
+                                               elapsed=time_to_capacity)
+                continue
+            if journal is not None:
+                journal.forget(MIGRATE, restore.name)
+                journal.record(ROLLBACK, restore.name, DELETED,
+                               timeToCapacity=round(time_to_capacity, 1))
+            results[restore.name] = Result(restore.name, "restored",
+                                           value=round(time_to_capacity, 1),
+                                           elapsed=time_to_capacity)
+        return not pending
+
+    if pending:
+        with metrics.span("wait-for-capacity"):
+            watch_nodegroup_capacity(on_change, start + deadline)
+    for restore in pending.values():
+        _journal_restored(journal, restore)
+        results[restore.name] = Result(
+            restore.name, "timeout", elapsed=time.monotonic() - restore.started,
+            error="no capacity before the %ds deadline, Karpenter resources kept" % deadline)
+    return [results[name] for name in nodegroup_names if name in results]
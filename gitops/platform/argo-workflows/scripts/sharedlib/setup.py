@@ -4,4 +4,5 @@ setup(
     name='infra',
     version='0.1',
     packages=find_packages(),
+    package_data={'sharedlib': ['data/*.json']},
 )
@@ -0,0 +1,397 @@
+"""
+Offline bin-packing pre-flight simulator
+
+Checks, before a node group is scaled to zero, that the NodePool generated
+for it can schedule the pods running there. The pods' requests,
+tolerations and node selectors are packed first-fit-decreasing onto the
+instance types of the bundled catalog (sharedlib.catalog) that satisfy the
+NodePool requirements, without any AWS or Kubernetes call:
+
+1.) pods that do not tolerate the NodePool taints, or select labels the
+    NodePool nodes will not have, are reported unschedulable
+2.) the remaining pods are grouped by the instance types they can use
+    and each group is packed onto the cheapest of them, identical pods
+    (replicas) are placed in one vectorized NumPy step
+3.) the projected nodes are checked against the NodePool limits
+
+Pods are Kubernetes Pod objects as JSON dicts, for example the items of
+`kubectl get pods -A -o json`. DaemonSet pods are not packed, the
+largest per node DaemonSet footprint is reserved on every projected node.
+"""
+
+import sys
+import time
+
+from sharedlib.catalog import load_catalog, requirement_matches
+from sharedlib.catalog import price as catalog_price
+from sharedlib.pods import (MIB, is_daemonset_pod, is_finished, pod_name, pod_request,
+                            quantity)
+
+# Karpenter defaults used to estimate allocatable capacity
+VM_MEMORY_OVERHEAD = 0.075
+EVICTION_THRESHOLD_MIB = 100
+NODEPOOL_LABEL = "karpenter.sh/nodepool"
+SCHEDULING_EFFECTS = ("NoSchedule", "NoExecute")
+
+
+def reserved_cpu_millicores(vcpu):
+    """
+    Return the kube-reserved cpu of a node, 6% of the first core, 1% of
+    the second, 0.5% of the next two and 0.25% of the others
+    """
+    cores = [(1, 60), (1, 10), (2, 5), (max(0, vcpu - 4), 2.5)]
+    reserved = 0.0
+    remaining = vcpu
+    for count, millicores in cores:
+        used = min(remaining, count)
+        reserved += used * millicores
+        remaining -= used
+    return reserved
+
+
+def allocatable(info):
+    """
+    Return the (cpu cores, memory MiB, pods) allocatable on an instance type
+    """
+    max_pods = info['maxPods']
+    cpu = info['vcpu'] - reserved_cpu_millicores(info['vcpu']) / 1000
+    memory = (info['memoryMiB'] * (1 - VM_MEMORY_OVERHEAD) -
+              (11 * max_pods + 255) - EVICTION_THRESHOLD_MIB)
+    return cpu, memory, max_pods
+
+
+def tolerates(tolerations, taint):
+    for toleration in tolerations:
+        effect = toleration.get('effect')
+        if effect and effect != taint['effect']:
+            continue
+        key = toleration.get('key')
+        if not key:
+            if toleration.get('operator') == "Exists":
+                return True
+            continue
+        if key != taint['key']:
+            continue
+        if toleration.get('operator') == "Exists":
+            return True
+        if toleration.get('value', "") == taint.get('value', ""):
+            return True
+    return False
+
+
+class NodePoolConstraints:
+    """
+    The scheduling constraints of a NodePool resolved against a catalog
+    """
+
+    def __init__(self, nodepool, catalog):
+        template = nodepool['spec']['template']
+        spec = template['spec']
+        self.name = nodepool['metadata']['name']
+        self.catalog = catalog
+        self.requirements = spec.get('requirements') or []
+        self.labels = dict((template.get('metadata') or {}).get('labels') or {})
+        self.labels[NODEPOOL_LABEL] = self.name
+        self.taints = [taint for taint in spec.get('taints') or []
+                       if taint['effect'] in SCHEDULING_EFFECTS]
+        self.limits = nodepool['spec'].get('limits') or {}
+        self.candidates = catalog.matching(self.requirements)
+        self.warnings = []
+        for requirement in self.requirements:
+            if requirement['key'] == "node.kubernetes.io/instance-type" and \
+                    requirement['operator'] == "In":
+                unknown = [name for name in requirement.get('values') or []
+                           if catalog.get(name) is None]
+                if unknown:
+                    self.warnings.append("instance types not in the catalog: " +
+                                         ", ".join(unknown))
+        instance_label_keys = set()
+        for labels in catalog.labels.values():
+            instance_label_keys.update(labels)
+        self.instance_label_keys = instance_label_keys
+        self._selector_cache = {}
+
+    def _selector(self, node_selector):
+        """
+        Return (candidate instance types, reason) for a node selector
+        """
+        key = tuple(sorted(node_selector.items()))
+        if key in self._selector_cache:
+            return self._selector_cache[key]
+        candidates = self.candidates
+        reason = None
+        for label, value in key:
+            if label in self.instance_label_keys:
+                candidates = [name for name in candidates
+                              if self.catalog.labels[name].get(label) == value]
+                if not candidates:
+                    reason = "no allowed instance type has %s=%s" % (label, value)
+                    break
+                continue
+            if label in self.labels:
+                if self.labels[label] != value:
+                    reason = "node selector %s=%s, NodePool sets %s" % (
+                        label, value, self.labels[label])
+                    break
+                continue
+            requirements = [r for r in self.requirements if r['key'] == label]
+            if not requirements:
+                reason = "node selector %s=%s not provided by the NodePool" % (label, value)
+                break
+            if not all(requirement_matches(r, {label: value}) for r in requirements):
+                reason = "node selector %s=%s not allowed by the NodePool requirements" % (
+                    label, value)
+                break
+        result = (tuple(candidates), reason)
+        self._selector_cache[key] = result
+        return result
+
+    def place(self, pod):
+        """
+        Return (candidate instance types, reason unschedulable or None)
+        """
+        tolerations = (pod.get('spec') or {}).get('tolerations') or []
+        for taint in self.taints:
+            if not tolerates(tolerations, taint):
+                return (), "does not tolerate taint %s=%s:%s" % (
+                    taint['key'], taint.get('value', ""), taint['effect'])
+        if not self.candidates:
+            return (), "no catalog instance type satisfies the NodePool requirements"
+        node_selector = (pod.get('spec') or {}).get('nodeSelector') or {}
+        if not node_selector:
+            return tuple(self.candidates), None
+        return self._selector(node_selector)
+
+
+def daemonset_overhead(pods):
+    """
+    Return the largest (cpu, memory MiB, pods) used by DaemonSets on a node
+    """
+    nodes = {}
+    for pod in pods:
+        if not is_daemonset_pod(pod) or is_finished(pod):
+            continue
+        node = (pod.get('spec') or {}).get('nodeName')
+        usage = nodes.setdefault(node, [0.0, 0.0, 0])
+        usage[0] += pod_request(pod, 'cpu')
+        usage[1] += pod_request(pod, 'memory') / MIB
+        usage[2] += 1
+    if not nodes:
+        return 0.0, 0.0, 0
+    return tuple(max(usage[i] for usage in nodes.values()) for i in range(3))
+
+
+def first_fit_decreasing(cpu, memory, capacity):
+    """
+    Pack pods with the given requests first-fit-decreasing onto nodes of
+    one capacity (cpu, memory, pods). Returns the number of nodes and
+    their used cpu and memory.
+
+    Pods are ordered by decreasing dominant share, so replicas of the same
+    size are adjacent. Each run of identical pods is placed in one step:
+    first-fit fills the open nodes in order with as many pods as fit, then
+    opens new full nodes.
+    """
+    import numpy as np
+    cap_cpu, cap_memory, cap_pods = capacity
+    used_cpu = np.zeros(0)
+    used_memory = np.zeros(0)
+    used_pods = np.zeros(0, dtype=np.int64)
+    if not len(cpu):
+        return 0, used_cpu, used_memory
+    dominant = np.maximum(cpu / cap_cpu, memory / cap_memory)
+    order = np.lexsort((-memory, -cpu, -dominant))
+    cpu = cpu[order]
+    memory = memory[order]
+    changes = np.flatnonzero((np.diff(cpu) != 0) | (np.diff(memory) != 0)) + 1
+    starts = np.concatenate(([0], changes))
+    counts = np.diff(np.concatenate((starts, [len(cpu)])))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start, count in zip(starts, counts):
+            pod_cpu = cpu[start]
+            pod_memory = memory[start]
+            fit = np.minimum(cap_pods - used_pods, np.minimum(
+                np.floor((cap_cpu - used_cpu) / pod_cpu) if pod_cpu else np.inf,
+                np.floor((cap_memory - used_memory) / pod_memory) if pod_memory else np.inf))
+            fit = np.maximum(fit, 0).astype(np.int64)
+            before = np.cumsum(fit) - fit
+            placed = np.clip(count - before, 0, fit)
+            used_cpu = used_cpu + placed * pod_cpu
+            used_memory = used_memory + placed * pod_memory
+            used_pods = used_pods + placed
+            remaining = int(count - placed.sum())
+            if not remaining:
+                continue
+            per_node = int(min(cap_pods,
+                               cap_cpu // pod_cpu if pod_cpu else cap_pods,
+                               cap_memory // pod_memory if pod_memory else cap_pods))
+            full, last = divmod(remaining, per_node)
+            new_pods = np.full(full + (1 if last else 0), per_node, dtype=np.int64)
+            if last:
+                new_pods[-1] = last
+            used_cpu = np.concatenate((used_cpu, new_pods * pod_cpu))
+            used_memory = np.concatenate((used_memory, new_pods * pod_memory))
+            used_pods = np.concatenate((used_pods, new_pods))
+    return len(used_pods), used_cpu, used_memory
+
+
+def _pack_group(cpu, memory, candidates, catalog, overhead):
+    """
+    Pack a group of pods onto the cheapest candidate instance type.
+    Returns (instance type, nodes, unschedulable pod indexes).
+    """
+    import numpy as np
+    best = None
+    for instance_type in candidates:
+        info = catalog.get(instance_type)
+        cap_cpu, cap_memory, cap_pods = allocatable(info)
+        capacity = (cap_cpu - overhead[0], cap_memory - overhead[1], cap_pods - overhead[2])
+        if min(capacity) <= 0:
+            continue
+        fits = (cpu <= capacity[0]) & (memory <= capacity[1])
+        nodes, _, _ = first_fit_decreasing(cpu[fits], memory[fits], capacity)
+        # schedule as many pods as possible, then minimize the hourly cost
+        key = (-int(fits.sum()), nodes * catalog_price(info), instance_type)
+        if best is None or key < best[0]:
+            best = (key, instance_type, nodes, np.flatnonzero(~fits))
+    if best is None:
+        return None, 0, np.arange(len(cpu))
+    return best[1], best[2], best[3]
+
+
+def _parse_limit(value):
+    return quantity(value) if value is not None else None
+
+
+def simulate(nodepool, pods, catalog=None):
+    """
+    Simulate scheduling pods on the nodes a NodePool would launch.
+    Returns a report dict, report["ok"] is False if a pod would be left
+    unschedulable or the NodePool limits would be exceeded.
+    """
+    # NumPy is only needed to pack, not to read pods (see sharedlib.pods)
+    import numpy as np
+    start = time.perf_counter()
+    catalog = catalog or load_catalog()
+    constraints = NodePoolConstraints(nodepool, catalog)
+    overhead = daemonset_overhead(pods)
+    unschedulable = []
+    groups = {}
+    for pod in pods:
+        if is_daemonset_pod(pod) or is_finished(pod):
+            continue
+        candidates, reason = constraints.place(pod)
+        if reason is not None:
+            unschedulable.append({"pod": pod_name(pod), "reason": reason})
+            continue
+        group = groups.setdefault(candidates, ([], [], []))
+        group[0].append(pod_request(pod, 'cpu'))
+        group[1].append(pod_request(pod, 'memory') / MIB)
+        group[2].append(pod_name(pod))
+    nodes = {}
+    cpu_total = 0.0
+    memory_total = 0.0
+    cost = 0.0
+    scheduled = 0
+    for candidates, (cpu, memory, names) in groups.items():
+        cpu = np.asarray(cpu, dtype=np.float64)
+        memory = np.asarray(memory, dtype=np.float64)
+        instance_type, count, rejected = _pack_group(
+            cpu, memory, candidates, catalog, overhead)
+        for i in rejected:
+            unschedulable.append({"pod": names[i],
+                                  "reason": "requests exceed every allowed instance type"})
+        scheduled += len(names) - len(rejected)
+        if not count:
+            continue
+        info = catalog.get(instance_type)
+        nodes[instance_type] = nodes.get(instance_type, 0) + count
+        cpu_total += count * info['vcpu']
+        memory_total += count * info['memoryMiB']
+        cost += count * catalog_price(info)
+    violations = []
+    cpu_limit = _parse_limit(constraints.limits.get('cpu'))
+    if cpu_limit is not None and cpu_total > cpu_limit:
+        violations.append("projected %g cpu exceeds limits.cpu %g" % (cpu_total, cpu_limit))
+    memory_limit = _parse_limit(constraints.limits.get('memory'))
+    if memory_limit is not None and memory_total * MIB > memory_limit:
+        violations.append("projected %g MiB exceeds limits.memory %g MiB" %
+                          (memory_total, memory_limit / MIB))
+    return {
+        "nodepool": constraints.name,
+        "pods": scheduled + len(unschedulable),
+        "scheduled": scheduled,
+        "unschedulable": unschedulable,
+        "nodes": dict(sorted(nodes.items())),
+        "nodeCount": sum(nodes.values()),
+        "projectedCpu": cpu_total,
+        "projectedMemoryMiB": memory_total,
+        "hourlyCost": round(cost, 4),
+        "daemonSetOverhead": {"cpu": overhead[0], "memoryMiB": overhead[1],
+                              "pods": overhead[2]},
+        "limitViolations": violations,
+        "warnings": constraints.warnings,
+        "ok": not unschedulable and not violations,
+        "elapsedSeconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def print_report(report, file=sys.stderr, max_pods=20):
+    print("Pre-flight for NodePool %s: %d/%d pods scheduled on %d nodes (%s), "
+          "$%.2f/hour, %.2fs" %
+          (report['nodepool'], report['scheduled'], report['pods'], report['nodeCount'],
+           ", ".join("%s=%d" % item for item in report['nodes'].items()) or "none",
+           report['hourlyCost'], report['elapsedSeconds']), file=file)
+    for warning in report['warnings']:
+        print("  warning: " + warning, file=file)
+    for violation in report['limitViolations']:
+        print("  limit: " + violation, file=file)
+    for entry in report['unschedulable'][:max_pods]:
+        print("  unschedulable %s: %s" % (entry['pod'], entry['reason']), file=file)
+    if len(report['unschedulable']) > max_pods:
+        print("  ... and %d more unschedulable pods" %
+              (len(report['unschedulable']) - max_pods), file=file)
+
+
+def load_pods(stream):
+    """
+    Return the pods of a Pod, a PodList (kubectl get pods -o json) or a list
+    """
+    import json
+    document = json.load(stream)
+    if isinstance(document, list):
+        return document
+    if document.get('kind') == "Pod":
+        return [document]
+    return document.get('items') or []
+
+
+def live_nodegroup_pods(nodegroup_name):
+    """
+    Return the pods, DaemonSets included, on a node group's nodes as dicts
+    """
+    from sharedlib import infra
+    from sharedlib.drain import list_nodegroup_nodes
+    core = infra.get_core_api()
+    pods = []
+    for node_name in list_nodegroup_nodes(nodegroup_name):
+        pods.extend(core.list_pod_for_all_namespaces(
+            field_selector="spec.nodeName=%s" % node_name).items)
+    return core.api_client.sanitize_for_serialization(pods)
+
+
+class PreflightError(Exception):
+    pass
+
+
+def preflight(nodegroup_name, nodepool, catalog=None):
+    """
+    Simulate the pods of a node group on its NodePool, raise PreflightError
+    if the NodePool cannot absorb them
+    """
+    report = simulate(nodepool, live_nodegroup_pods(nodegroup_name), catalog)
+    print_report(report)
+    if not report['ok']:
+        raise PreflightError("NodePool %s cannot absorb the pods of nodegroup %s" %
+                             (nodepool['metadata']['name'], nodegroup_name))
+    return report
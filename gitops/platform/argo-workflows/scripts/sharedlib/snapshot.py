@@ -0,0 +1,108 @@
+"""
+Cluster snapshot
+
+A compact, versioned JSON document with everything
+generate_karpenter_node_class and generate_karpenter_node_pool need for
+every node group of a cluster, captured in one discovery pass. The
+get-nodegroups step writes it as an Argo artifact and the fan-out steps
+generate from it offline, without describing AWS again.
+
+{
+  "version": 1,
+  "cluster": {"name": ..., "region": ..., "clusterSecurityGroupId": ...},
+  "nodegroups": {"<name>": {<describe_nodegroup subset>, "securityGroups": [...]}}
+}
+"""
+
+import json
+import sys
+
+SNAPSHOT_VERSION = 1
+
+# describe_nodegroup fields used by the generators
+NODEGROUP_FIELDS = (
+    "nodegroupName", "clusterName", "subnets", "tags", "amiType", "nodeRole",
+    "capacityType", "instanceTypes", "labels", "taints", "scalingConfig",
+    "launchTemplate", "releaseVersion", "version",
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def compact_nodegroup(nodegroup, security_groups):
+    compact = {field: nodegroup[field] for field in NODEGROUP_FIELDS
+               if nodegroup.get(field) is not None}
+    compact.setdefault("taints", [])
+    compact.setdefault("tags", {})
+    compact["securityGroups"] = security_groups
+    return compact
+
+
+def build_snapshot(eks, ec2, cluster, selector=None, max_workers=8):
+    """
+    Describe the cluster and its node groups once and return the snapshot
+    """
+    from sharedlib import infra
+    from sharedlib.discovery import discover_nodegroups
+    cluster_description = infra.describe_cluster(eks, cluster)
+    nodegroups = {}
+    for nodegroup in discover_nodegroups(eks, cluster, selector, max_workers):
+        # launch template versions and the cluster are cached across node groups
+        security_groups = infra.get_nodegroup_sg(eks, ec2, nodegroup)
+        nodegroups[nodegroup['nodegroupName']] = compact_nodegroup(
+            nodegroup, security_groups)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "cluster": {
+            "name": cluster,
+            "region": eks.meta.region_name,
+            "clusterSecurityGroupId":
+                cluster_description['resourcesVpcConfig'].get('clusterSecurityGroupId'),
+        },
+        "nodegroups": dict(sorted(nodegroups.items())),
+    }
+
+
+def write_snapshot(snapshot, path):
+    data = json.dumps(snapshot, sort_keys=True, separators=(",", ":"))
+    if path == "-":
+        sys.stdout.write(data)
+        return
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def read_snapshot(path):
+    if path == "-":
+        snapshot = json.load(sys.stdin)
+    else:
+        with open(path) as f:
+            snapshot = json.load(f)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError("unsupported snapshot version %r" % snapshot.get("version"))
+    return snapshot
+
+
+def get_nodegroup(snapshot, nodegroup_name):
+    nodegroup = snapshot["nodegroups"].get(nodegroup_name)
+    if nodegroup is None:
+        raise SnapshotError("nodegroup %s is not in the snapshot of cluster %s" %
+                            (nodegroup_name, snapshot["cluster"]["name"]))
+    return nodegroup
+
+
+def generate_from_snapshot(snapshot, nodegroup_name, nodeclass_mode="per-nodegroup",
+                           instance_mode="exact", disruption=None):
+    """
+    Return the EC2NodeClass and NodePool of a node group without any AWS
+    call, with the disruption settings of sharedlib.workload if given
+    """
+    from sharedlib import render
+    nodegroup = get_nodegroup(snapshot, nodegroup_name)
+    objects = render.render_nodegroup(nodegroup, instance_mode=instance_mode,
+                                      disruption=disruption)
+    if nodeclass_mode == render.NODECLASS_SHARED:
+        objects = list(render.share_node_class(*objects))
+    return objects
@@ -0,0 +1,405 @@
+"""
+Post-migration verification report
+
+A snapshot of the nodes, pods and NodeClaims of the cluster is taken
+before and after the migration. Both are streamed through paginated LISTs
+(`limit`/`continue`), one page in memory at a time, and kept as a few
+columns per object rather than the objects themselves. The aggregates are
+computed over the columns with NumPy:
+
+- pods left Pending and unscheduled, nodes not Ready, NodeClaims not Ready
+- time to schedule percentiles (creation to PodScheduled), after the
+  migration over the pods created since the before snapshot, ie. the
+  pods evicted by the drain and scale down
+- cpu and memory packing efficiency, requested over allocatable of the
+  Ready nodes
+- nodes, efficiency and estimated hourly cost per former node group: the
+  node group nodes before, its NodePool's nodes after (labelled
+  migrate.karpenter.io/nodegroup)
+
+The report is written as JSON with gates, ie. no new pending pods, that
+fail the Argo step:
+
+    python -m sharedlib verify snapshot --cluster argocon-1 --output-file /tmp/before.json
+    python -m sharedlib verify report --cluster argocon-1 --before /tmp/before.json \\
+        --output-file /tmp/verify.json
+"""
+
+import datetime
+import functools
+import json
+import math
+import sys
+
+from sharedlib.pagination import PAGE_SIZE, paginate
+from sharedlib.pods import MIB, pod_name, pod_request, quantity
+from sharedlib.workload import parse_timestamp
+
+SNAPSHOT_VERSION = 1
+EKS_NODEGROUP_LABEL = "eks.amazonaws.com/nodegroup"
+MIGRATED_NODEGROUP_LABEL = "migrate.karpenter.io/nodegroup"
+NODEPOOL_LABEL = "karpenter.sh/nodepool"
+INSTANCE_TYPE_LABEL = "node.kubernetes.io/instance-type"
+CAPACITY_TYPE_LABELS = ("karpenter.sh/capacity-type", "eks.amazonaws.com/capacityType")
+NODECLAIM = ("karpenter.sh", "v1beta1", "nodeclaims")
+# rough spot price as a fraction of on-demand, the catalog only has the latter
+SPOT_PRICE_RATIO = 0.35
+PERCENTILES = (50, 90, 99)
+# names listed in the report per problem, the counts are always complete
+MAX_LISTED = 20
+
+NODE_COLUMNS = ("name", "nodegroup", "instanceType", "capacityType", "ready", "cpu",
+                "memoryMiB")
+POD_COLUMNS = ("name", "node", "phase", "cpu", "memoryMiB", "created", "scheduled")
+NODECLAIM_COLUMNS = ("name", "nodepool", "ready")
+
+# gate name -> default threshold, None disables the gate
+DEFAULT_GATES = {
+    # pods Pending after the migration, beyond those Pending before
+    "new-pending-pods": 0,
+    "not-ready-nodes": 0,
+    "not-ready-nodeclaims": 0,
+    # seconds, p90 time to schedule of the pods created during the migration
+    "schedule-p90-seconds": 300,
+    # drop of the cluster cpu and memory packing efficiency, in points
+    "efficiency-drop": 0.1,
+    # hourly cost after over before, ie. 1.1 for 10% more
+    "cost-ratio": None,
+}
+
+
+class VerifyError(Exception):
+    pass
+
+
+def parse_gates(specs):
+    """
+    Return the thresholds of `name=value` gate specs, `name=off` disables
+    a gate
+    """
+    thresholds = {}
+    for spec in specs or ():
+        name, _, value = spec.partition("=")
+        if name not in DEFAULT_GATES:
+            raise VerifyError("unknown gate %s, one of %s" % (name, ", ".join(DEFAULT_GATES)))
+        try:
+            thresholds[name] = None if value == "off" else float(value)
+        except ValueError:
+            raise VerifyError("gate %s: %r is not a number or off" % (name, value))
+    return thresholds
+
+
+def _epoch(value):
+    timestamp = parse_timestamp(value)
+    return None if timestamp is None else timestamp.timestamp()
+
+
+def _condition(obj, condition_type):
+    for condition in (obj.get('status') or {}).get('conditions') or []:
+        if condition.get('type') == condition_type:
+            return condition
+    return {}
+
+
+def _former_nodegroup(labels):
+    return labels.get(EKS_NODEGROUP_LABEL) or labels.get(MIGRATED_NODEGROUP_LABEL) or ""
+
+
+def _capacity_type(labels):
+    for label in CAPACITY_TYPE_LABELS:
+        if labels.get(label):
+            return labels[label].lower().replace("_", "-")
+    return ""
+
+
+def node_row(node):
+    metadata = node.get('metadata') or {}
+    labels = metadata.get('labels') or {}
+    allocatable = (node.get('status') or {}).get('allocatable') or {}
+    return (metadata.get('name'), _former_nodegroup(labels),
+            labels.get(INSTANCE_TYPE_LABEL, ""), _capacity_type(labels),
+            _condition(node, "Ready").get('status') == "True",
+            quantity(allocatable.get('cpu')), quantity(allocatable.get('memory')) / MIB)
+
+
+def pod_row(pod):
+    metadata = pod.get('metadata') or {}
+    scheduled = _condition(pod, "PodScheduled")
+    return (pod_name(pod), (pod.get('spec') or {}).get('nodeName') or "",
+            (pod.get('status') or {}).get('phase', ""),
+            pod_request(pod, 'cpu'), pod_request(pod, 'memory') / MIB,
+            _epoch(metadata.get('creationTimestamp')),
+            _epoch(scheduled.get('lastTransitionTime'))
+            if scheduled.get('status') == "True" else None)
+
+
+def nodeclaim_row(nodeclaim):
+    metadata = nodeclaim.get('metadata') or {}
+    labels = metadata.get('labels') or {}
+    return (metadata.get('name'), labels.get(NODEPOOL_LABEL, ""),
+            _condition(nodeclaim, "Ready").get('status') == "True")
+
+
+def _columns(names, rows):
+    columns = {name: [] for name in names}
+    count = 0
+    for row in rows:
+        for name, value in zip(names, row):
+            columns[name].append(value)
+        count += 1
+    return columns, count
+
+
+def capture(cluster=None, page_size=PAGE_SIZE, now=None):
+    """
+    Stream the nodes, pods and NodeClaims of the cluster into a columnar
+    snapshot. Clusters without the NodeClaim CRD have no NodeClaims.
+    """
+    from kubernetes.client.rest import ApiException
+    from sharedlib import infra
+    core = infra.get_core_api()
+    custom = infra.get_custom_objects_api()
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    snapshot = {"version": SNAPSHOT_VERSION, "cluster": cluster,
+                "capturedAt": now.isoformat(), "counts": {}}
+    for key, names, rows in (
+            ("nodes", NODE_COLUMNS,
+             (node_row(node) for node in paginate(core, core.list_node, page_size))),
+            ("pods", POD_COLUMNS,
+             (pod_row(pod) for pod in
+              paginate(core, core.list_pod_for_all_namespaces, page_size)))):
+        snapshot[key], snapshot["counts"][key] = _columns(names, rows)
+    try:
+        snapshot["nodeClaims"], snapshot["counts"]["nodeClaims"] = _columns(
+            NODECLAIM_COLUMNS, (nodeclaim_row(nodeclaim) for nodeclaim in paginate(
+                custom, functools.partial(custom.list_cluster_custom_object, *NODECLAIM),
+                page_size)))
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        print("No NodeClaims in the cluster", file=sys.stderr)
+        snapshot["nodeClaims"], snapshot["counts"]["nodeClaims"] = _columns(
+            NODECLAIM_COLUMNS, ())
+    print("Captured %s" % ", ".join("%d %s" % (count, key) for key, count in
+                                    snapshot["counts"].items()), file=sys.stderr)
+    return snapshot
+
+
+def write_snapshot(snapshot, path):
+    with open(path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+
+
+def read_snapshot(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise VerifyError("%s: unsupported verify snapshot version %s" %
+                          (path, snapshot.get("version")))
+    return snapshot
+
+
+def _floats(values):
+    import numpy as np
+    # None -> NaN
+    return np.array(values, dtype=np.float64)
+
+
+def _ratio(numerator, denominator):
+    return None if not denominator else round(float(numerator / denominator), 4)
+
+
+def _round(value, digits=2):
+    return None if value is None or math.isnan(value) else round(float(value), digits)
+
+
+def _listed(names, mask):
+    import numpy as np
+    return [names[i] for i in np.flatnonzero(mask)[:MAX_LISTED]]
+
+
+def node_prices(nodes, catalog):
+    """
+    Return the estimated hourly price of every node, NaN for instance
+    types missing from the catalog
+    """
+    import numpy as np
+    from sharedlib.catalog import price
+    prices = {}
+    for instance_type in set(nodes["instanceType"]):
+        info = catalog.get(instance_type) if instance_type else None
+        prices[instance_type] = np.nan if info is None else price(info)
+    on_demand = _floats([prices[instance_type] for instance_type in nodes["instanceType"]])
+    spot = np.array([capacity == "spot" for capacity in nodes["capacityType"]], dtype=bool)
+    return np.where(spot, on_demand * SPOT_PRICE_RATIO, on_demand)
+
+
+def aggregate(snapshot, catalog=None, since=None):
+    """
+    Return the aggregates of a snapshot. Time to schedule covers the pods
+    created at or after `since` (epoch seconds), all of them without.
+    """
+    import numpy as np
+    from sharedlib.catalog import load_catalog
+    catalog = catalog or load_catalog()
+    nodes, pods, nodeclaims = snapshot["nodes"], snapshot["pods"], snapshot["nodeClaims"]
+
+    ready = np.array(nodes["ready"], dtype=bool)
+    allocatable_cpu = _floats(nodes["cpu"])
+    allocatable_memory = _floats(nodes["memoryMiB"])
+    prices = node_prices(nodes, catalog)
+
+    node_index = {name: i for i, name in enumerate(nodes["name"])}
+    pod_node = np.array([node_index.get(name, -1) for name in pods["node"]], dtype=np.int64)
+    phase = np.array(pods["phase"], dtype=object)
+    finished = (phase == "Succeeded") | (phase == "Failed")
+    # requests held on a node by its pods, per node
+    placed = (pod_node >= 0) & ~finished
+    requested_cpu = np.bincount(pod_node[placed], weights=_floats(pods["cpu"])[placed],
+                                minlength=len(ready))
+    requested_memory = np.bincount(pod_node[placed],
+                                   weights=_floats(pods["memoryMiB"])[placed],
+                                   minlength=len(ready))
+
+    pending = phase == "Pending"
+    unscheduled = pending & (np.array(pods["node"], dtype=object) == "")
+    created = _floats(pods["created"])
+    to_schedule = _floats(pods["scheduled"]) - created
+    window = ~np.isnan(to_schedule)
+    if since is not None:
+        window &= created >= since
+    timing = {"pods": int(window.sum())}
+    if window.any():
+        for percentile, value in zip(PERCENTILES,
+                                     np.percentile(to_schedule[window], PERCENTILES)):
+            timing["p%d" % percentile] = _round(value, 1)
+        timing["max"] = _round(to_schedule[window].max(), 1)
+
+    nodeclaim_ready = np.array(nodeclaims["ready"], dtype=bool)
+    return {
+        "capturedAt": snapshot["capturedAt"],
+        "nodes": len(ready),
+        "notReadyNodes": int((~ready).sum()),
+        "notReady": _listed(nodes["name"], ~ready),
+        "pods": len(phase),
+        "pendingPods": int(pending.sum()),
+        "unscheduledPods": int(unscheduled.sum()),
+        "pending": _listed(pods["name"], pending),
+        "timeToScheduleSeconds": timing,
+        "cpuEfficiency": _ratio(requested_cpu[ready].sum(), allocatable_cpu[ready].sum()),
+        "memoryEfficiency": _ratio(requested_memory[ready].sum(),
+                                   allocatable_memory[ready].sum()),
+        "hourlyCost": _round(np.nansum(prices)),
+        "unpricedNodes": int(np.isnan(prices).sum()),
+        "nodeClaims": len(nodeclaim_ready),
+        "notReadyNodeClaims": int((~nodeclaim_ready).sum()),
+        "notReadyNodeClaimNames": _listed(nodeclaims["name"], ~nodeclaim_ready),
+        "nodegroups": _per_nodegroup(nodes["nodegroup"], ready, allocatable_cpu,
+                                     allocatable_memory, requested_cpu, requested_memory,
+                                     prices),
+    }
+
+
+def _per_nodegroup(nodegroups, ready, allocatable_cpu, allocatable_memory, requested_cpu,
+                   requested_memory, prices):
+    import numpy as np
+    if not len(ready):
+        return {}
+    names, group = np.unique(np.array(nodegroups, dtype=object), return_inverse=True)
+
+    def total(values, mask=None):
+        weights = values if mask is None else np.where(mask, values, 0.0)
+        return np.bincount(group, weights=weights, minlength=len(names))
+
+    nodes = np.bincount(group, minlength=len(names))
+    ready_nodes = np.bincount(group, weights=ready.astype(np.float64), minlength=len(names))
+    cpu = total(requested_cpu, ready), total(allocatable_cpu, ready)
+    memory = total(requested_memory, ready), total(allocatable_memory, ready)
+    cost = total(np.nan_to_num(prices))
+    return {str(name) or "(none)": {
+        "nodes": int(nodes[i]),
+        "readyNodes": int(ready_nodes[i]),
+        "cpuEfficiency": _ratio(cpu[0][i], cpu[1][i]),
+        "memoryEfficiency": _ratio(memory[0][i], memory[1][i]),
+        "hourlyCost": _round(cost[i]),
+    } for i, name in enumerate(names)}
+
+
+def evaluate_gates(before, after, thresholds=None):
+    """
+    Return the gates as [{gate, value, threshold, ok}], disabled gates
+    (threshold None) are left out
+    """
+    thresholds = dict(DEFAULT_GATES, **(thresholds or {}))
+    efficiency_drop = max(
+        [before[key] - after[key] for key in ("cpuEfficiency", "memoryEfficiency")
+         if before[key] is not None and after[key] is not None] or [0.0])
+    values = {
+        "new-pending-pods": after["pendingPods"] - before["pendingPods"],
+        "not-ready-nodes": after["notReadyNodes"],
+        "not-ready-nodeclaims": after["notReadyNodeClaims"],
+        "schedule-p90-seconds": after["timeToScheduleSeconds"].get("p90"),
+        "efficiency-drop": round(efficiency_drop, 4),
+        "cost-ratio": _ratio(after["hourlyCost"] or 0.0, before["hourlyCost"]),
+    }
+    gates = []
+    for gate, threshold in thresholds.items():
+        if threshold is None:
+            continue
+        value = values[gate]
+        # no pods rescheduled, or no cost before: nothing to compare
+        ok = value is None or value <= threshold
+        gates.append({"gate": gate, "value": value, "threshold": threshold, "ok": ok})
+    return gates
+
+
+def build_report(before_snapshot, after_snapshot, catalog=None, thresholds=None):
+    since = _epoch(before_snapshot["capturedAt"])
+    before = aggregate(before_snapshot, catalog)
+    after = aggregate(after_snapshot, catalog, since)
+    nodegroups = {}
+    for name in sorted(set(before["nodegroups"]) | set(after["nodegroups"])):
+        nodegroups[name] = {"before": before["nodegroups"].get(name),
+                            "after": after["nodegroups"].get(name)}
+    gates = evaluate_gates(before, after, thresholds)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "cluster": after_snapshot.get("cluster") or before_snapshot.get("cluster"),
+        "ok": all(gate["ok"] for gate in gates),
+        "gates": gates,
+        "before": {key: value for key, value in before.items() if key != "nodegroups"},
+        "after": {key: value for key, value in after.items() if key != "nodegroups"},
+        "nodegroups": nodegroups,
+    }
+
+
+def write_report(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def print_report(report, file=sys.stderr):
+    before, after = report["before"], report["after"]
+    print("Verification for cluster %s:" % report["cluster"], file=file)
+    for label, key in (("nodes", "nodes"), ("not ready nodes", "notReadyNodes"),
+                       ("pending pods", "pendingPods"), ("cpu efficiency", "cpuEfficiency"),
+                       ("memory efficiency", "memoryEfficiency"),
+                       ("hourly cost", "hourlyCost"), ("nodeclaims", "nodeClaims")):
+        print("  %-20s %10s -> %s" % (label, before[key], after[key]), file=file)
+    print("  %-20s %10s -> %s" % ("schedule p50/p90/p99",
+                                  "/".join(str(before["timeToScheduleSeconds"].get("p%d" % p))
+                                           for p in PERCENTILES),
+                                  "/".join(str(after["timeToScheduleSeconds"].get("p%d" % p))
+                                           for p in PERCENTILES)), file=file)
+    for name, entry in report["nodegroups"].items():
+        parts = []
+        for when in ("before", "after"):
+            stats = entry[when]
+            parts.append("-" if stats is None else "%d nodes cpu=%s $%s/h" % (
+                stats["nodes"], stats["cpuEfficiency"], stats["hourlyCost"]))
+        print("  nodegroup %-30s %s -> %s" % (name, parts[0], parts[1]), file=file)
+    for gate in report["gates"]:
+        print("  gate %-22s %-4s value=%s threshold=%s" % (
+            gate["gate"], "ok" if gate["ok"] else "FAIL", gate["value"], gate["threshold"]),
+            file=file)
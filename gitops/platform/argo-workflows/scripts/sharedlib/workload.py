@@ -0,0 +1,297 @@
+"""
+Workload profiles and the NodePool disruption settings chosen from them
+
+Instead of `consolidationPolicy: WhenEmpty` and `consolidateAfter: 30s`
+for every NodePool, the nodes and pods of the node groups are streamed
+through paginated LISTs (`limit`/`continue`), one page in memory at a
+time, and aggregated per node group:
+
+- requested versus allocatable cpu and memory of every node
+- pod lifetimes, in a fixed set of buckets, and the share of Job pods
+- StatefulSet pods and pods annotated karpenter.sh/do-not-disrupt
+
+Then per node group:
+
+- consolidationPolicy WhenUnderutilized for long running workloads on
+  underutilized nodes, so half empty nodes are consolidated
+- WhenEmpty with a consolidateAfter covering the gaps between short lived
+  (batch) pods, so nodes are not churned between them, and for nodes
+  already packed
+- expireAfter Never for stateful workloads, 720h otherwise
+
+No disruption budgets are set: `spec.disruption.budgets` arrived in
+Karpenter v0.34 and the deployed v0.33.1 (gitops/bootstrap/addons) would
+drop them, the report says so instead.
+
+Every choice comes with its reason in the report:
+
+    python -m sharedlib profile --cluster argocon-1 --nodegroup team-a
+"""
+
+import datetime
+import sys
+
+from sharedlib.drain import NODEGROUP_NODE_LABEL
+from sharedlib.pagination import PAGE_SIZE, paginate
+from sharedlib.pods import is_daemonset_pod, is_finished, pod_request, quantity
+
+# list the pods per node up to this many nodes, cluster wide above
+PER_NODE_LISTS = 20
+# pod lifetime buckets, in seconds
+LIFETIME_BUCKETS = (60, 300, 900, 3600, 6 * 3600, 24 * 3600, 7 * 24 * 3600)
+SHORT_LIVED = 3600
+BATCH_SHARE = 0.5
+UNDERUTILIZED = 0.5
+PACKED = 0.8
+MIN_CONSOLIDATE_AFTER = 60
+MAX_CONSOLIDATE_AFTER = 900
+DEFAULT_EXPIRE_AFTER = "720h"
+DO_NOT_DISRUPT = "karpenter.sh/do-not-disrupt"
+
+# profile (opt-in): from the node group workload, default: render.DEFAULT_DISRUPTION
+DISRUPTION_PROFILE = "profile"
+DISRUPTION_DEFAULT = "default"
+DISRUPTION_MODES = (DISRUPTION_PROFILE, DISRUPTION_DEFAULT)
+
+
+class NodegroupProfile:
+    """
+    Aggregates of the nodes and pods of one node group, independent of
+    the number of pods
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # node name -> [allocatable cpu, memory, requested cpu, memory]
+        self.nodes = {}
+        self.pods = 0
+        self.job_pods = 0
+        self.stateful_pods = 0
+        self.do_not_disrupt = 0
+        self.lifetimes = [0] * (len(LIFETIME_BUCKETS) + 1)
+
+    def add_node(self, node_name, allocatable):
+        self.nodes[node_name] = [quantity(allocatable.get('cpu')),
+                                 quantity(allocatable.get('memory')), 0.0, 0.0]
+
+    def add_pod(self, pod, now):
+        node = self.nodes.get((pod.get('spec') or {}).get('nodeName'))
+        if node is None:
+            return
+        if not is_finished(pod):
+            # DaemonSet requests take node capacity too
+            node[2] += pod_request(pod, 'cpu')
+            node[3] += pod_request(pod, 'memory')
+        if is_daemonset_pod(pod):
+            return
+        metadata = pod.get('metadata') or {}
+        owners = {owner.get('kind') for owner in metadata.get('ownerReferences') or []}
+        self.pods += 1
+        if "Job" in owners:
+            self.job_pods += 1
+        if "StatefulSet" in owners:
+            self.stateful_pods += 1
+        if (metadata.get('annotations') or {}).get(DO_NOT_DISRUPT) == "true":
+            self.do_not_disrupt += 1
+        lifetime = pod_lifetime(pod, now)
+        if lifetime is not None:
+            self.lifetimes[_bucket(lifetime)] += 1
+
+    def utilization(self, resource):
+        """
+        Return the mean requested/allocatable ratio of the nodes for
+        resource 0 (cpu) or 1 (memory)
+        """
+        ratios = [node[2 + resource] / node[resource]
+                  for node in self.nodes.values() if node[resource]]
+        return sum(ratios) / len(ratios) if ratios else None
+
+    def underutilized_nodes(self):
+        return sum(1 for node in self.nodes.values()
+                   if node[0] and node[1] and max(node[2] / node[0], node[3] / node[1]) <
+                   UNDERUTILIZED)
+
+    def lifetime_percentile(self, fraction):
+        """
+        Return the upper bound in seconds of the bucket holding the
+        percentile, None above the last bucket or without pods
+        """
+        total = sum(self.lifetimes)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(LIFETIME_BUCKETS + (None,), self.lifetimes):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+        return None
+
+    def as_dict(self):
+        cpu, memory = self.utilization(0), self.utilization(1)
+        return {
+            "nodes": len(self.nodes),
+            "pods": self.pods,
+            "jobPods": self.job_pods,
+            "statefulPods": self.stateful_pods,
+            "doNotDisruptPods": self.do_not_disrupt,
+            "cpuUtilization": None if cpu is None else round(cpu, 3),
+            "memoryUtilization": None if memory is None else round(memory, 3),
+            "underutilizedNodes": self.underutilized_nodes(),
+            "lifetimeP50Seconds": self.lifetime_percentile(0.5),
+            "lifetimeBuckets": dict(zip([str(bound) for bound in LIFETIME_BUCKETS] + ["+Inf"],
+                                        self.lifetimes)),
+        }
+
+
+def _bucket(seconds):
+    for i, bound in enumerate(LIFETIME_BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(LIFETIME_BUCKETS)
+
+
+def parse_timestamp(value):
+    """
+    Return an RFC 3339 timestamp of the API as an aware datetime
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def pod_lifetime(pod, now):
+    """
+    Return the seconds a pod ran, until now while it runs, None before it started
+    """
+    status = pod.get('status') or {}
+    started = parse_timestamp(status.get('startTime'))
+    if started is None:
+        return None
+    ended = None
+    if is_finished(pod):
+        finished = [parse_timestamp(((container.get('state') or {}).get('terminated') or {})
+                                     .get('finishedAt'))
+                    for container in status.get('containerStatuses') or []]
+        finished = [timestamp for timestamp in finished if timestamp is not None]
+        ended = max(finished) if finished else None
+    return max(0.0, ((ended or now) - started).total_seconds())
+
+
+def profile_nodegroups(nodegroup_names, page_size=PAGE_SIZE, now=None):
+    """
+    Stream the nodes and pods of the node groups and return a
+    NodegroupProfile per node group
+    """
+    from sharedlib import infra
+    core = infra.get_core_api()
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    profiles = {name: NodegroupProfile(name) for name in nodegroup_names}
+    node_profiles = {}
+    for node in paginate(core, core.list_node, page_size, label_selector=NODEGROUP_NODE_LABEL):
+        metadata = node.get('metadata') or {}
+        profile = profiles.get((metadata.get('labels') or {}).get(NODEGROUP_NODE_LABEL))
+        if profile is not None:
+            profile.add_node(metadata['name'], (node.get('status') or {}).get('allocatable') or {})
+            node_profiles[metadata['name']] = profile
+    if len(node_profiles) <= PER_NODE_LISTS:
+        pages = (paginate(core, core.list_pod_for_all_namespaces, page_size,
+                          field_selector="spec.nodeName=%s" % node_name)
+                 for node_name in sorted(node_profiles))
+        pods = (pod for page in pages for pod in page)
+    else:
+        pods = paginate(core, core.list_pod_for_all_namespaces, page_size)
+    for pod in pods:
+        profile = node_profiles.get((pod.get('spec') or {}).get('nodeName'))
+        if profile is not None:
+            profile.add_pod(pod, now)
+    return profiles
+
+
+def _duration(seconds):
+    return "%dm" % (seconds // 60) if seconds % 3600 else "%dh" % (seconds // 3600)
+
+
+def choose_disruption(profile):
+    """
+    Return (spec.disruption, reasons) for a node group profile
+    """
+    from sharedlib.render import DEFAULT_DISRUPTION
+    if not profile.nodes or not profile.pods:
+        return dict(DEFAULT_DISRUPTION), ["no pods observed, defaults kept"]
+    reasons = []
+    cpu, memory = profile.utilization(0) or 0.0, profile.utilization(1) or 0.0
+    utilization = max(cpu, memory)
+    batch = profile.job_pods / profile.pods >= BATCH_SHARE
+    p50 = profile.lifetime_percentile(0.5)
+    short_lived = p50 is not None and p50 <= SHORT_LIVED
+    if batch or short_lived:
+        # keep empty nodes for the next pods rather than churning them
+        after = min(MAX_CONSOLIDATE_AFTER, max(MIN_CONSOLIDATE_AFTER, p50 or 0))
+        disruption = {"consolidationPolicy": "WhenEmpty", "consolidateAfter": _duration(after)}
+        reasons.append("%d%% Job pods, median lifetime %s: consolidate empty nodes "
+                       "after %s" % (100 * profile.job_pods // profile.pods,
+                                     "up to " + _duration(p50) if p50 else "over 7 days",
+                                     disruption["consolidateAfter"]))
+    elif utilization >= PACKED:
+        disruption = {"consolidationPolicy": "WhenEmpty", "consolidateAfter": "5m"}
+        reasons.append("nodes %.0f%% requested: already packed, consolidate empty "
+                       "nodes only" % (100 * utilization))
+    else:
+        disruption = {"consolidationPolicy": "WhenUnderutilized"}
+        reasons.append("long running pods, nodes %.0f%% requested with %d/%d under "
+                       "%.0f%%: consolidate underutilized nodes" % (
+                           100 * utilization, profile.underutilized_nodes(),
+                           len(profile.nodes), 100 * UNDERUTILIZED))
+    if profile.stateful_pods:
+        disruption["expireAfter"] = "Never"
+        reasons.append("%d StatefulSet pods: never expire nodes" % profile.stateful_pods)
+    else:
+        disruption["expireAfter"] = DEFAULT_EXPIRE_AFTER
+        reasons.append("stateless: expire nodes after %s" % DEFAULT_EXPIRE_AFTER)
+    reasons.append("no disruption budgets: not supported by Karpenter v0.33, "
+                   "they need v0.34")
+    if profile.do_not_disrupt:
+        reasons.append("%d pods annotated %s block voluntary disruption of their "
+                       "nodes" % (profile.do_not_disrupt, DO_NOT_DISRUPT))
+    return disruption, reasons
+
+
+def disruption_report(profiles):
+    """
+    Return the disruption settings chosen per node group with the profile
+    and the reasons
+    """
+    report = {}
+    for name, profile in sorted(profiles.items()):
+        disruption, reasons = choose_disruption(profile)
+        report[name] = {"disruption": disruption, "reasons": reasons,
+                        "profile": profile.as_dict()}
+    return report
+
+
+def nodegroup_disruptions(nodegroup_names):
+    """
+    Return the disruption report of the node groups, or an empty one when
+    the cluster cannot be read: the NodePools then keep the defaults
+    """
+    from kubernetes.client.rest import ApiException
+    try:
+        report = disruption_report(profile_nodegroups(nodegroup_names))
+    except ApiException as e:
+        print("Unable to profile node group workloads: %s" % e, file=sys.stderr)
+        return {}
+    print_report(report)
+    return report
+
+
+def print_report(report, file=sys.stderr):
+    for name, entry in report.items():
+        profile = entry["profile"]
+        print("Disruption for nodegroup %s: %s (%d nodes, %d pods)" % (
+            name, ", ".join("%s=%s" % (key, value) for key, value in
+                            entry["disruption"].items()),
+            profile["nodes"], profile["pods"]), file=file)
+        for reason in entry["reasons"]:
+            print("    " + reason, file=file)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS)
+# the EKS and Kubernetes fakes of the benchmarks
+sys.path.insert(0, os.path.join(SCRIPTS, "benchmarks"))
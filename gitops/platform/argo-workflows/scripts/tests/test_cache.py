@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+
+from sharedlib.cache import ConfigMapTier, TTLCache, merge
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_expires_after_ttl():
+    clock = Clock()
+    cache = TTLCache(ttls={"nodegroup": 10}, clock=clock)
+    cache.set("nodegroup", "a", {"name": "a"})
+    assert cache.get("nodegroup", "a") == {"name": "a"}
+    clock.now += 11
+    assert cache.get("nodegroup", "a") is None
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set("ns", "a", 1)
+    cache.set("ns", "b", 2)
+    cache.get("ns", "a")
+    cache.set("ns", "c", 3)
+    assert cache.get("ns", "b") is None
+    assert cache.get("ns", "a") == 1
+    assert cache.evictions == 1
+
+
+def test_get_or_call_does_not_cache_none():
+    cache = TTLCache()
+    calls = []
+    assert cache.get_or_call("ns", "a", lambda: calls.append(1)) is None
+    assert cache.get_or_call("ns", "a", lambda: calls.append(1)) is None
+    assert len(calls) == 2
+
+
+def test_get_or_call_single_flight():
+    cache = TTLCache()
+    calls = []
+    release = threading.Event()
+
+    def describe():
+        calls.append(1)
+        release.wait(5)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache.get_or_call("cluster", "argocon-1", describe))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]
+    assert results == ["value"] * 8
+
+
+def test_get_or_call_shares_the_exception():
+    cache = TTLCache()
+    release = threading.Event()
+    errors = []
+
+    def describe():
+        release.wait(5)
+        raise RuntimeError("describe failed")
+
+    def caller():
+        try:
+            cache.get_or_call("cluster", "argocon-1", describe)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=caller) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert errors == ["describe failed"] * 4
+    # nothing left in flight, the next miss calls again
+    assert cache.get_or_call("cluster", "argocon-1", lambda: "value") == "value"
+
+
+def test_snapshot_restore_skips_expired():
+    clock = Clock()
+    cache = TTLCache(ttls={"short": 10, "long": 100}, clock=clock)
+    cache.set("short", "a", 1)
+    cache.set("long", "b", 2)
+    document = cache.snapshot()
+    clock.now += 50
+    restored = TTLCache(clock=clock)
+    restored.restore(document)
+    assert restored.get("short", "a") is None
+    assert restored.get("long", "b") == 2
+
+
+def test_merge_keeps_the_later_expiry():
+    base = {"version": 1, "entries": [["ns", "a", 100, "old"], ["ns", "b", 100, "b"]]}
+    document = {"version": 1, "entries": [["ns", "a", 200, "new"], ["ns", "c", 50, "c"]]}
+    merged = {(ns, key): (expires, value) for ns, key, expires, value in
+              merge(base, document)["entries"]}
+    assert merged == {("ns", "a"): (200, "new"), ("ns", "b"): (100, "b"),
+                      ("ns", "c"): (50, "c")}
+    assert merge(None, document)["entries"] == document["entries"]
+
+
+def test_configmap_tier_fit_drops_the_entries_expiring_first(monkeypatch):
+    monkeypatch.setattr(ConfigMapTier, "MAX_BYTES", 2000)
+    entries = [["ns", "key-%03d" % i, 1000 + i, "x" * 50] for i in range(100)]
+    data = ConfigMapTier("default", "cache").fit({"version": 1, "entries": entries})
+    assert len(data.encode()) <= 2000
+    assert "key-099" in data
+    assert "key-000" not in data
+
+
+@pytest.mark.parametrize("data", ["{not json", ""])
+def test_configmap_tier_tolerates_corrupt_data(data):
+    class ConfigMap:
+        pass
+    configmap = ConfigMap()
+    configmap.data = {ConfigMapTier.KEY: data}
+    assert ConfigMapTier._document(configmap) is None
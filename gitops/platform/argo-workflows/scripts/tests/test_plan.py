@@ -0,0 +1,100 @@
+from sharedlib import plan
+from sharedlib.drain import NODEGROUP_NODE_LABEL
+
+CATALOG = {"m5.large": {"vcpu": 2}}
+
+
+class Catalog:
+
+    def get(self, instance_type):
+        return CATALOG.get(instance_type)
+
+
+def nodegroups(*names, desired=2):
+    return {name: {"instanceTypes": ["m5.large"], "scalingConfig": {"desiredSize": desired}}
+            for name in names}
+
+
+def node(name, nodegroup):
+    return {"metadata": {"name": name, "labels": {NODEGROUP_NODE_LABEL: nodegroup}}}
+
+
+def pod(name, node_name, namespace="default", labels=None, priority_class=None):
+    return {"metadata": {"name": name, "namespace": namespace, "labels": labels or {}},
+            "spec": {"nodeName": node_name, "priorityClassName": priority_class},
+            "status": {"phase": "Running"}}
+
+
+def pdb(name, selector, allowed, namespace="default"):
+    return {"metadata": {"name": name, "namespace": namespace},
+            "spec": {"selector": {"matchLabels": selector}},
+            "status": {"disruptionsAllowed": allowed}}
+
+
+def make_plan(groups, nodes, pods, pdbs=(), **kwargs):
+    scores = plan.score_nodegroups(groups, nodes, pods, list(pdbs), Catalog())
+    batches, held = plan.plan_batches(scores, **kwargs)
+    return plan.build_plan("argocon-1", scores, batches, held)
+
+
+def test_selector_matches():
+    labels = {"app": "web", "tier": "front"}
+    assert plan.selector_matches({"matchLabels": {"app": "web"}}, labels)
+    assert not plan.selector_matches({"matchLabels": {"app": "db"}}, labels)
+    assert plan.selector_matches({"matchExpressions": [
+        {"key": "tier", "operator": "In", "values": ["front"]},
+        {"key": "zone", "operator": "DoesNotExist"}]}, labels)
+    assert not plan.selector_matches(
+        {"matchExpressions": [{"key": "app", "operator": "NotIn", "values": ["web"]}]}, labels)
+    assert not plan.selector_matches(None, labels)
+
+
+def test_app_nodegroups_share_batches():
+    result = make_plan(nodegroups("a", "b", "c"),
+                       [node("n-a", "a"), node("n-b", "b"), node("n-c", "c")],
+                       [pod("p-a", "n-a"), pod("p-b", "n-b"), pod("p-c", "n-c")],
+                       max_parallel=2)
+    assert [batch["nodegroups"] for batch in result["batches"]] == [["a", "b"], ["c"]]
+    assert result["batches"][0]["vcpus"] == 8
+
+
+def test_critical_nodegroups_last_one_per_batch():
+    result = make_plan(nodegroups("apps", "dns", "system"),
+                       [node("n1", "apps"), node("n2", "dns"), node("n3", "system")],
+                       [pod("web", "n1"),
+                        pod("coredns", "n2", "kube-system", {"k8s-app": "kube-dns"}),
+                        pod("metrics", "n3", "kube-system",
+                            priority_class="system-cluster-critical")])
+    batches = result["batches"]
+    assert [batch["nodegroups"] for batch in batches] == [["apps"], ["dns"], ["system"]]
+    assert [batch["critical"] for batch in batches] == [False, True, True]
+
+
+def test_tight_pdb_nodegroups_not_in_the_same_batch():
+    labels = {"app": "web"}
+    result = make_plan(nodegroups("a", "b"), [node("n-a", "a"), node("n-b", "b")],
+                       [pod("w1", "n-a", labels=labels), pod("w2", "n-b", labels=labels)],
+                       [pdb("web", labels, 1)])
+    assert [batch["nodegroups"] for batch in result["batches"]] == [["a"], ["b"]]
+    assert result["scores"]["a"]["tightPdbs"] == ["default/web"]
+
+
+def test_max_pods_and_vcpu_headroom_split_batches():
+    groups = nodegroups("a", "b")
+    nodes = [node("n-a", "a"), node("n-b", "b")]
+    pods = [pod("p%d" % i, "n-a" if i % 2 else "n-b") for i in range(6)]
+    assert len(make_plan(groups, nodes, pods, max_pods=4)["batches"]) == 2
+    assert len(make_plan(groups, nodes, pods, vcpu_headroom=4)["batches"]) == 2
+    assert len(make_plan(groups, nodes, pods)["batches"]) == 1
+
+
+def test_karpenter_nodegroup_held_as_a_skipped_batch():
+    result = make_plan(nodegroups("apps", "karpenter"),
+                       [node("n1", "apps"), node("n2", "karpenter")],
+                       [pod("web", "n1"),
+                        pod("controller", "n2", "karpenter",
+                            {"app.kubernetes.io/name": "karpenter"})])
+    assert [(batch["nodegroups"], batch["skipped"]) for batch in result["batches"]] == [
+        (["apps"], False), (["karpenter"], True)]
+    assert result["batches"][-1]["parallelism"] == 0
+    assert "karpenter" in result["held"]
@@ -0,0 +1,73 @@
+import boto3
+import pytest
+
+from sharedlib import poller, ratelimit
+from fakes import FakeCluster, FakeEKS
+
+
+def eks_client(fake):
+    session = boto3.Session(aws_access_key_id="test", aws_secret_access_key="test",
+                            region_name="us-east-2")
+    eks = session.client("eks", config=ratelimit.aws_client_config())
+    FakeEKS(fake).register(eks)
+    return eks
+
+
+def update(eks, fake, nodegroup, desired):
+    return eks.update_nodegroup_config(clusterName=fake.name, nodegroupName=nodegroup,
+                                       scalingConfig={"desiredSize": desired})
+
+
+def test_track_resolves_once_active():
+    fake = FakeCluster("test", nodegroups=3, nodes_per_nodegroup=1, pods_per_node=0,
+                       update_seconds=0.2)
+    eks = eks_client(fake)
+    updates = poller.NodegroupUpdatePoller(eks, min_interval=0.05, max_interval=0.1)
+    futures = {}
+    for name in sorted(fake.nodegroups):
+        response = update(eks, fake, name, 0)
+        futures[name] = updates.track(fake.name, name, response)
+    for name, future in futures.items():
+        assert future.result(10)["update"]["status"] == "InProgress"
+        assert fake.nodegroups[name]["status"] == "ACTIVE"
+    assert updates.pending_count() == 0
+
+
+def test_throttles_are_retried_not_failures():
+    fake = FakeCluster("test", nodegroups=1, nodes_per_nodegroup=0, pods_per_node=0,
+                       update_seconds=0.2)
+    eks = eks_client(fake)
+    name = next(iter(fake.nodegroups))
+    response = update(eks, fake, name, 1)
+    before = ratelimit.stats()[ratelimit.aws_bucket(eks)]
+    fake.throttle_rate = 0.5
+    updates = poller.NodegroupUpdatePoller(eks, min_interval=0.02, max_interval=0.05)
+    updates.track(fake.name, name, response).result(10)
+    after = ratelimit.stats()[ratelimit.aws_bucket(eks)]
+    assert sum(fake.throttled.values()) > 0
+    assert after["throttles"] - before["throttles"] == sum(fake.throttled.values())
+    assert after["failures"] == before["failures"]
+
+
+def test_failed_update_raises():
+    fake = FakeCluster("test", nodegroups=1, nodes_per_nodegroup=0, pods_per_node=0,
+                       update_seconds=60)
+    eks = eks_client(fake)
+    name = next(iter(fake.nodegroups))
+    response = update(eks, fake, name, 1)
+    fake.updates[response["update"]["id"]]["status"] = "Failed"
+    updates = poller.NodegroupUpdatePoller(eks, min_interval=0.02, max_interval=0.05)
+    with pytest.raises(poller.NodegroupUpdateError, match="Failed"):
+        updates.track(fake.name, name, response).result(10)
+
+
+def test_timeout_raises():
+    fake = FakeCluster("test", nodegroups=1, nodes_per_nodegroup=0, pods_per_node=0,
+                       update_seconds=60)
+    eks = eks_client(fake)
+    name = next(iter(fake.nodegroups))
+    response = update(eks, fake, name, 1)
+    updates = poller.NodegroupUpdatePoller(eks, min_interval=0.02, max_interval=0.05,
+                                           timeout=0.2)
+    with pytest.raises(poller.NodegroupUpdateError, match="Timed out"):
+        updates.track(fake.name, name, response).result(10)
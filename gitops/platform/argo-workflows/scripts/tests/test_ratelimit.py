@@ -0,0 +1,122 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from sharedlib import ratelimit
+
+
+def client_error(code, status=400):
+    return ClientError({"Error": {"Code": code, "Message": code},
+                        "ResponseMetadata": {"HTTPStatusCode": status}}, "DescribeNodegroup")
+
+
+class ApiException(Exception):
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(ratelimit.time, "sleep", lambda seconds: None)
+
+
+def counters(name):
+    return ratelimit.stats()[name]
+
+
+@pytest.mark.parametrize("error, kind", [
+    (client_error("ThrottlingException"), ratelimit.THROTTLE),
+    (client_error("Whatever", 429), ratelimit.THROTTLE),
+    (client_error("ServiceUnavailableException", 503), ratelimit.RETRYABLE),
+    (client_error("ResourceNotFoundException", 404), None),
+    (EndpointConnectionError(endpoint_url="https://eks"), ratelimit.RETRYABLE),
+    (ApiException(429), ratelimit.THROTTLE),
+    (ApiException(503), ratelimit.RETRYABLE),
+    (ApiException(404), None),
+    (ValueError("bug"), None),
+])
+def test_classify(error, kind):
+    assert ratelimit.classify(error) == kind
+
+
+def test_token_bucket_waits_for_a_token():
+    now, slept = [0.0], []
+    bucket = ratelimit.TokenBucket(10.0, 2, clock=lambda: now[0], sleep=slept.append)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.1)
+    assert slept == [pytest.approx(0.1)]
+
+
+def test_token_bucket_halves_on_throttle_and_recovers():
+    bucket = ratelimit.TokenBucket(10.0, 2, clock=lambda: 0.0, sleep=lambda seconds: None)
+    bucket.throttled()
+    assert bucket.rate == 5.0
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 10.0
+
+
+def test_call_retries_throttles():
+    attempts = []
+
+    def describe():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise client_error("ThrottlingException")
+        return "ok"
+
+    assert ratelimit.call("test-retry", describe) == "ok"
+    assert counters("test-retry") == dict(counters("test-retry"), calls=3, throttles=2,
+                                          retries=2, failures=0)
+
+
+def test_call_raises_non_retryable_errors_at_once():
+    def describe():
+        raise client_error("ResourceNotFoundException", 404)
+
+    with pytest.raises(ClientError):
+        ratelimit.call("test-fail", describe)
+    assert counters("test-fail")["calls"] == 1
+    assert counters("test-fail")["failures"] == 1
+
+
+def test_call_gives_up_after_max_attempts():
+    def describe():
+        raise client_error("ThrottlingException")
+
+    with pytest.raises(ClientError):
+        ratelimit.call("test-exhausted", describe, max_attempts=3)
+    assert counters("test-exhausted")["calls"] == 3
+    assert counters("test-exhausted")["failures"] == 1
+
+
+def test_caller_retries_are_not_failures():
+    def describe():
+        raise client_error("ThrottlingException")
+
+    with pytest.raises(ClientError):
+        ratelimit.call("test-caller", describe, max_attempts=1, caller_retries=True)
+    assert counters("test-caller")["throttles"] == 1
+    assert counters("test-caller")["retries"] == 1
+    assert counters("test-caller")["failures"] == 0
+
+
+def test_paginate_follows_the_token():
+    class Client:
+        class meta:
+            region_name = "us-east-2"
+
+            class service_model:
+                service_name = "eks"
+
+        def list_nodegroups(self, nextToken=None, **kwargs):
+            start = int(nextToken or 0)
+            page = {"nodegroups": ["ng-%d" % start]}
+            if start < 2:
+                page["nextToken"] = str(start + 1)
+            return page
+
+    pages = list(ratelimit.paginate(Client(), "list_nodegroups", clusterName="c"))
+    assert [page["nodegroups"] for page in pages] == [["ng-0"], ["ng-1"], ["ng-2"]]
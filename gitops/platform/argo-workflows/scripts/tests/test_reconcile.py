@@ -0,0 +1,91 @@
+import boto3
+import pytest
+
+from sharedlib import infra, ratelimit
+from sharedlib.apply import stamp
+from sharedlib.index import ResourceIndex
+from sharedlib.reconcile import FINGERPRINT_ANNOTATION, SCALED_DOWN, Reconciler, merge_patch
+from sharedlib.render import render_nodegroup
+from fakes import FakeCluster, FakeEKS, FakeKubeServer
+
+CONTEXT = "test"
+
+
+@pytest.fixture
+def fake():
+    fake = FakeCluster(CONTEXT, nodegroups=4, nodes_per_nodegroup=0, pods_per_node=0)
+    with fake.lock:
+        for name, nodegroup in fake.nodegroups.items():
+            node_class, node_pool = render_nodegroup(nodegroup, ["sg-cluster"])
+            fake.objects["ec2nodeclasses"][name] = stamp(node_class)
+            fake.objects["nodepools"][name] = stamp(node_pool)
+            nodegroup["scalingConfig"] = dict(SCALED_DOWN)
+    return fake
+
+
+@pytest.fixture
+def reconciler(fake):
+    from kubernetes.client import Configuration
+    session = boto3.Session(aws_access_key_id="test", aws_secret_access_key="test",
+                            region_name="us-east-2")
+    config = ratelimit.aws_client_config()
+    eks, ec2 = session.client("eks", config=config), session.client("ec2", config=config)
+    handler = FakeEKS(fake)
+    handler.register(eks)
+    handler.register(ec2)
+    with FakeKubeServer(fake) as server, infra.kube_context(CONTEXT):
+        infra.add_kube_client(CONTEXT, ratelimit.kube_api_client(
+            CONTEXT, Configuration(host=server.url)))
+        yield Reconciler(CONTEXT, eks, ec2, ResourceIndex().load(), budget=2)
+
+
+def statuses(results):
+    return sorted(result.status for result in results)
+
+
+def test_merge_patch():
+    current = {"a": 1, "b": {"c": 2, "d": 3}, "e": [1]}
+    desired = {"a": 1, "b": {"c": 4}, "e": [1, 2], "f": "new"}
+    # keys only the live object has are kept
+    assert merge_patch(current, desired) == {"b": {"c": 4}, "e": [1, 2], "f": "new"}
+    assert merge_patch(desired, desired) == {}
+
+
+def test_merge_patch_removes_keys_of_owned_maps():
+    current = {"spec": {"tags": {"team": "a", "old": "x"}}}
+    desired = {"spec": {"tags": {"team": "a"}}}
+    assert merge_patch(current, desired) == {"spec": {"tags": {"old": None}}}
+
+
+def test_budget_and_fingerprints(fake, reconciler):
+    # the first sweep stamps the fingerprints, the budget bounds each cycle
+    assert statuses(reconciler.cycle()) == ["reconciled", "reconciled"]
+    assert statuses(reconciler.cycle()) == ["reconciled", "reconciled"]
+    assert all(FINGERPRINT_ANNOTATION in pool["metadata"]["annotations"]
+               for pool in fake.objects["nodepools"].values())
+    calls = sum(fake.calls.values())
+    assert statuses(reconciler.cycle()) == ["unchanged", "unchanged"]
+    # one describe per node group, no writes
+    assert sum(fake.calls.values()) - calls == 2
+
+
+def test_edited_nodegroup_is_patched(fake, reconciler):
+    for _ in range(2):
+        reconciler.cycle()
+    name = sorted(fake.nodegroups)[0]
+    with fake.lock:
+        fake.nodegroups[name]["labels"]["tier"] = "edited"
+        fake.nodegroups[name]["scalingConfig"]["maxSize"] = 20
+    results = reconciler.cycle() + reconciler.cycle()
+    assert statuses(results) == ["reconciled", "unchanged", "unchanged", "unchanged"]
+    pool = fake.objects["nodepools"][name]
+    assert pool["spec"]["template"]["metadata"]["labels"]["tier"] == "edited"
+    assert pool["metadata"]["annotations"]["migrate.karpenter.io/max"] == "20"
+
+
+def test_deleted_nodegroup_is_missing(fake, reconciler):
+    name = sorted(fake.nodegroups)[0]
+    with fake.lock:
+        del fake.nodegroups[name]
+    results = reconciler.cycle()
+    assert [result.status for result in results if result.name == name] == ["missing"]
@@ -0,0 +1,114 @@
+import io
+import json
+
+import pytest
+
+from sharedlib import render
+from sharedlib.catalog import load_catalog
+
+
+def nodegroup(name="team-a", instance_types=("m5.large",), capacity_type="ON_DEMAND",
+              ami_type="AL2_x86_64", subnets=("subnet-1",)):
+    return {
+        "nodegroupName": name,
+        "clusterName": "argocon-1",
+        "capacityType": capacity_type,
+        "amiType": ami_type,
+        "instanceTypes": list(instance_types),
+        "scalingConfig": {"minSize": 1, "maxSize": 3, "desiredSize": 2},
+        "subnets": list(subnets),
+        "nodeRole": "arn:aws:iam::111122223333:role/nodes",
+        "labels": {"team": name},
+        "taints": [],
+        "tags": {},
+    }
+
+
+def requirement(node_pool, key):
+    return next(r for r in node_pool["spec"]["template"]["spec"]["requirements"]
+                if r["key"] == key)
+
+
+def test_render_nodegroup():
+    node_class, node_pool = render.render_nodegroup(nodegroup(), ["sg-1"])
+    assert node_class["kind"] == "EC2NodeClass"
+    assert node_class["spec"]["role"] == "nodes"
+    assert node_class["spec"]["securityGroupSelectorTerms"] == [{"id": "sg-1"}]
+    assert node_pool["metadata"]["annotations"] == {
+        "migrate.karpenter.io/min": "1", "migrate.karpenter.io/max": "3",
+        "migrate.karpenter.io/desired": "2"}
+    assert requirement(node_pool, "karpenter.sh/capacity-type")["values"] == ["on-demand"]
+    assert requirement(node_pool, "kubernetes.io/arch")["values"] == ["amd64"]
+    assert requirement(node_pool, "node.kubernetes.io/instance-type")["values"] == ["m5.large"]
+    assert node_pool["spec"]["disruption"] == render.DEFAULT_DISRUPTION
+
+
+def test_render_nodegroup_without_security_groups():
+    with pytest.raises(render.RenderError):
+        render.render_nodegroup(nodegroup())
+
+
+def test_limits_cover_maxsize_nodes():
+    info = load_catalog().get("m5.large")
+    node_pool = render.render_node_pool(nodegroup())
+    assert node_pool["spec"]["limits"] == {
+        "cpu": 3 * info["vcpu"], "memory": "%dMi" % (3 * info["memoryMiB"])}
+
+
+def test_limits_unset_when_not_in_catalog(capsys):
+    node_pool = render.render_node_pool(nodegroup(instance_types=["m5.large", "zz9.huge"]))
+    assert "limits" not in node_pool["spec"]
+    assert "zz9.huge" in capsys.readouterr().err
+
+
+def test_flexible_instance_mode():
+    node_pool = render.render_node_pool(nodegroup(), render.INSTANCE_FLEXIBLE)
+    keys = [r["key"] for r in node_pool["spec"]["template"]["spec"]["requirements"]]
+    assert "node.kubernetes.io/instance-type" not in keys
+    assert "karpenter.k8s.aws/instance-category" in keys
+
+
+def test_flexible_spot_keeps_on_demand_exact():
+    node_pool = render.render_node_pool(nodegroup(), render.INSTANCE_FLEXIBLE_SPOT)
+    assert requirement(node_pool, "node.kubernetes.io/instance-type")["values"] == ["m5.large"]
+
+
+def test_shared_node_class_with_every_nodegroup():
+    nodegroups = [(nodegroup("team-a"), ["sg-1"]), (nodegroup("team-b"), ["sg-1"])]
+    rendered = list(render.render(nodegroups, nodeclass_mode=render.NODECLASS_SHARED))
+    classes = [objects[0]["metadata"]["name"] for _, objects in rendered]
+    assert classes[0] == classes[1]
+    assert all(objects[1]["spec"]["template"]["spec"]["nodeClassRef"]["name"] == classes[0]
+               for _, objects in rendered)
+    stream = io.StringIO()
+    render.write_json_stream(iter(rendered), stream)
+    kinds = [obj["kind"] for obj in json.loads(stream.getvalue())["items"]]
+    assert kinds == ["EC2NodeClass", "NodePool", "NodePool"]
+
+
+def test_render_collects_errors():
+    errors = []
+    rendered = list(render.render([nodegroup("team-a"), (nodegroup("team-b"), ["sg-1"])],
+                                  errors=errors))
+    assert [name for name, _ in rendered] == ["team-b"]
+    assert [name for name, _ in errors] == ["team-a"]
+
+
+def test_taints_translated_and_migration_taints_dropped():
+    taints = [{"key": "dedicated", "value": "gpu", "effect": "NO_SCHEDULE"},
+              {"key": "migratedfrom", "value": "nodegroup", "effect": "NO_SCHEDULE"},
+              {"key": "owner", "value": "karpenter", "effect": "NO_EXECUTE"}]
+    assert render.translate_nodegroup_taints(taints) == [
+        {"key": "dedicated", "value": "gpu", "effect": "NoSchedule"}]
+    assert taints[0]["effect"] == "NO_SCHEDULE"
+
+
+@pytest.mark.parametrize("text", [
+    json.dumps([nodegroup("team-a"), nodegroup("team-b")]),
+    json.dumps(nodegroup("team-a")) + "\n" + json.dumps({"nodegroup": nodegroup("team-b")}),
+    "---\n" + json.dumps(nodegroup("team-a")) + "\n---\n" + json.dumps(nodegroup("team-b")),
+])
+def test_load_nodegroups_streams_json_and_yaml(monkeypatch, text):
+    monkeypatch.setattr(render, "READ_SIZE", 16)
+    names = [ng["nodegroupName"] for ng, _ in render.load_nodegroups(io.StringIO(text))]
+    assert names == ["team-a", "team-b"]